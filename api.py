@@ -1,14 +1,43 @@
-from fastapi import FastAPI, HTTPException, Header, Depends
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Header, Depends, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, conint
 from pathlib import Path
 import docker
+import pymysql
+import pymysql.cursors
+from pymysql.constants import FIELD_TYPE, FLAG
 import os
 import random
+import re
 import string
 import hashlib
+import contextvars
+import datetime
+import gzip
+import calendar
+import io
 import json
 import logging
-from typing import Dict, Optional
+import math
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+import tracing
+from mysql_proxy import CR_CONN_HOST_ERROR, MySQLProxy, ProxyError
+
+try:
+    import pyarrow
+except ImportError:  # Arrow output is optional
+    pyarrow = None
+
+ARROW_ERRORS = (pyarrow.ArrowException,) if pyarrow else ()
 
 
 # -------------------------------
@@ -17,10 +46,99 @@ from typing import Dict, Optional
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "supersecretadmintoken")
 MYSQL_IMAGE = "mysql:8.0"
+# Build and launch from a derived image with an already-initialised datadir
+MYSQL_PREINIT = os.getenv("MYSQL_PREINIT", "1") == "1"
+MYSQL_PREINIT_DATADIR = "/var/lib/mysql-preinit"
 MYSQL_ROOT_PASSWORD = os.getenv("MYSQL_ROOT_PASSWORD", "rootpassword")
-PORT_RANGE_START = 33070
-PORT_RANGE_END = 33100
-DATA_FILE = Path("users_db.json")
+PUBLIC_HOST = os.getenv("PUBLIC_HOST", "13.61.141.60")
+READINESS_HOST = os.getenv("READINESS_HOST", "127.0.0.1")
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "90"))
+PORT_RANGE_START = int(os.getenv("PORT_RANGE_START", "33070"))
+PORT_RANGE_END = int(os.getenv("PORT_RANGE_END", "33100"))  # exclusive
+DATA_FILE = Path("users_db.json")  # legacy JSON store, migrated on first startup
+DB_FILE = Path(os.getenv("USERS_DB_FILE", "users_db.sqlite3"))
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", "4"))
+STOP_TIMEOUT = int(os.getenv("STOP_TIMEOUT", "10"))  # seconds before Docker sends SIGKILL
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", "16"))  # cap on parallel /admin/bulk/ actions
+USER_LIST_PAGE_SIZE = int(os.getenv("USER_LIST_PAGE_SIZE", "200"))
+USER_LIST_MAX_PAGE_SIZE = 2000
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "2"))
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "60"))
+RECONCILE_GRACE = float(os.getenv("RECONCILE_GRACE", "300"))
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "3600"))  # 0 disables auto-stop
+IDLE_SAMPLE_INTERVAL = float(os.getenv("IDLE_SAMPLE_INTERVAL", "60"))
+IDLE_WORKERS = int(os.getenv("IDLE_WORKERS", "8"))
+# Log archive: every container's logs are copied into gzip files under
+# LOG_ARCHIVE_DIR each LOG_ARCHIVE_INTERVAL seconds (0 disables) and
+# indexed in SQLite, so they outlive the container.
+LOG_ARCHIVE_DIR = Path(os.getenv("LOG_ARCHIVE_DIR", "log_archive"))
+LOG_ARCHIVE_INTERVAL = float(os.getenv("LOG_ARCHIVE_INTERVAL", "60"))
+LOG_ARCHIVE_FILE_MB = int(os.getenv("LOG_ARCHIVE_FILE_MB", "64"))
+LOG_ARCHIVE_RETENTION_DAYS = float(os.getenv("LOG_ARCHIVE_RETENTION_DAYS", "30"))
+LOG_ARCHIVE_CHUNK_BYTES = 2**20  # uncompressed bytes per indexed chunk
+# Resource sampler: docker stats for every user container each
+# STATS_INTERVAL seconds (0 disables), keeping STATS_HISTORY samples each.
+STATS_INTERVAL = float(os.getenv("STATS_INTERVAL", "15"))
+STATS_HISTORY = int(os.getenv("STATS_HISTORY", "40"))
+# Per-container limits by tier; users pick up DEFAULT_TIER unless an admin
+# assigns another tier or per-user overrides. RESOURCE_TIERS (JSON) adds or
+# replaces tiers.
+DEFAULT_TIER = os.getenv("DEFAULT_TIER", "standard")
+RESOURCE_TIERS: Dict[str, Dict] = {
+    "small": {"mem_limit_mb": 384, "cpus": 0.5, "pids_limit": 128},
+    "standard": {"mem_limit_mb": 512, "cpus": 1.0, "pids_limit": 256},
+    "large": {"mem_limit_mb": 1024, "cpus": 2.0, "pids_limit": 512},
+}
+RESOURCE_TIERS.update(json.loads(os.getenv("RESOURCE_TIERS", "{}")))
+HOST_MEMORY_BUDGET_MB = int(os.getenv("HOST_MEMORY_BUDGET_MB", "0"))  # 0: 80% of MemTotal
+ADMISSION_WAIT = float(os.getenv("ADMISSION_WAIT", "60"))
+# Docker endpoints user containers are placed on (JSON list). Per host:
+# name, base_url (omit for the local daemon from the environment,
+# fake://<name> for the in-process fake driver), public_host,
+# readiness_host, memory_budget_mb, port_range_start, port_range_end,
+# publish_ports.
+DOCKER_HOSTS: List[Dict] = json.loads(os.getenv("DOCKER_HOSTS", "[]")) or [
+    {"name": "local", "public_host": PUBLIC_HOST, "readiness_host": READINESS_HOST}
+]
+PLACEMENT_STRATEGY = os.getenv("PLACEMENT_STRATEGY", "least_loaded")  # or "binpack"
+# "container": a mysqld container per user. "shared": a database and scoped
+# account per user on one of SHARED_MYSQL_INSTANCES. Overridable per user.
+PROVISION_MODE = os.getenv("PROVISION_MODE", "container")
+# Shared mysqld servers (JSON list). Per instance: name, host, port,
+# public_host, public_port, admin_user, admin_password, max_users.
+SHARED_MYSQL_INSTANCES: List[Dict] = json.loads(os.getenv("SHARED_MYSQL_INSTANCES", "[]"))
+SHARED_MAX_USER_CONNECTIONS = int(os.getenv("SHARED_MAX_USER_CONNECTIONS", "10"))
+# Single-port MySQL proxy (mysql_proxy.py) that routes logins by username;
+# 0 disables it and clients use each container's published port instead.
+MYSQL_PROXY_PORT = int(os.getenv("MYSQL_PROXY_PORT", "6033"))
+MYSQL_PROXY_PUBLIC_HOST = os.getenv("MYSQL_PROXY_PUBLIC_HOST", PUBLIC_HOST)
+MYSQL_PROXY_POOL_SIZE = int(os.getenv("MYSQL_PROXY_POOL_SIZE", "4"))
+MYSQL_PROXY_POOL_IDLE = float(os.getenv("MYSQL_PROXY_POOL_IDLE", "30"))  # keep below IDLE_TIMEOUT
+# Publish 3306 of every container on a host port. Unpublished containers are
+# reached on their MYSQL_NETWORK address, which the backend must be able to
+# route to (true for a local daemon); per host override: publish_ports.
+PUBLISH_PORTS = os.getenv("PUBLISH_PORTS", "0" if MYSQL_PROXY_PORT else "1") == "1"
+MYSQL_NETWORK = os.getenv("MYSQL_NETWORK", "sqllab")
+# /sql/execute/: pooled backend connections per user and result caps.
+SQL_POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", "2"))
+SQL_POOL_IDLE = float(os.getenv("SQL_POOL_IDLE", "30"))  # keep below IDLE_TIMEOUT
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "10000"))
+SQL_MAX_BYTES = int(os.getenv("SQL_MAX_BYTES", str(16 * 2**20)))
+SQL_BATCH_ROWS = 500
+ER_QUERY_TIMEOUT = 3024  # max_execution_time exceeded
+# Upper bound on one statement's run time; requests may ask for less.
+SQL_QUERY_TIMEOUT = float(os.getenv("SQL_QUERY_TIMEOUT", "30"))
+SQL_KILL_GRACE = 2  # watchdog backstop past the deadline, for non-SELECTs
+# Token buckets per username and endpoint class: per_minute refill rate
+# and burst size; per_minute 0 turns a class off. RATE_LIMITS (JSON)
+# overrides classes individually.
+RATE_LIMITS: Dict[str, Dict] = {
+    "auth": {"per_minute": 10, "burst": 5},
+    "provision": {"per_minute": 6, "burst": 3},
+    "sql": {"per_minute": 120, "burst": 20},
+    "admin": {"per_minute": 300, "burst": 60},
+}
+RATE_LIMITS.update(json.loads(os.getenv("RATE_LIMITS", "{}")))
 
 
 # -------------------------------
@@ -29,47 +147,246 @@ DATA_FILE = Path("users_db.json")
 app = FastAPI(title="MySQL Docker Manager")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+tracing.SERVICE = tracing.SERVICE or "backend"
 
-
-def get_docker_client():
+# -------------------------------
+# Metrics
+# -------------------------------
+# Served in Prometheus text format on /metrics. Gauges over state that is
+# kept elsewhere (container states, port pools) are collected at scrape
+# time and registered in the startup section.
+http_requests = metrics.Counter(
+    "sqllab_http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+http_latency = metrics.Histogram(
+    "sqllab_http_request_duration_seconds", "Time to response headers by route", ("method", "route")
+)
+http_in_flight = metrics.Gauge("sqllab_http_requests_in_flight", "Requests being handled")
+docker_latency = metrics.Histogram(
+    "sqllab_docker_call_duration_seconds", "Docker SDK call duration", ("host", "call")
+)
+docker_errors = metrics.Counter("sqllab_docker_call_errors_total", "Docker SDK calls that raised", ("host", "call"))
+db_latency = metrics.Histogram(
+    "sqllab_db_duration_seconds",
+    "User store statement duration, including lock wait",
+    ("op",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+provision_latency = metrics.Histogram(
+    "sqllab_provision_duration_seconds", "Container provisioning phases", ("source", "phase")
+)
+provision_jobs = metrics.Counter("sqllab_provision_jobs_total", "Finished provisioning jobs", ("status",))
+rate_limit_decisions = metrics.Counter(
+    "sqllab_rate_limit_decisions_total", "Rate limiter decisions", ("class", "outcome")
+)
+
+
+def get_docker_client(base_url: Optional[str] = None):
     try:
+        if base_url and base_url.startswith("fake://"):
+            import fake_docker
+
+            return fake_docker.FakeDockerClient(base_url[len("fake://"):])
+        if base_url:
+            return docker.DockerClient(base_url=base_url)
         return docker.from_env()
     except Exception as e:
-        logger.warning("Docker client not available: %s", e)
+        logger.warning("Docker client %s not available: %s", base_url or "from env", e)
         return None
 
 
-client = get_docker_client()
-
-
 # -------------------------------
-# In-memory user db (persisted)
+# User store (SQLite, WAL mode)
 # -------------------------------
-users_db: Dict[str, Dict] = {}
+# Column name -> SQL type. New user attributes are added here and picked up
+# by init_users_db() on existing databases through ALTER TABLE.
+USER_COLUMNS: Dict[str, str] = {
+    "password_hash": "TEXT NOT NULL",
+    "is_admin": "INTEGER NOT NULL DEFAULT 0",
+    "container_name": "TEXT",
+    "host_port": "INTEGER",
+    "suspended": "INTEGER NOT NULL DEFAULT 0",
+    "desired_state": "TEXT NOT NULL DEFAULT 'running'",
+    "idle_stopped_at": "REAL",
+    "idle_reclaimed_bytes": "INTEGER",
+    "tier": "TEXT",
+    "mem_limit_mb": "INTEGER",
+    "cpus": "REAL",
+    "pids_limit": "INTEGER",
+    "host": "TEXT",
+    "mode": "TEXT",
+    "shared_instance": "TEXT",
+    "mysql_user": "TEXT",
+    "mysql_password": "TEXT",
+}
+BOOL_COLUMNS = {"is_admin", "suspended"}
+SECRET_COLUMNS = {"password_hash", "mysql_password"}  # never returned by admin listings
+
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.RLock()
+# Bumped on every write to users so listings can answer If-None-Match
+# without reading the table.
+users_version = 0
+
+
+def users_changed() -> None:
+    global users_version
+    with _db_lock:
+        users_version += 1
+
+
+def get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        # One shared connection in autocommit mode; every access goes through
+        # _db_lock so FastAPI's worker threads never interleave statements.
+        _db = sqlite3.connect(str(DB_FILE), check_same_thread=False, isolation_level=None)
+        _db.row_factory = sqlite3.Row
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute("PRAGMA busy_timeout=5000")
+    return _db
+
+
+def db_execute(sql: str, params=()) -> sqlite3.Cursor:
+    with db_latency.time(op="execute"), _db_lock:
+        return get_db().execute(sql, params)
+
+
+def db_query(sql: str, params=()) -> List[sqlite3.Row]:
+    with db_latency.time(op="query"), _db_lock:
+        return get_db().execute(sql, params).fetchall()
+
+
+def init_users_db() -> None:
+    with _db_lock:
+        db = get_db()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "username TEXT PRIMARY KEY, "
+            + ", ".join(f"{col} {typ}" for col, typ in USER_COLUMNS.items())
+            + ")"
+        )
+        existing = {r["name"] for r in db.execute("PRAGMA table_info(users)")}
+        for col, typ in USER_COLUMNS.items():
+            if col not in existing:
+                db.execute(f"ALTER TABLE users ADD COLUMN {col} {typ}")
+        # Rows from before multi-host placement live on the first host.
+        db.execute(
+            "UPDATE users SET host = ? WHERE host IS NULL AND container_name IS NOT NULL",
+            (DEFAULT_HOST,),
+        )
+        db.execute("DROP INDEX IF EXISTS idx_users_host_port")
+        db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_host_host_port "
+            "ON users(host, host_port) WHERE host_port IS NOT NULL"
+        )
+        db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_container_name "
+            "ON users(container_name) WHERE container_name IS NOT NULL"
+        )
 
 
-# -------------------------------
-# Persistence helpers
-# -------------------------------
-def save_users_db() -> None:
+def migrate_users_json() -> None:
+    if not DATA_FILE.exists():
+        return
     try:
-        with open(DATA_FILE, "w") as f:
-            json.dump(users_db, f, indent=2)
+        with open(DATA_FILE, "r") as f:
+            legacy = json.load(f)
     except Exception as e:
-        logger.error("Failed to save users DB: %s", e)
+        logger.error("Failed to read legacy users DB %s: %s", DATA_FILE, e)
+        return
+    with _db_lock:
+        db = get_db()
+        db.execute("BEGIN")
+        try:
+            existing = {r["username"] for r in db.execute("SELECT username FROM users")}
+            ignored = []
+            for username, record in legacy.items():
+                fields = {k: record.get(k) for k in USER_COLUMNS if k in record}
+                cols = ["username", *fields]
+                before = db.total_changes
+                db.execute(
+                    f"INSERT OR IGNORE INTO users ({', '.join(cols)}) "
+                    f"VALUES ({', '.join('?' for _ in cols)})",
+                    [username, *fields.values()],
+                )
+                # Already-present usernames are from an earlier, interrupted
+                # run; anything else collided with a unique index.
+                if db.total_changes == before and username not in existing:
+                    ignored.append(username)
+            db.execute("COMMIT")
+            users_changed()
+        except Exception as e:
+            db.execute("ROLLBACK")
+            logger.error("Failed to migrate legacy users DB: %s", e)
+            return
+    migrated = DATA_FILE.with_suffix(".json.migrated")
+    if ignored:
+        logger.error(
+            "Skipped %d legacy users whose container name or host port is already taken: %s "
+            "(their records remain in %s)",
+            len(ignored), ", ".join(ignored), migrated,
+        )
+    DATA_FILE.rename(migrated)
+    logger.info("Migrated %d users from %s to %s", len(legacy) - len(ignored), DATA_FILE, DB_FILE)
 
 
 def load_users_db() -> None:
-    global users_db
+    init_users_db()
+    migrate_users_json()
+
+
+def row_to_user(row: sqlite3.Row) -> Dict:
+    user = {k: row[k] for k in row.keys() if k != "username"}
+    for col in BOOL_COLUMNS:
+        user[col] = bool(user.get(col))
+    return user
+
+
+def get_user(username: str) -> Optional[Dict]:
+    rows = db_query("SELECT * FROM users WHERE username = ?", (username,))
+    return row_to_user(rows[0]) if rows else None
+
+
+def user_exists(username: str) -> bool:
+    return bool(db_query("SELECT 1 FROM users WHERE username = ?", (username,)))
+
+
+def insert_user(username: str, **fields) -> bool:
+    cols = ["username", *fields]
     try:
-        if DATA_FILE.exists():
-            with open(DATA_FILE, "r") as f:
-                users_db = json.load(f)
-        else:
-            users_db = {}
-    except Exception as e:
-        logger.error("Failed to load users DB: %s", e)
-        users_db = {}
+        db_execute(
+            f"INSERT INTO users ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)})",
+            [username, *fields.values()],
+        )
+    except sqlite3.IntegrityError:
+        return False
+    users_changed()
+    return True
+
+
+def update_user(username: str, **fields) -> None:
+    if not fields:
+        return
+    assignments = ", ".join(f"{col} = ?" for col in fields)
+    db_execute(
+        f"UPDATE users SET {assignments} WHERE username = ?",
+        [*fields.values(), username],
+    )
+    users_changed()
+
+
+def remove_user(username: str) -> None:
+    db_execute("DELETE FROM users WHERE username = ?", (username,))
+    users_changed()
+
+
+def all_users() -> Dict[str, Dict]:
+    return {
+        r["username"]: row_to_user(r)
+        for r in db_query("SELECT * FROM users ORDER BY username")
+    }
 
 
 # -------------------------------
@@ -87,14 +404,11 @@ def random_string(n: int = 6) -> str:
     return "".join(random.choices(string.ascii_lowercase + string.digits, k=n))
 
 
-def get_user(username: str) -> Optional[Dict]:
-    return users_db.get(username)
-
-
 def require_admin(x_token: str = Header(...)) -> Dict:
     user = get_user(x_token)
     if not user or not user.get("is_admin"):
         raise HTTPException(status_code=403, detail="Admin privileges required")
+    enforce_rate_limit("admin", x_token)
     return user
 
 
@@ -107,40 +421,2539 @@ def require_auth(x_token: str = Header(...)) -> Dict:
     return {"username": x_token, **user}
 
 
-def assign_port() -> int:
-    used_ports = [u.get("host_port") for u in users_db.values() if u.get("host_port")]
-    for port in range(PORT_RANGE_START, PORT_RANGE_END):
-        if port not in used_ports:
+# -------------------------------
+# Rate limiting
+# -------------------------------
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        # Returns 0 when a token was taken, otherwise seconds until one is due.
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    MAX_BUCKETS = 10000
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60
+        self.burst = max(int(burst), 1)
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    def check(self, key: str) -> float:
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_BUCKETS:
+                    self._prune(now)
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            wait = bucket.take(now)
+            if wait:
+                self.rejected += 1
+            else:
+                self.allowed += 1
+            return wait
+
+    def _prune(self, now: float) -> None:
+        # A bucket that has refilled completely is the same as a new one.
+        full_after = self.burst / self.rate
+        self._buckets = {k: b for k, b in self._buckets.items() if now - b.updated < full_after}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "per_minute": self.rate * 60,
+                "burst": self.burst,
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "tracked_users": len(self._buckets),
+            }
+
+
+rate_limiters = {kind: RateLimiter(**cfg) for kind, cfg in RATE_LIMITS.items()}
+
+
+def enforce_rate_limit(kind: str, key: str) -> None:
+    wait = rate_limiters[kind].check(key)
+    rate_limit_decisions.inc(**{"class": kind, "outcome": "rejected" if wait else "allowed"})
+    if wait:
+        retry_after = math.ceil(wait)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many {kind} requests, retry in {retry_after}s",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+def rate_limit(kind: str) -> Callable:
+    def dependency(x_token: str = Header(...)) -> None:
+        enforce_rate_limit(kind, x_token)
+
+    return dependency
+
+
+# -------------------------------
+# Port allocation
+# -------------------------------
+class PortAllocator:
+    # Free-list of host ports with O(1) allocate/release. Ports in use are
+    # tracked in a set so a double release can never duplicate a free port.
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self._lock = threading.Lock()
+        self._free: deque = deque()
+        self._used: Dict[int, float] = {}  # port -> allocation time
+
+    def reset(self, used_ports) -> None:
+        with self._lock:
+            now = time.time()
+            self._used = {p: now for p in used_ports if self.start <= p < self.end}
+            self._free = deque(p for p in range(self.start, self.end) if p not in self._used)
+
+    def allocate(self) -> Optional[int]:
+        with self._lock:
+            if not self._free:
+                return None
+            port = self._free.popleft()
+            self._used[port] = time.time()
             return port
-    raise HTTPException(status_code=500, detail="No available port")
+
+    def release(self, port: Optional[int]) -> None:
+        with self._lock:
+            if port in self._used:
+                del self._used[port]
+                self._free.append(port)
+
+    def reclaim(self, keep, older_than: float) -> List[int]:
+        # Release ports nobody references any more, sparing recent
+        # allocations whose owner may not be recorded yet.
+        cutoff = time.time() - older_than
+        with self._lock:
+            leaked = [p for p, at in self._used.items() if p not in keep and at < cutoff]
+            for port in leaked:
+                del self._used[port]
+                self._free.append(port)
+        return leaked
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "range_start": self.start,
+                "range_end": self.end,
+                "used": len(self._used),
+                "free": len(self._free),
+            }
+
+
+def init_port_allocators() -> None:
+    for h in docker_hosts.values():
+        h.ports.reset(
+            r["host_port"]
+            for r in db_query(
+                "SELECT host_port FROM users WHERE host_port IS NOT NULL AND COALESCE(host, ?) = ? "
+                "UNION SELECT host_port FROM warm_pool WHERE host = ?",
+                (DEFAULT_HOST, h.name, h.name),
+            )
+        )
 
 
-def start_mysql_container(username: str) -> int:
-    if client is None:
+def assign_port(h: "DockerHost") -> int:
+    port = h.ports.allocate()
+    if port is None:
+        raise HTTPException(status_code=500, detail=f"No available port on {h.name}")
+    return port
+
+
+# -------------------------------
+# Resource limits and admission control
+# -------------------------------
+def resource_limits(user: Optional[Dict] = None) -> Dict:
+    user = user or {}
+    limits = dict(RESOURCE_TIERS.get(user.get("tier") or DEFAULT_TIER, RESOURCE_TIERS[DEFAULT_TIER]))
+    for key in ("mem_limit_mb", "cpus", "pids_limit"):
+        if user.get(key) is not None:
+            limits[key] = user[key]
+    return limits
+
+
+def docker_limits(limits: Dict) -> Dict:
+    return {
+        "mem_limit": f"{limits['mem_limit_mb']}m",
+        "memswap_limit": f"{limits['mem_limit_mb']}m",  # no swap on top of the limit
+        "cpu_period": 100000,
+        "cpu_quota": int(limits["cpus"] * 100000),
+    }
+
+
+class AdmissionController:
+    # Tracks memory committed to running containers against a host budget.
+    # reserve() blocks until the reservation fits or the timeout expires, so
+    # provisioning jobs queue behind capacity instead of overcommitting.
+    def __init__(self, budget_mb: int):
+        self.budget_mb = budget_mb
+        self._cond = threading.Condition()
+        self._committed: Dict[str, int] = {}
+
+    def reset(self, reservations: Dict[str, int]) -> None:
+        with self._cond:
+            self._committed = dict(reservations)
+            self._cond.notify_all()
+
+    def committed_mb(self) -> int:
+        with self._cond:
+            return sum(self._committed.values())
+
+    def available_mb(self) -> int:
+        return self.budget_mb - self.committed_mb()
+
+    def reserve(self, name: str, mb: int, timeout: float = 0) -> bool:
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                current = sum(self._committed.values()) - self._committed.get(name, 0)
+                if current + mb <= self.budget_mb:
+                    self._committed[name] = mb
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+
+    def transfer(self, old: str, new: str, mb: int) -> None:
+        with self._cond:
+            self._committed.pop(old, None)
+            self._committed[new] = mb
+            self._cond.notify_all()
+
+    def release(self, name: Optional[str]) -> None:
+        with self._cond:
+            if self._committed.pop(name, None) is not None:
+                self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            committed = sum(self._committed.values())
+            return {
+                "budget_mb": self.budget_mb,
+                "committed_mb": committed,
+                "available_mb": self.budget_mb - committed,
+                "containers": len(self._committed),
+            }
+
+
+def default_memory_budget_mb() -> int:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(int(line.split()[1]) / 1024 * 0.8)
+    except OSError:
+        pass
+    return 4096
+
+
+def init_admission() -> None:
+    reservations: Dict[str, Dict[str, int]] = {name: {} for name in docker_hosts}
+    for u in all_users().values():
+        if u.get("container_name") and u.get("desired_state") == "running":
+            host = u.get("host") or DEFAULT_HOST
+            reservations.setdefault(host, {})[u["container_name"]] = resource_limits(u)["mem_limit_mb"]
+    for row in db_query("SELECT container_name, host FROM warm_pool"):
+        reservations.setdefault(row["host"], {})[row["container_name"]] = resource_limits()["mem_limit_mb"]
+    for h in docker_hosts.values():
+        h.admission.reset(reservations.get(h.name, {}))
+
+
+def admit_container(
+    h: "DockerHost", name: str, user: Optional[Dict], timeout: float = ADMISSION_WAIT
+) -> None:
+    mb = resource_limits(user)["mem_limit_mb"]
+    if not h.admission.reserve(name, mb, timeout=timeout):
+        raise HTTPException(
+            status_code=503,
+            detail=f"Host {h.name} at capacity "
+            f"({h.admission.committed_mb()} of {h.admission.budget_mb} MB committed)",
+        )
+
+
+# -------------------------------
+# Docker hosts and placement
+# -------------------------------
+class DockerHost:
+    # One Docker endpoint and everything tracked per daemon: its port pool,
+    # memory admission, built image and container state cache.
+    def __init__(self, config: Dict):
+        self.name = config["name"]
+        self.base_url = config.get("base_url")
+        self.public_host = config.get("public_host", PUBLIC_HOST)
+        self.readiness_host = config.get("readiness_host", READINESS_HOST)
+        self.publish_ports = config.get("publish_ports", PUBLISH_PORTS)
+        client = get_docker_client(self.base_url)
+        nested = ("api", "containers", "images", "networks")
+        self.client = client and tracing.Traced(
+            metrics.Instrumented(client, docker_latency, docker_errors, {"host": self.name}, nested=nested),
+            "docker",
+            {"host": self.name},
+            nested=nested,
+        )
+        self.ports = PortAllocator(
+            config.get("port_range_start", PORT_RANGE_START),
+            config.get("port_range_end", PORT_RANGE_END),
+        )
+        self.admission = AdmissionController(
+            config.get("memory_budget_mb") or HOST_MEMORY_BUDGET_MB or default_memory_budget_mb()
+        )
+        self.mysql_image = MYSQL_IMAGE
+        self.container_states: Dict[str, Dict] = {}
+        self.states_lock = threading.Lock()
+        self.states_ready = threading.Event()
+        self.states_version = 0  # bumped on every change to container_states
+        self.warm_pool_wakeup = threading.Event()
+
+    def stats(self) -> Dict:
+        return {
+            "name": self.name,
+            "available": self.client is not None,
+            "public_host": self.public_host,
+            "image": self.mysql_image,
+            "ports": self.ports.stats(),
+            "memory": self.admission.stats(),
+        }
+
+
+docker_hosts: Dict[str, DockerHost] = {c["name"]: DockerHost(c) for c in DOCKER_HOSTS}
+DEFAULT_HOST = DOCKER_HOSTS[0]["name"]
+
+
+def live_hosts() -> List[DockerHost]:
+    return [h for h in docker_hosts.values() if h.client is not None]
+
+
+def host_of(user: Dict) -> DockerHost:
+    h = docker_hosts.get(user.get("host") or DEFAULT_HOST)
+    if h is None or h.client is None:
         raise HTTPException(status_code=500, detail="Docker not available")
-    port = assign_port()
-    container_name = f"mysql_{username}"
+    return h
+
+
+def place_container(user: Optional[Dict]) -> DockerHost:
+    mb = resource_limits(user)["mem_limit_mb"]
+    candidates = [h for h in live_hosts() if not h.publish_ports or h.ports.stats()["free"]]
+    if not candidates:
+        raise HTTPException(status_code=503, detail="No Docker host with free ports")
+    fitting = [h for h in candidates if h.admission.available_mb() >= mb]
+    if not fitting:
+        # Everything is full: queue on the host that frees up soonest in
+        # proportion to its size.
+        return max(candidates, key=lambda h: h.admission.available_mb() / h.admission.budget_mb)
+    if PLACEMENT_STRATEGY == "binpack":
+        return min(fitting, key=lambda h: h.admission.available_mb())
+    return max(fitting, key=lambda h: h.admission.available_mb() / h.admission.budget_mb)
+
+
+# -------------------------------
+# Pre-initialised MySQL image
+# -------------------------------
+# The official entrypoint ends with `exec "$@"`; neutralising it during the
+# build lets it initialise the datadir and stop, so the result is committed
+# into the image. The datadir lives outside the VOLUME at /var/lib/mysql,
+# whose contents would be discarded at build time.
+PREINIT_DOCKERFILE = f"""
+ARG BASE_IMAGE
+FROM ${{BASE_IMAGE}}
+ARG MYSQL_ROOT_PASSWORD
+ARG MYSQL_ROOT_HOST=%
+RUN sed -i 's/^\\(\\s*\\)exec "\\$@"/\\1: preinit/' /usr/local/bin/docker-entrypoint.sh \\
+ && MYSQL_ROOT_PASSWORD="$MYSQL_ROOT_PASSWORD" MYSQL_ROOT_HOST="$MYSQL_ROOT_HOST" \\
+    docker-entrypoint.sh mysqld --datadir={MYSQL_PREINIT_DATADIR} \\
+ && sed -i 's/^\\(\\s*\\): preinit/\\1exec "$@"/' /usr/local/bin/docker-entrypoint.sh \\
+ && test -d {MYSQL_PREINIT_DATADIR}/mysql
+CMD ["mysqld", "--datadir={MYSQL_PREINIT_DATADIR}"]
+"""
+
+def preinit_image_tag() -> str:
+    # Tag on everything baked into the image so a changed root password or
+    # base image builds a fresh one instead of reusing a stale cache.
+    digest = hashlib.sha256(
+        f"{MYSQL_IMAGE}|{MYSQL_ROOT_PASSWORD}|{PREINIT_DOCKERFILE}".encode()
+    ).hexdigest()[:12]
+    return f"sqllab-mysql-preinit:{digest}"
+
+
+def ensure_mysql_image(h: DockerHost) -> str:
+    if not MYSQL_PREINIT or h.client is None:
+        return h.mysql_image
+    tag = preinit_image_tag()
+    try:
+        h.client.images.get(tag)
+    except Exception:
+        logger.info("Building pre-initialised MySQL image %s on %s", tag, h.name)
+        started = time.time()
+        try:
+            h.client.images.build(
+                fileobj=io.BytesIO(PREINIT_DOCKERFILE.encode()),
+                tag=tag,
+                buildargs={"BASE_IMAGE": MYSQL_IMAGE, "MYSQL_ROOT_PASSWORD": MYSQL_ROOT_PASSWORD},
+                rm=True,
+            )
+        except Exception as e:
+            logger.error("Failed to build pre-initialised MySQL image on %s, using %s: %s", h.name, MYSQL_IMAGE, e)
+            return h.mysql_image
+        logger.info("Built %s on %s in %.1fs", tag, h.name, time.time() - started)
+    h.mysql_image = tag
+    return h.mysql_image
+
+
+# -------------------------------
+# Readiness probing and provisioning timings
+# -------------------------------
+def probe_mysql(host: str, port: int) -> bool:
+    # A listening mysqld sends its protocol-10 greeting first; docker-proxy
+    # accepts TCP on the host port long before that, so connect() alone
+    # proves nothing.
+    try:
+        with socket.create_connection((host, port), timeout=1) as sock:
+            header = sock.recv(4)
+            if len(header) < 4:
+                return False
+            return sock.recv(1) == b"\x0a"
+    except OSError:
+        return False
+
+
+def wait_for_mysql(host: str, port: int, timeout: float = READINESS_TIMEOUT) -> bool:
+    deadline = time.time() + timeout
+    delay = 0.05
+    while True:
+        if probe_mysql(host, port):
+            return True
+        if time.time() + delay > deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+
+
+def init_timings_db() -> None:
+    db_execute(
+        "CREATE TABLE IF NOT EXISTS provision_timings ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "username TEXT NOT NULL, "
+        "source TEXT NOT NULL, "
+        "create_seconds REAL, "
+        "start_seconds REAL, "
+        "ready_seconds REAL, "
+        "total_seconds REAL, "
+        "created_at REAL NOT NULL)"
+    )
+
+
+def record_provision_timing(username: str, source: str, timings: Dict[str, float]) -> None:
+    total = sum(timings.get(k, 0.0) for k in ("create_seconds", "start_seconds", "ready_seconds"))
+    for phase in ("create", "start", "ready"):
+        if timings.get(f"{phase}_seconds") is not None:
+            provision_latency.observe(timings[f"{phase}_seconds"], source=source, phase=phase)
+    provision_latency.observe(total, source=source, phase="total")
+    try:
+        db_execute(
+            "INSERT INTO provision_timings (username, source, create_seconds, start_seconds, "
+            "ready_seconds, total_seconds, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                username,
+                source,
+                timings.get("create_seconds"),
+                timings.get("start_seconds"),
+                timings.get("ready_seconds"),
+                total,
+                time.time(),
+            ),
+        )
+    except Exception as e:
+        logger.error("Failed to record provisioning timings for %s: %s", username, e)
+
+
+def ensure_network(h: DockerHost) -> None:
     try:
-        client.containers.run(
-            MYSQL_IMAGE,
-            name=container_name,
+        h.client.networks.get(MYSQL_NETWORK)
+    except docker.errors.NotFound:
+        h.client.networks.create(MYSQL_NETWORK, driver="bridge", labels={"sqllab.managed": "1"})
+
+
+def mysql_address(h: DockerHost, name: str, port: Optional[int]) -> Tuple[str, int]:
+    # Published containers via the host port, others on the Docker network.
+    if port:
+        return h.readiness_host, port
+    networks = h.client.api.inspect_container(name)["NetworkSettings"]["Networks"]
+    return networks[MYSQL_NETWORK]["IPAddress"], 3306
+
+
+def remove_container_quietly(h: DockerHost, name: str) -> None:
+    try:
+        h.client.api.remove_container(name, force=True)
+    except Exception:
+        logger.debug("Failed to clean up container %s", name)
+
+
+def create_mysql_container(
+    h: DockerHost, name: str, port: Optional[int], on_phase: Callable[[str], None], limits: Dict
+) -> Dict[str, float]:
+    timings: Dict[str, float] = {}
+    container = None
+    try:
+        on_phase("creating")
+        started = time.time()
+        container = h.client.containers.create(
+            h.mysql_image,
+            name=name,
             environment={
                 "MYSQL_ROOT_PASSWORD": MYSQL_ROOT_PASSWORD,
                 "MYSQL_ROOT_HOST": "%",
             },
-            ports={"3306/tcp": port},
+            ports={"3306/tcp": port} if port else {},
+            network=MYSQL_NETWORK,
+            labels={"sqllab.managed": "1"},
+            pids_limit=limits["pids_limit"],
+            **docker_limits(limits),
             detach=True,
         )
-    except Exception as e:
-        logger.error("Failed to start container for %s: %s", username, e)
-        raise HTTPException(status_code=500, detail="Failed to start container")
+        timings["create_seconds"] = time.time() - started
+        on_phase("starting")
+        started = time.time()
+        container.start()
+        timings["start_seconds"] = time.time() - started
+        started = time.time()
+        if not wait_for_mysql(*mysql_address(h, name, port)):
+            raise RuntimeError(f"MySQL in {name} not ready after {READINESS_TIMEOUT}s")
+        timings["ready_seconds"] = time.time() - started
+    except Exception:
+        if container is not None:
+            remove_container_quietly(h, name)
+        raise
+    return timings
+
+
+def start_mysql_container(
+    username: str, on_phase: Optional[Callable[[str], None]] = None
+) -> Optional[int]:
+    if not live_hosts():
+        raise HTTPException(status_code=500, detail="Docker not available")
+    on_phase = on_phase or (lambda phase: None)
+    user = get_user(username) or {}
+    h = place_container(user)
+    claimed = claim_pool_container(h, username, user)
+    if claimed:
+        container_name, port = claimed
+        started = time.time()
+        if wait_for_mysql(*mysql_address(h, container_name, port), timeout=5):
+            source = "pool"
+            timings = {"create_seconds": 0.0, "start_seconds": 0.0, "ready_seconds": time.time() - started}
+        else:
+            logger.warning("Pool container for %s not responding, cold-starting instead", username)
+            remove_container_quietly(h, container_name)
+            h.ports.release(port)
+            h.admission.release(container_name)
+            forget_pool_claim(h, container_name)
+            claimed = None
+    if not claimed:
+        source = "cold"
+        container_name = f"mysql_{username}"
+        # Waits here (job still "queued") until the host has room
+        admit_container(h, container_name, user)
+        port = None
+        try:
+            port = assign_port(h) if h.publish_ports else None
+            timings = create_mysql_container(h, container_name, port, on_phase, resource_limits(user))
+        except HTTPException:
+            h.admission.release(container_name)
+            raise
+        except Exception as e:
+            h.ports.release(port)
+            h.admission.release(container_name)
+            logger.error("Failed to start container for %s: %s", username, e)
+            raise HTTPException(status_code=500, detail="Failed to start container")
 
-    users_db[username]["container_name"] = container_name
-    users_db[username]["host_port"] = port
-    save_users_db()
+    try:
+        update_user(
+            username,
+            container_name=container_name,
+            host_port=port,
+            host=h.name,
+            desired_state="running",
+            # What the user presents to the MySQL proxy; the container itself
+            # keeps the shared root password.
+            mysql_password=user.get("mysql_password") or random_string(20),
+        )
+    finally:
+        if claimed:
+            forget_pool_claim(h, container_name)
+    record_provision_timing(username, source, timings)
+    h.warm_pool_wakeup.set()
     return port
 
 
+# -------------------------------
+# Warm container pool
+# -------------------------------
+# Unassigned, already-running containers named mysqlpool_<id>. A user's first
+# provisioning renames one to mysql_<username> instead of cold-starting mysqld.
+warm_pool_lock = threading.Lock()
+warm_pool_stop = threading.Event()
+warm_pool_stats = {"hits": 0, "misses": 0, "refill_failures": 0}
+warm_pool_refill_seconds: deque = deque(maxlen=100)
+# (host, container name) -> port for pool containers being handed to a user,
+# under both the pool and the user name. Between the pool row being deleted
+# and the user row being written they are in neither table, and the
+# reconciler must not take them for orphans.
+pool_claims: Dict[Tuple[str, str], Optional[int]] = {}
+pool_claims_lock = threading.Lock()
+
+
+def forget_pool_claim(h: DockerHost, *names: str) -> None:
+    with pool_claims_lock:
+        for name in names:
+            pool_claims.pop((h.name, name), None)
+
+
+def init_warm_pool_db() -> None:
+    # Pool rows from an older schema (no host, or a mandatory host port) are
+    # dropped; the reconciler collects their labelled containers as orphans.
+    columns = {r["name"]: r for r in db_query("PRAGMA table_info(warm_pool)")}
+    if columns and ("host" not in columns or columns["host_port"]["notnull"]):
+        db_execute("DROP TABLE warm_pool")
+    db_execute(
+        "CREATE TABLE IF NOT EXISTS warm_pool ("
+        "container_name TEXT NOT NULL, "
+        "host TEXT NOT NULL, "
+        "host_port INTEGER, "
+        "created_at REAL NOT NULL, "
+        "PRIMARY KEY (host, container_name), "
+        "UNIQUE (host, host_port))"
+    )
+
+
+def warm_pool_size(h: Optional[DockerHost] = None) -> int:
+    if h is None:
+        return db_query("SELECT COUNT(*) AS n FROM warm_pool")[0]["n"]
+    return db_query("SELECT COUNT(*) AS n FROM warm_pool WHERE host = ?", (h.name,))[0]["n"]
+
+
+def delete_pool_row(h: DockerHost, name: str) -> None:
+    db_execute("DELETE FROM warm_pool WHERE host = ? AND container_name = ?", (h.name, name))
+
+
+def claim_pool_container(h: DockerHost, username: str, user: Dict) -> Optional[Tuple[str, int]]:
+    if WARM_POOL_SIZE <= 0:
+        return None
+    limits = resource_limits(user)
+    with warm_pool_lock:
+        for row in db_query("SELECT * FROM warm_pool WHERE host = ? ORDER BY created_at", (h.name,)):
+            # The pool container holds the default tier's memory; resize its
+            # reservation to this user's tier first, or cold-start (and wait
+            # for room in admit_container) when the difference doesn't fit.
+            if not h.admission.reserve(row["container_name"], limits["mem_limit_mb"]):
+                break
+            container_name = f"mysql_{username}"
+            with pool_claims_lock:
+                for name in (row["container_name"], container_name):
+                    pool_claims[(h.name, name)] = row["host_port"]
+            delete_pool_row(h, row["container_name"])
+            try:
+                container = h.client.containers.get(row["container_name"])
+                container.rename(container_name)
+                if limits != resource_limits():
+                    # Pool containers run with the default tier; pids_limit
+                    # cannot be changed on a live container.
+                    container.update(**docker_limits(limits))
+            except Exception as e:
+                logger.warning("Discarding pool container %s: %s", row["container_name"], e)
+                remove_container_quietly(h, row["container_name"])
+                remove_container_quietly(h, container_name)
+                h.ports.release(row["host_port"])
+                h.admission.release(row["container_name"])
+                forget_pool_claim(h, row["container_name"], container_name)
+                continue
+            forget_pool_claim(h, row["container_name"])
+            h.admission.transfer(row["container_name"], container_name, limits["mem_limit_mb"])
+            warm_pool_stats["hits"] += 1
+            return container_name, row["host_port"]
+        warm_pool_stats["misses"] += 1
+    return None
+
+
+def refill_warm_pool(h: DockerHost) -> None:
+    while not warm_pool_stop.is_set() and warm_pool_size(h) < WARM_POOL_SIZE:
+        port = h.ports.allocate() if h.publish_ports else None
+        if h.publish_ports and port is None:
+            logger.warning("Warm pool refill on %s paused: no free ports", h.name)
+            return
+        name = f"mysqlpool_{random_string(8)}"
+        if not h.admission.reserve(name, resource_limits()["mem_limit_mb"]):
+            h.ports.release(port)
+            logger.info("Warm pool refill on %s paused: host memory budget reached", h.name)
+            return
+        started = time.time()
+        try:
+            create_mysql_container(h, name, port, lambda phase: None, resource_limits())
+        except Exception as e:
+            h.ports.release(port)
+            h.admission.release(name)
+            warm_pool_stats["refill_failures"] += 1
+            logger.error("Failed to refill warm pool: %s", e)
+            return
+        warm_pool_refill_seconds.append(time.time() - started)
+        db_execute(
+            "INSERT INTO warm_pool (container_name, host, host_port, created_at) VALUES (?, ?, ?, ?)",
+            (name, h.name, port, time.time()),
+        )
+
+
+def prune_warm_pool(h: DockerHost) -> None:
+    for row in db_query("SELECT * FROM warm_pool WHERE host = ?", (h.name,)):
+        try:
+            h.client.api.inspect_container(row["container_name"])
+        except Exception:
+            delete_pool_row(h, row["container_name"])
+            h.ports.release(row["host_port"])
+            h.admission.release(row["container_name"])
+
+
+def warm_pool_loop(h: DockerHost) -> None:
+    prune_warm_pool(h)
+    while not warm_pool_stop.is_set():
+        refill_warm_pool(h)
+        h.warm_pool_wakeup.wait(timeout=30)
+        h.warm_pool_wakeup.clear()
+
+
+# -------------------------------
+# Shared-instance mode
+# -------------------------------
+# Users in "shared" mode get a database named after their username and an
+# account that can only touch it, on the least-populated shared mysqld.
+class SharedInstance:
+    def __init__(self, config: Dict):
+        self.name = config["name"]
+        self.host = config.get("host", READINESS_HOST)
+        self.port = int(config.get("port", 3306))
+        self.public_host = config.get("public_host", PUBLIC_HOST)
+        self.public_port = int(config.get("public_port", self.port))
+        self.admin_user = config.get("admin_user", "root")
+        self.admin_password = config.get("admin_password", MYSQL_ROOT_PASSWORD)
+        self.max_users = int(config.get("max_users", 200))
+
+    def connect(self, **kwargs):
+        return pymysql.connect(
+            host=self.host,
+            port=self.port,
+            user=self.admin_user,
+            password=self.admin_password,
+            autocommit=True,
+            connect_timeout=5,
+            **kwargs,
+        )
+
+
+shared_instances: Dict[str, SharedInstance] = {c["name"]: SharedInstance(c) for c in SHARED_MYSQL_INSTANCES}
+shared_placement_lock = threading.Lock()
+
+
+def user_mode(user: Dict) -> str:
+    return user.get("mode") or PROVISION_MODE
+
+
+def is_provisioned(user: Dict) -> bool:
+    return bool(user.get("container_name") or user.get("shared_instance"))
+
+
+def quote_ident(name: str) -> str:
+    return "`" + name.replace("`", "``") + "`"
+
+
+def shared_account_name(username: str) -> str:
+    # MySQL account names are capped at 32 characters and must not clash with
+    # root or the mysql.* system accounts.
+    account = f"u_{username}"
+    if len(account) <= 32:
+        return account
+    return f"u_{username[:21]}_{hashlib.sha1(username.encode()).hexdigest()[:8]}"
+
+
+def create_shared_account(inst: SharedInstance, username: str) -> Tuple[str, str]:
+    if len(username) > 64:
+        raise HTTPException(status_code=400, detail="Username too long for a database name")
+    account, password = shared_account_name(username), random_string(20)
+    # `_` and `%` are wildcards in a GRANT's database name.
+    grant_db = quote_ident(username.replace("\\", "\\\\").replace("_", "\\_").replace("%", "\\%"))
+    with inst.connect() as conn, conn.cursor() as cur:
+        cur.execute(f"CREATE DATABASE IF NOT EXISTS {quote_ident(username)}")
+        cur.execute("DROP USER IF EXISTS %s@'%%'", (account,))
+        cur.execute(
+            "CREATE USER %s@'%%' IDENTIFIED BY %s WITH MAX_USER_CONNECTIONS %s",
+            (account, password, SHARED_MAX_USER_CONNECTIONS),
+        )
+        cur.execute(f"GRANT ALL PRIVILEGES ON {grant_db.replace('%', '%%')}.* TO %s@'%%'", (account,))
+    return account, password
+
+
+def drop_shared_account(inst: SharedInstance, username: str, account: str) -> None:
+    with inst.connect() as conn, conn.cursor() as cur:
+        kill_shared_sessions(cur, account)
+        cur.execute("DROP USER IF EXISTS %s@'%%'", (account,))
+        cur.execute(f"DROP DATABASE IF EXISTS {quote_ident(username)}")
+
+
+def kill_shared_sessions(cur, account: str) -> int:
+    cur.execute("SELECT id FROM information_schema.processlist WHERE user = %s", (account,))
+    killed = 0
+    for (session_id,) in cur.fetchall():
+        try:
+            cur.execute(f"KILL {int(session_id)}")
+            killed += 1
+        except pymysql.MySQLError:
+            pass  # already gone
+    return killed
+
+
+def set_shared_account_locked(u: Dict, locked: bool) -> None:
+    inst = shared_instance_of(u)
+    with inst.connect() as conn, conn.cursor() as cur:
+        cur.execute(
+            f"ALTER USER %s@'%%' ACCOUNT {'LOCK' if locked else 'UNLOCK'}", (u["mysql_user"],)
+        )
+        if locked:
+            kill_shared_sessions(cur, u["mysql_user"])
+
+
+def shared_instance_of(user: Dict) -> SharedInstance:
+    inst = shared_instances.get(user.get("shared_instance") or "")
+    if inst is None:
+        raise HTTPException(status_code=500, detail="Shared MySQL instance not configured")
+    return inst
+
+
+def shared_instance_load() -> Dict[str, int]:
+    counts = {name: 0 for name in shared_instances}
+    for r in db_query(
+        "SELECT shared_instance, COUNT(*) AS n FROM users "
+        "WHERE shared_instance IS NOT NULL GROUP BY shared_instance"
+    ):
+        counts[r["shared_instance"]] = r["n"]
+    return counts
+
+
+def provision_shared_user(username: str, on_phase: Callable[[str], None]) -> SharedInstance:
+    if not shared_instances:
+        raise HTTPException(status_code=503, detail="No shared MySQL instance configured")
+    started = time.time()
+    on_phase("creating")
+    with shared_placement_lock:
+        load = shared_instance_load()
+        inst = min(shared_instances.values(), key=lambda i: load[i.name] / i.max_users)
+        if load[inst.name] >= inst.max_users:
+            raise HTTPException(status_code=503, detail="All shared MySQL instances are full")
+        account, password = create_shared_account(inst, username)
+        update_user(
+            username,
+            mode="shared",
+            shared_instance=inst.name,
+            mysql_user=account,
+            mysql_password=password,
+            desired_state="running",
+        )
+    record_provision_timing(username, "shared", {"create_seconds": time.time() - started})
+    return inst
+
+
+def provision_user(username: str, on_phase: Optional[Callable[[str], None]] = None) -> int:
+    if user_mode(get_user(username) or {}) == "shared":
+        return provision_shared_user(username, on_phase or (lambda phase: None)).public_port
+    return start_mysql_container(username, on_phase)
+
+
+def connection_info(username: str, user: Dict) -> Dict:
+    if MYSQL_PROXY_PORT:
+        password = user.get("mysql_password")
+        if not password:
+            # Containers provisioned before the proxy have no proxy password yet.
+            password = random_string(20)
+            update_user(username, mysql_password=password)
+        return {
+            "mode": user_mode(user),
+            "host": MYSQL_PROXY_PUBLIC_HOST,
+            "port": MYSQL_PROXY_PORT,
+            "user": username,
+            "password": password,
+            "database": username if user.get("shared_instance") else None,
+        }
+    if user.get("shared_instance"):
+        inst = shared_instance_of(user)
+        return {
+            "mode": "shared",
+            "host": inst.public_host,
+            "port": inst.public_port,
+            "user": user["mysql_user"],
+            "password": user["mysql_password"],
+            "database": username,
+        }
+    return {
+        "mode": "container",
+        "host": host_of(user).public_host,
+        "port": user.get("host_port"),
+        "user": "root",
+        "password": MYSQL_ROOT_PASSWORD,
+        "database": None,
+    }
+
+
+# -------------------------------
+# Request coalescing
+# -------------------------------
+class SingleFlight:
+    # Concurrent calls with the same key share one execution: the first
+    # caller runs fn, later ones wait for it and get the same result or
+    # exception. Keys are forgotten as soon as the call finishes.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Dict] = {}
+        self.stats = {"executed": 0, "coalesced": 0}
+
+    def do(self, key: str, fn: Callable):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+                self.stats["executed"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if leader:
+            try:
+                call["result"] = fn()
+            except BaseException as e:
+                call["error"] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+        else:
+            call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+
+provision_flight = SingleFlight()
+resume_flight = SingleFlight()
+
+
+# -------------------------------
+# Provisioning job queue
+# -------------------------------
+JOB_ACTIVE_STATES = ("queued", "creating", "starting")
+
+provision_executor = ThreadPoolExecutor(
+    max_workers=PROVISION_WORKERS, thread_name_prefix="provision"
+)
+
+
+def init_jobs_db() -> None:
+    db_execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "job_id TEXT PRIMARY KEY, "
+        "username TEXT NOT NULL, "
+        "status TEXT NOT NULL, "
+        "host_port INTEGER, "
+        "error TEXT, "
+        "created_at REAL NOT NULL, "
+        "updated_at REAL NOT NULL)"
+    )
+    db_execute("CREATE INDEX IF NOT EXISTS idx_jobs_username ON jobs(username, status)")
+
+
+def get_job(job_id: str) -> Optional[Dict]:
+    rows = db_query("SELECT * FROM jobs WHERE job_id = ?", (job_id,))
+    return dict(rows[0]) if rows else None
+
+
+def active_job_for(username: str) -> Optional[Dict]:
+    rows = db_query(
+        f"SELECT * FROM jobs WHERE username = ? AND status IN ({', '.join('?' for _ in JOB_ACTIVE_STATES)}) "
+        "ORDER BY created_at DESC LIMIT 1",
+        (username, *JOB_ACTIVE_STATES),
+    )
+    return dict(rows[0]) if rows else None
+
+
+def set_job_status(job_id: str, status: str, **fields) -> None:
+    if status in ("ready", "failed"):
+        provision_jobs.inc(status=status)
+    fields.update(status=status, updated_at=time.time())
+    assignments = ", ".join(f"{col} = ?" for col in fields)
+    db_execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", [*fields.values(), job_id])
+
+
+def run_provision_job(job_id: str, username: str) -> None:
+    user = get_user(username) or {}
+    if is_provisioned(user):
+        # Queued before an earlier job for this user finished.
+        set_job_status(job_id, "ready", host_port=connection_info(username, user)["port"])
+        return
+    try:
+        with tracing.span("provision.job", root=False, job_id=job_id):
+            port = provision_user(username, on_phase=lambda phase: set_job_status(job_id, phase))
+    except HTTPException as e:
+        set_job_status(job_id, "failed", error=str(e.detail))
+        return
+    except Exception as e:
+        logger.error("Provisioning job %s for %s failed: %s", job_id, username, e)
+        set_job_status(job_id, "failed", error=str(e))
+        return
+    set_job_status(job_id, "ready", host_port=port)
+
+
+def enqueue_provision(username: str) -> Dict:
+    # Two tabs or a double click must not both pass the active-job check.
+    return provision_flight.do(username, lambda: insert_provision_job(username))
+
+
+def insert_provision_job(username: str) -> Dict:
+    job = active_job_for(username)
+    if job:
+        return job
+    now = time.time()
+    job_id = uuid.uuid4().hex
+    db_execute(
+        "INSERT INTO jobs (job_id, username, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (job_id, username, "queued", now, now),
+    )
+    # The job's Docker calls join the trace of the request that queued it.
+    provision_executor.submit(contextvars.copy_context().run, run_provision_job, job_id, username)
+    return get_job(job_id)
+
+
+def resume_provision_jobs() -> None:
+    # Jobs interrupted by a restart are re-run from scratch; a half-created
+    # container from the previous run would otherwise block the name.
+    for job in db_query(
+        f"SELECT * FROM jobs WHERE status IN ({', '.join('?' for _ in JOB_ACTIVE_STATES)}) ORDER BY created_at",
+        JOB_ACTIVE_STATES,
+    ):
+        user = get_user(job["username"])
+        if not user or is_provisioned(user):
+            set_job_status(job["job_id"], "failed", error="Interrupted by backend restart")
+            continue
+        if job["status"] != "queued":
+            for h in live_hosts():
+                try:
+                    h.client.api.remove_container(f"mysql_{job['username']}", force=True)
+                except Exception:
+                    pass
+        set_job_status(job["job_id"], "queued")
+        provision_executor.submit(run_provision_job, job["job_id"], job["username"])
+        logger.info("Resumed provisioning job %s for %s", job["job_id"], job["username"])
+
+
+# -------------------------------
+# Container state cache (Docker events)
+# -------------------------------
+# Per host: name -> {"id", "status", "health", "started_at", "exit_code"},
+# kept current by a background subscriber to that daemon's events stream so
+# endpoints can answer status questions without a round trip.
+container_events_stop = threading.Event()
+
+
+def parse_list_status(status: str) -> Dict:
+    # /containers/json only has a human Status such as
+    # "Exited (137) 2 hours ago" or "Up 5 minutes (healthy)".
+    info: Dict = {"health": None, "exit_code": None}
+    if status.startswith("Exited (") and ")" in status:
+        try:
+            info["exit_code"] = int(status[len("Exited ("):status.index(")")])
+        except ValueError:
+            pass
+    for health in ("healthy", "unhealthy", "starting"):
+        if f"({health})" in status or f"(health: {health})" in status:
+            info["health"] = health
+    return info
+
+
+def seed_container_states(h: DockerHost) -> None:
+    states = {}
+    for c in h.client.api.containers(all=True):
+        name = c["Names"][0].lstrip("/")
+        states[name] = {
+            "id": c["Id"],
+            "status": c["State"],
+            "started_at": None,
+            **parse_list_status(c.get("Status", "")),
+        }
+    with h.states_lock:
+        h.container_states.clear()
+        h.container_states.update(states)
+        h.states_version += 1
+    h.states_ready.set()
+
+
+def apply_container_event(h: DockerHost, event: Dict) -> None:
+    action = event.get("Action") or event.get("status") or ""
+    attrs = event.get("Actor", {}).get("Attributes", {})
+    name = attrs.get("name")
+    if not name:
+        return
+    with h.states_lock:
+        before = h.container_states.get(name)
+        before = dict(before) if before is not None else None
+        if action == "destroy":
+            if h.container_states.pop(name, None) is not None:
+                h.states_version += 1
+            return
+        if action == "rename":
+            old = attrs.get("oldName", "").lstrip("/")
+            state = h.container_states.pop(old, None) or {}
+            h.container_states[name] = state
+            h.states_version += 1
+        state = h.container_states.setdefault(
+            name,
+            {"id": event.get("id"), "status": None, "health": None, "started_at": None, "exit_code": None},
+        )
+        if action == "create":
+            state["status"] = "created"
+        elif action in ("start", "restart", "unpause"):
+            state.update(status="running", started_at=event.get("time"), exit_code=None)
+        elif action == "die":
+            exit_code = attrs.get("exitCode")
+            state.update(status="exited", exit_code=int(exit_code) if exit_code is not None else None)
+        elif action == "pause":
+            state["status"] = "paused"
+        elif action == "oom":
+            state["oom_killed"] = True
+        elif action.startswith("health_status:"):
+            state["health"] = action.split(":", 1)[1].strip()
+        # exec_* events (the idle sampler's probes) change nothing and must
+        # not invalidate listing ETags.
+        if state != before:
+            h.states_version += 1
+
+
+def container_events_loop(h: DockerHost) -> None:
+    while not container_events_stop.is_set():
+        try:
+            # Subscribe from just before the seed so nothing between the
+            # listing and the stream is lost; replays are idempotent.
+            since = time.time()
+            seed_container_states(h)
+            for event in h.client.events(decode=True, since=since, filters={"type": "container"}):
+                if container_events_stop.is_set():
+                    return
+                apply_container_event(h, event)
+        except Exception as e:
+            logger.warning("Docker events stream on %s interrupted: %s", h.name, e)
+        h.states_ready.clear()
+        container_events_stop.wait(timeout=5)
+
+
+def get_container_state(h: DockerHost, name: str) -> Optional[Dict]:
+    if h.states_ready.is_set():
+        with h.states_lock:
+            state = h.container_states.get(name)
+        if state:
+            return dict(state)
+    # Cache not available, or the create event has not arrived yet: inspect.
+    try:
+        state = h.client.api.inspect_container(name)["State"]
+    except docker.errors.NotFound:
+        return None
+    return {
+        "status": state.get("Status"),
+        "health": state.get("Health", {}).get("Status"),
+        "started_at": state.get("StartedAt"),
+        "exit_code": state.get("ExitCode"),
+    }
+
+
+def require_container(username: str) -> Dict:
+    u = get_user(username)
+    if not u or not u.get("container_name"):
+        raise HTTPException(status_code=404, detail="Container not found")
+    state = get_container_state(host_of(u), u["container_name"])
+    if state is None:
+        raise HTTPException(status_code=404, detail="Container not found")
+    return {**u, "state": state}
+
+
+# -------------------------------
+# Reconciler
+# -------------------------------
+# Periodically compares the users and warm_pool tables with one batched
+# container listing and repairs drift: restarts containers that should be
+# running, forgets containers that vanished, removes managed containers
+# nobody owns and returns leaked ports to the allocator.
+reconcile_lock = threading.Lock()
+reconcile_stop = threading.Event()
+last_reconcile_report: Dict = {}
+reconcile_totals = {"runs": 0, "restarted": 0, "missing": 0, "orphans_removed": 0, "ports_reclaimed": 0}
+
+
+def reconcile_host(h: DockerHost, users: Dict[str, Dict], report: Dict) -> None:
+    containers = {c["Names"][0].lstrip("/"): c for c in h.client.api.containers(all=True)}
+    pool = {
+        r["container_name"]: r["host_port"]
+        for r in db_query("SELECT * FROM warm_pool WHERE host = ?", (h.name,))
+    }
+    owned = set()
+    keep_ports = set(pool.values())
+    for username, u in users.items():
+        name = u.get("container_name")
+        if not name:
+            continue
+        c = containers.get(name)
+        if c is None:
+            update_user(username, container_name=None, host_port=None, host=None)
+            h.ports.release(u.get("host_port"))
+            h.admission.release(name)
+            report["missing"].append(username)
+            continue
+        owned.add(name)
+        if u.get("host_port"):
+            keep_ports.add(u["host_port"])
+        if u.get("desired_state") == "running" and c["State"] in ("exited", "dead", "created"):
+            if not h.admission.reserve(name, resource_limits(u)["mem_limit_mb"]):
+                report["errors"].append(f"start {name} on {h.name}: host at capacity")
+                continue
+            try:
+                h.client.api.start(name)
+                report["restarted"].append(username)
+            except Exception as e:
+                report["errors"].append(f"start {name} on {h.name}: {e}")
+
+    for name, port in pool.items():
+        if name not in containers:
+            delete_pool_row(h, name)
+            h.ports.release(port)
+            h.admission.release(name)
+            keep_ports.discard(port)
+            report["missing"].append(name)
+
+    for name, c in containers.items():
+        if name in owned or name in pool:
+            continue
+        # Containers still being provisioned are not in the tables yet.
+        if time.time() - c.get("Created", 0) < RECONCILE_GRACE:
+            keep_ports.update(p["PublicPort"] for p in c.get("Ports") or [] if p.get("PublicPort"))
+            continue
+        # The listing may predate a pool claim that is now recorded.
+        if container_in_use(h, name):
+            keep_ports.update(p["PublicPort"] for p in c.get("Ports") or [] if p.get("PublicPort"))
+            continue
+        if (c.get("Labels") or {}).get("sqllab.managed") == "1":
+            try:
+                h.client.api.remove_container(name, force=True)
+                report["orphans_removed"].append(name)
+            except Exception as e:
+                report["errors"].append(f"remove {name} on {h.name}: {e}")
+        elif name.startswith("mysql_"):
+            report["unmanaged_orphans"].append(name)
+
+    with pool_claims_lock:
+        keep_ports.update(port for (host, _), port in pool_claims.items() if host == h.name and port)
+    report["ports_reclaimed"] += h.ports.reclaim(keep_ports, older_than=RECONCILE_GRACE)
+
+
+def container_in_use(h: DockerHost, name: str) -> bool:
+    # Claims are checked before the tables: a claim is only dropped after
+    # its user row is written.
+    with pool_claims_lock:
+        if (h.name, name) in pool_claims:
+            return True
+    return bool(
+        db_query("SELECT 1 FROM users WHERE host = ? AND container_name = ?", (h.name, name))
+        or db_query("SELECT 1 FROM warm_pool WHERE host = ? AND container_name = ?", (h.name, name))
+    )
+
+
+def reconcile() -> Dict:
+    with reconcile_lock:
+        started = time.time()
+        report: Dict = {
+            "restarted": [],
+            "missing": [],
+            "orphans_removed": [],
+            "unmanaged_orphans": [],
+            "ports_reclaimed": [],
+            "errors": [],
+        }
+        by_host: Dict[str, Dict[str, Dict]] = {name: {} for name in docker_hosts}
+        for username, u in all_users().items():
+            by_host.setdefault(u.get("host") or DEFAULT_HOST, {})[username] = u
+        for h in live_hosts():
+            try:
+                reconcile_host(h, by_host.get(h.name, {}), report)
+            except Exception as e:
+                report["errors"].append(f"{h.name}: {e}")
+
+        report["finished_at"] = time.time()
+        report["duration_seconds"] = report["finished_at"] - started
+        reconcile_totals["runs"] += 1
+        for key in ("restarted", "missing", "orphans_removed", "ports_reclaimed"):
+            reconcile_totals[key] += len(report[key])
+        if any(report[k] for k in ("restarted", "missing", "orphans_removed", "ports_reclaimed")):
+            logger.info(
+                "Reconciler fixed drift: restarted=%s missing=%s orphans_removed=%s ports_reclaimed=%s",
+                report["restarted"], report["missing"], report["orphans_removed"], report["ports_reclaimed"],
+            )
+        last_reconcile_report.clear()
+        last_reconcile_report.update(report)
+        return report
+
+
+def reconcile_loop() -> None:
+    while not reconcile_stop.wait(timeout=RECONCILE_INTERVAL):
+        try:
+            reconcile()
+        except Exception as e:
+            logger.error("Reconcile run failed: %s", e)
+
+
+# -------------------------------
+# Idle container auto-stop
+# -------------------------------
+# Each sample runs SHOW GLOBAL STATUS inside the container. The sample's own
+# connection shows up in Threads_connected and adds to Questions, so a
+# container is only active if it beats those baselines.
+IDLE_PROBE_SQL = (
+    "SHOW GLOBAL STATUS WHERE Variable_name IN ('Threads_connected', 'Questions')"
+)
+IDLE_PROBE_QUESTIONS = 2
+
+idle_activity: Dict[str, Dict] = {}  # container name -> {"questions", "last_active"}
+idle_stop = threading.Event()
+idle_stats = {"idle_stops": 0, "reclaimed_bytes_total": 0}
+
+
+def sample_mysql_activity(h: DockerHost, name: str) -> Optional[Dict[str, int]]:
+    try:
+        exec_id = h.client.api.exec_create(
+            name,
+            ["mysql", "-uroot", "-N", "-B", "-e", IDLE_PROBE_SQL],
+            environment={"MYSQL_PWD": MYSQL_ROOT_PASSWORD},
+        )["Id"]
+        output = h.client.api.exec_start(exec_id)
+    except Exception as e:
+        logger.debug("Activity sample for %s failed: %s", name, e)
+        return None
+    values = {}
+    for line in output.decode(errors="ignore").splitlines():
+        parts = line.split("\t")
+        if len(parts) == 2 and parts[1].isdigit():
+            values[parts[0]] = int(parts[1])
+    if "Threads_connected" not in values or "Questions" not in values:
+        return None
+    return values
+
+
+def container_memory_bytes(h: DockerHost, name: str) -> int:
+    try:
+        mem = h.client.api.stats(name, stream=False, one_shot=True).get("memory_stats", {})
+    except Exception:
+        return 0
+    # Page cache is reclaimable anyway; report the working set like `docker stats`.
+    return max(mem.get("usage", 0) - mem.get("stats", {}).get("inactive_file", 0), 0)
+
+
+def check_idle(h: DockerHost, username: str, name: str) -> Optional[int]:
+    sample = sample_mysql_activity(h, name)
+    if sample is None:
+        return None
+    now = time.time()
+    prev = idle_activity.get(name)
+    active = (
+        prev is None
+        or sample["Threads_connected"] > 1
+        or not 0 <= sample["Questions"] - prev["questions"] <= IDLE_PROBE_QUESTIONS
+    )
+    last_active = now if active else prev["last_active"]
+    idle_activity[name] = {"questions": sample["Questions"], "last_active": last_active}
+    if now - last_active < IDLE_TIMEOUT:
+        return None
+    reclaimed = container_memory_bytes(h, name)
+    # Recorded before stopping, as admin_stop_user does, so the reconciler
+    # does not restart the container in between.
+    update_user(
+        username,
+        desired_state="stopped",
+        idle_stopped_at=now,
+        idle_reclaimed_bytes=reclaimed,
+    )
+    try:
+        h.client.api.stop(name)
+    except Exception as e:
+        # Still running (or gone): keep it a candidate for the next pass.
+        update_user(username, desired_state="running", idle_stopped_at=None, idle_reclaimed_bytes=None)
+        logger.warning("Stopping idle container %s on %s failed: %s", name, h.name, e)
+        return None
+    h.admission.release(name)
+    idle_activity.pop(name, None)
+    idle_stats["idle_stops"] += 1
+    idle_stats["reclaimed_bytes_total"] += reclaimed
+    logger.info("Stopped idle container %s (%.0f MB)", name, reclaimed / 2**20)
+    return reclaimed
+
+
+def check_idle_quietly(h: DockerHost, username: str, name: str) -> Optional[int]:
+    try:
+        return check_idle(h, username, name)
+    except Exception as e:
+        logger.warning("Idle check for %s on %s failed: %s", name, h.name, e)
+        return None
+
+
+def idle_pass(pool: ThreadPoolExecutor) -> None:
+    candidates = []
+    for username, u in all_users().items():
+        name = u.get("container_name")
+        h = docker_hosts.get(u.get("host") or DEFAULT_HOST)
+        if not name or u.get("desired_state") != "running" or h is None or h.client is None:
+            continue
+        try:
+            state = get_container_state(h, name)
+        except Exception as e:
+            logger.warning("Idle scan could not inspect %s on %s: %s", name, h.name, e)
+            continue
+        if state and state["status"] == "running":
+            candidates.append((h, username, name))
+    list(pool.map(lambda c: check_idle_quietly(*c), candidates))
+    live = {name for _, _, name in candidates}
+    for name in list(idle_activity):
+        if name not in live:
+            idle_activity.pop(name, None)
+
+
+def idle_loop() -> None:
+    with ThreadPoolExecutor(max_workers=IDLE_WORKERS, thread_name_prefix="idle") as pool:
+        while not idle_stop.wait(timeout=IDLE_SAMPLE_INTERVAL):
+            try:
+                idle_pass(pool)
+            except Exception as e:
+                logger.error("Idle pass failed: %s", e)
+
+
+def idle_summary() -> Dict:
+    rows = db_query(
+        "SELECT username, idle_stopped_at, idle_reclaimed_bytes FROM users "
+        "WHERE desired_state = 'stopped' AND idle_stopped_at IS NOT NULL "
+        "ORDER BY idle_stopped_at DESC"
+    )
+    return {
+        "idle_timeout_seconds": IDLE_TIMEOUT,
+        "stopped_containers": len(rows),
+        "memory_reclaimed_bytes": sum(r["idle_reclaimed_bytes"] or 0 for r in rows),
+        **idle_stats,
+        "users": [dict(r) for r in rows],
+    }
+
+
+# -------------------------------
+# On-demand resume
+# -------------------------------
+def ensure_container_running(username: str) -> Dict:
+    u = require_container(username)
+    if u["state"]["status"] == "running":
+        info = connection_info(username, u)
+        return {"host": info["host"], "host_port": info["port"], "resumed": False, "resume_ms": None}
+    # The console, the proxy and /ensure_running/ can all hit a stopped
+    # container at once; they share one start instead of racing on it.
+    return resume_flight.do(username, lambda: resume_container(username))
+
+
+def resume_container(username: str) -> Dict:
+    u = require_container(username)
+    h = host_of(u)
+    info = connection_info(username, u)
+    result = {"host": info["host"], "host_port": info["port"], "resumed": False, "resume_ms": None}
+    if u["state"]["status"] == "running":
+        return result
+    started = time.time()
+    admit_container(h, u["container_name"], u)
+    try:
+        h.client.api.start(u["container_name"])
+    except Exception as e:
+        h.admission.release(u["container_name"])
+        logger.error("Failed to resume container for %s: %s", username, e)
+        raise HTTPException(status_code=500, detail="Failed to resume container")
+    update_user(username, desired_state="running", idle_stopped_at=None, idle_reclaimed_bytes=None)
+    if not wait_for_mysql(*mysql_address(h, u["container_name"], u.get("host_port"))):
+        raise HTTPException(status_code=503, detail="Container resumed but MySQL is not ready yet")
+    result.update(resumed=True, resume_ms=round((time.time() - started) * 1000))
+    logger.info("Resumed container for %s in %d ms", username, result["resume_ms"])
+    return result
+
+
+# -------------------------------
+# MySQL proxy routing
+# -------------------------------
+def proxy_authenticate(username: str) -> Optional[str]:
+    u = get_user(username)
+    if not u or u.get("suspended") or not is_provisioned(u):
+        return None
+    return u.get("mysql_password")
+
+
+def mysql_backend(username: str) -> Tuple[Dict, Dict]:
+    # Where to log in for this user's SQL, resuming a stopped container first.
+    u = get_user(username) or {}
+    if u.get("shared_instance"):
+        inst = shared_instance_of(u)
+        route = {"host": inst.host, "port": inst.port, "user": u["mysql_user"], "password": u["mysql_password"]}
+        return route, {"resumed": False, "resume_ms": None}
+    resume = ensure_container_running(username)
+    u = get_user(username) or {}
+    host, port = mysql_address(host_of(u), u["container_name"], u.get("host_port"))
+    return {"host": host, "port": port, "user": "root", "password": MYSQL_ROOT_PASSWORD}, resume
+
+
+def proxy_route(username: str) -> Dict:
+    try:
+        return mysql_backend(username)[0]
+    except HTTPException as e:
+        raise ProxyError(CR_CONN_HOST_ERROR, f"MySQL server for {username} unavailable: {e.detail}")
+
+
+mysql_proxy = MySQLProxy(
+    proxy_authenticate,
+    proxy_route,
+    port=MYSQL_PROXY_PORT,
+    pool_size=MYSQL_PROXY_POOL_SIZE,
+    pool_idle=MYSQL_PROXY_POOL_IDLE,
+)
+
+
+# -------------------------------
+# SQL execution
+# -------------------------------
+# The console's statements run here, next to the containers, on pooled
+# connections; results stream back in batches instead of every statement
+# paying a client-side TCP + auth handshake across the WAN.
+class SQLConnectionPool:
+    def __init__(self, size: int, idle_seconds: float):
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self._idle: Dict[Tuple, deque] = {}  # route key -> deque of (conn, last_used)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "discarded": 0}
+
+    @staticmethod
+    def key(route: Dict) -> Tuple:
+        return route["host"], route["port"], route["user"]
+
+    def acquire(self, route: Dict):
+        with self._lock:
+            idle = self._idle.get(self.key(route))
+            conn = idle.pop()[0] if idle else None
+        if conn is not None:
+            try:
+                conn.ping(reconnect=False)
+                self._count("hits")
+                return conn
+            except pymysql.MySQLError:
+                self._count("discarded")
+        self._count("misses")
+        with tracing.span("mysql.connect", root=False, host=route["host"], port=route["port"]):
+            return pymysql.connect(
+                host=route["host"],
+                port=route["port"],
+                user=route["user"],
+                password=route["password"],
+                autocommit=True,
+                connect_timeout=5,
+                charset="utf8mb4",
+            )
+
+    def release(self, route: Dict, conn, reusable: bool = True) -> None:
+        if reusable and conn.open:
+            with self._lock:
+                idle = self._idle.setdefault(self.key(route), deque())
+                if len(idle) < self.size:
+                    idle.append((conn, time.time()))
+                    return
+        self._count("discarded")
+        conn.close()
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self.stats[stat] += 1
+
+    def prune(self) -> None:
+        cutoff = time.time() - self.idle_seconds
+        expired = []
+        with self._lock:
+            for idle in self._idle.values():
+                while idle and idle[0][1] < cutoff:
+                    expired.append(idle.popleft()[0])
+        for conn in expired:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def pooled(self) -> int:
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def counters(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+
+sql_pool = SQLConnectionPool(SQL_POOL_SIZE, SQL_POOL_IDLE)
+sql_pool_stop = threading.Event()
+
+
+def sql_pool_loop() -> None:
+    while not sql_pool_stop.wait(timeout=max(SQL_POOL_IDLE / 2, 1)):
+        sql_pool.prune()
+
+
+# Statements in flight, by query id, so they can be cancelled or timed out.
+# MySQL's max_execution_time only covers SELECT; the watchdog issues KILL
+# QUERY for anything else that outlives its deadline.
+running_queries: Dict[str, Dict] = {}
+running_queries_lock = threading.Lock()
+sql_stats = {"cancelled": 0, "timed_out": 0}  # guarded by running_queries_lock
+
+
+def sql_query_stats() -> Dict[str, int]:
+    with running_queries_lock:
+        return dict(sql_stats)
+
+
+def register_query(query_id: str, username: str, route: Dict, conn, timeout: float) -> Dict:
+    q = {
+        "query_id": query_id,
+        "username": username,
+        "route": route,
+        "thread_id": conn.thread_id(),
+        "started": time.time(),
+        "deadline": time.time() + timeout + SQL_KILL_GRACE,
+        "killed": None,
+        "lock": threading.Lock(),
+    }
+    with running_queries_lock:
+        if query_id in running_queries:
+            raise HTTPException(status_code=409, detail=f"Query {query_id} is already running")
+        running_queries[query_id] = q
+    return q
+
+
+def finish_query(q: Dict) -> None:
+    # Taken under the query's lock so a KILL can't land after the
+    # connection has gone back to the pool and started someone else's query.
+    with q["lock"]:
+        q["done"] = True
+        with running_queries_lock:
+            running_queries.pop(q["query_id"], None)
+
+
+def kill_query(q: Dict, reason: str) -> bool:
+    with q["lock"]:
+        if q.get("done") or q["killed"]:
+            return False
+    # Connecting may take up to connect_timeout, so it happens before the
+    # query's lock is taken; only the state check and the KILL itself (one
+    # round trip) are serialised with finish_query.
+    try:
+        conn = sql_pool.acquire(q["route"])
+    except pymysql.MySQLError as e:
+        logger.warning("Cannot kill query %s: %s", q["query_id"], e)
+        return False
+    try:
+        with q["lock"]:
+            if q.get("done") or q["killed"]:
+                return False
+            with conn.cursor() as cur:
+                cur.execute("KILL QUERY %s", (q["thread_id"],))
+            q["killed"] = reason
+    except pymysql.MySQLError as e:
+        logger.warning("KILL QUERY for %s failed: %s", q["query_id"], e)
+        return False
+    finally:
+        sql_pool.release(q["route"], conn)
+    with running_queries_lock:
+        sql_stats["cancelled" if reason == "cancelled" else "timed_out"] += 1
+    logger.info("Killed query %s of %s (%s)", q["query_id"], q["username"], reason)
+    return True
+
+
+def sql_watchdog_loop() -> None:
+    while not sql_pool_stop.wait(timeout=1):
+        now = time.time()
+        with running_queries_lock:
+            overdue = [q for q in running_queries.values() if not q["killed"] and now > q["deadline"]]
+        for q in overdue:
+            kill_query(q, "timeout")
+
+
+def sql_error(e: pymysql.MySQLError, q: Dict) -> Dict:
+    errno = e.args[0]
+    reason = q["killed"] or ("timeout" if errno == ER_QUERY_TIMEOUT else None)
+    return {"errno": errno, "message": str(e.args[-1]), "query_id": q["query_id"], "reason": reason}
+
+
+def json_value(value):
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)  # Decimal, timedelta
+
+
+def ndjson(record: Dict) -> bytes:
+    return (json.dumps(record, default=json_value) + "\n").encode()
+
+
+# Temporal columns go out as ISO strings, like in NDJSON: pymysql hands
+# zero dates ("0000-00-00") back as str, which no Arrow date type accepts.
+ARROW_TYPES = {
+    FIELD_TYPE.TINY: "int64",
+    FIELD_TYPE.SHORT: "int64",
+    FIELD_TYPE.INT24: "int64",
+    FIELD_TYPE.LONG: "int64",
+    FIELD_TYPE.LONGLONG: "int64",
+    FIELD_TYPE.YEAR: "int64",
+    FIELD_TYPE.FLOAT: "float64",
+    FIELD_TYPE.DOUBLE: "float64",
+}
+
+
+def arrow_schema(cursor):
+    # BIGINT UNSIGNED (e.g. SELECT ~0) overflows int64; the flag is only on
+    # the result's field packets, not in the DB-API description.
+    packets = getattr(getattr(cursor, "_result", None), "fields", None) or [None] * len(cursor.description)
+    fields = []
+    for column, packet in zip(cursor.description, packets):
+        kind = ARROW_TYPES.get(column[1], "string")
+        if column[1] == FIELD_TYPE.LONGLONG and packet is not None and packet.flags & FLAG.UNSIGNED:
+            kind = "string"
+        fields.append(pyarrow.field(column[0], getattr(pyarrow, kind)()))
+    return pyarrow.schema(fields)
+
+
+def arrow_batch(schema, rows):
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pyarrow.types.is_string(field.type):
+            values = [None if v is None else json_value(v) if not isinstance(v, str) else v for v in values]
+        try:
+            arrays.append(pyarrow.array(values, type=field.type))
+        except (pyarrow.ArrowException, OverflowError, TypeError, ValueError) as e:
+            raise pyarrow.ArrowInvalid(f"Column {field.name!r} cannot be converted to {field.type}: {e}") from e
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def write_arrow_trailer(writer, schema, summary: Dict) -> None:
+    # The schema goes out before the outcome is known, so a zero-row batch
+    # carries the "done" or "error" record in its custom metadata.
+    empty = pyarrow.RecordBatch.from_arrays([pyarrow.array([], type=f.type) for f in schema], schema=schema)
+    writer.write_batch(empty, custom_metadata={"sqllab": json.dumps(summary, default=str)})
+
+
+def drain(sink: io.BytesIO) -> bytes:
+    chunk = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return chunk
+
+
+def stream_rows(route: Dict, conn, cursor, fmt: str, max_rows: int, header: Dict, q: Dict, parent_span=None):
+    # Each chunk may be produced in a different context, so the fetch span
+    # is detached rather than made current.
+    fetch = tracing.detached_span("mysql.fetch", parent_span, query_id=q["query_id"])
+    started = time.time()
+    rows_sent = bytes_sent = 0
+    truncated = None
+    finished = False
+    sink = io.BytesIO()
+    writer = None
+    try:
+        if fmt == "arrow":
+            schema = arrow_schema(cursor).with_metadata({"sqllab": json.dumps(header)})
+            writer = pyarrow.ipc.new_stream(sink, schema)
+            # Sent on its own so a stream truncated at its first batch is still readable.
+            schema_bytes = drain(sink)
+            bytes_sent += len(schema_bytes)
+            yield schema_bytes
+        else:
+            yield ndjson({"type": "columns", "columns": [d[0] for d in cursor.description], **header})
+        while rows_sent < max_rows:
+            batch = cursor.fetchmany(min(SQL_BATCH_ROWS, max_rows - rows_sent))
+            if not batch:
+                break
+            if fmt == "arrow":
+                writer.write_batch(arrow_batch(schema, batch))
+                chunk = drain(sink)
+            else:
+                chunk = ndjson({"type": "rows", "rows": batch})
+            if bytes_sent + len(chunk) > SQL_MAX_BYTES:
+                truncated = "bytes"
+                break
+            yield chunk
+            rows_sent += len(batch)
+            bytes_sent += len(chunk)
+        else:
+            truncated = "rows" if cursor.fetchone() is not None else None
+        finished = True
+        done = {
+            "type": "done",
+            "row_count": rows_sent,
+            "truncated": truncated,
+            "elapsed_ms": round((time.time() - started) * 1000),
+        }
+        if fmt == "arrow":
+            write_arrow_trailer(writer, schema, done)
+            writer.close()
+            yield drain(sink)
+        else:
+            yield ndjson(done)
+    except ARROW_ERRORS as e:
+        # The connection still has unread rows, so it is released as not
+        # reusable below (finished is False).
+        error = {"type": "error", "errno": None, "message": str(e), "query_id": q["query_id"], "reason": "conversion"}
+        write_arrow_trailer(writer, schema, error)
+        writer.close()
+        yield drain(sink)
+    except pymysql.MySQLError as e:
+        error = {"type": "error", **sql_error(e, q)}
+        if writer is not None:
+            write_arrow_trailer(writer, schema, error)
+            writer.close()
+            yield drain(sink)
+        else:
+            yield ndjson(error)
+    finally:
+        fetch.set(rows=rows_sent, bytes=bytes_sent, truncated=truncated)
+        fetch.finish()
+        finish_query(q)
+        # An unbuffered result that was not read to the end cannot be reused.
+        sql_pool.release(route, conn, reusable=finished and not truncated)
+
+
+# -------------------------------
+# Admin container actions
+# -------------------------------
+# Shared by the single-user admin endpoints and /admin/bulk/{action}/.
+def admin_delete_user(username: str, stop_timeout: int = STOP_TIMEOUT) -> Dict:
+    u = get_user(username)
+    if not u:
+        raise HTTPException(status_code=404, detail="User not found")
+    if u.get("shared_instance"):
+        try:
+            drop_shared_account(shared_instance_of(u), username, u["mysql_user"])
+        except Exception as e:
+            logger.warning("Failed to drop shared database for %s: %s", username, e)
+    h = docker_hosts.get(u.get("host") or DEFAULT_HOST)
+    if u.get("container_name") and h and h.client:
+        try:
+            h.client.api.stop(u["container_name"], timeout=stop_timeout)
+            if LOG_ARCHIVE_INTERVAL > 0:
+                # Last chance to keep the logs, including shutdown
+                archive_container_logs(h, username, u["container_name"])
+                forget_log_cursor(h, u["container_name"])
+            h.client.api.remove_container(u["container_name"])
+        except Exception as e:
+            # Left for the reconciler to garbage-collect
+            logger.warning("Failed to remove container for %s: %s", username, e)
+    remove_user(username)
+    if h:
+        h.ports.release(u.get("host_port"))
+        h.admission.release(u.get("container_name"))
+    return {"message": f"User {username} deleted"}
+
+
+def admin_restart_user(username: str, stop_timeout: int = STOP_TIMEOUT) -> Dict:
+    u = get_user(username)
+    if u and u.get("shared_instance"):
+        with shared_instance_of(u).connect() as conn, conn.cursor() as cur:
+            killed = kill_shared_sessions(cur, u["mysql_user"])
+        return {"message": f"Closed {killed} sessions for {username} on the shared instance"}
+    u = require_container(username)
+    h = host_of(u)
+    admit_container(h, u["container_name"], u, timeout=0)
+    h.client.api.restart(u["container_name"], timeout=stop_timeout)
+    update_user(username, desired_state="running", idle_stopped_at=None, idle_reclaimed_bytes=None)
+    return {"message": f"Container for {username} restarted"}
+
+
+def admin_start_user(username: str, stop_timeout: int = STOP_TIMEOUT) -> Dict:
+    u = get_user(username)
+    if not u:
+        raise HTTPException(status_code=404, detail="User not found")
+    if not is_provisioned(u):
+        job = enqueue_provision(username)
+        return {"message": f"Container provisioning queued for {username}", "job_id": job["job_id"]}
+    if u.get("shared_instance"):
+        set_shared_account_locked(u, False)
+        update_user(username, desired_state="running")
+        return {"message": f"Account for {username} unlocked"}
+    u = require_container(username)
+    update_user(username, desired_state="running", idle_stopped_at=None, idle_reclaimed_bytes=None)
+    if u["state"]["status"] == "running":
+        return {"message": f"Container for {username} already running"}
+    h = host_of(u)
+    admit_container(h, u["container_name"], u, timeout=0)
+    h.client.api.start(u["container_name"])
+    return {"message": f"Container for {username} started"}
+
+
+def admin_stop_user(username: str, stop_timeout: int = STOP_TIMEOUT) -> Dict:
+    u = get_user(username)
+    if u and u.get("shared_instance"):
+        set_shared_account_locked(u, True)
+        update_user(username, desired_state="stopped")
+        return {"message": f"Account for {username} locked"}
+    u = require_container(username)
+    update_user(username, desired_state="stopped", idle_stopped_at=None, idle_reclaimed_bytes=None)
+    h = host_of(u)
+    h.admission.release(u["container_name"])
+    if u["state"]["status"] in ("exited", "created"):
+        return {"message": f"Container for {username} already stopped"}
+    h.client.api.stop(u["container_name"], timeout=stop_timeout)
+    return {"message": f"Container for {username} stopped"}
+
+
+def admin_suspend_user(username: str, stop_timeout: int = STOP_TIMEOUT) -> Dict:
+    u = get_user(username)
+    if not u:
+        raise HTTPException(status_code=404, detail="User not found")
+    update_user(username, suspended=True)
+    return {"message": f"User {username} suspended"}
+
+
+def admin_unsuspend_user(username: str, stop_timeout: int = STOP_TIMEOUT) -> Dict:
+    u = get_user(username)
+    if not u:
+        raise HTTPException(status_code=404, detail="User not found")
+    update_user(username, suspended=False)
+    return {"message": f"User {username} unsuspended"}
+
+
+ADMIN_USER_ACTIONS: Dict[str, Callable[..., Dict]] = {
+    "start": admin_start_user,
+    "stop": admin_stop_user,
+    "restart": admin_restart_user,
+    "suspend": admin_suspend_user,
+    "unsuspend": admin_unsuspend_user,
+    "delete": admin_delete_user,
+}
+
+
+def filter_usernames(f: "BulkFilterModel") -> List[str]:
+    matched = []
+    for username, u in all_users().items():
+        if u.get("is_admin") or not username.startswith(f.prefix or ""):
+            continue
+        if f.suspended is not None and bool(u.get("suspended")) != f.suspended:
+            continue
+        if f.has_container is not None and is_provisioned(u) != f.has_container:
+            continue
+        if f.desired_state is not None and (u.get("desired_state") or "running") != f.desired_state:
+            continue
+        if f.host is not None and u.get("host") != f.host:
+            continue
+        if f.mode is not None and user_mode(u) != f.mode:
+            continue
+        matched.append(username)
+    return matched
+
+
+def run_bulk_action(action: str, usernames: List[str], stop_timeout: int, max_workers: int) -> List[Dict]:
+    fn = ADMIN_USER_ACTIONS[action]
+
+    def run_one(username: str) -> Dict:
+        started = time.time()
+        result = {"username": username, "ok": True}
+        try:
+            result.update(fn(username, stop_timeout))
+        except HTTPException as e:
+            result.update(ok=False, status_code=e.status_code, error=e.detail)
+        except Exception as e:
+            logger.error("Bulk %s for %s failed: %s", action, username, e)
+            result.update(ok=False, status_code=500, error=str(e))
+        result["elapsed_ms"] = round((time.time() - started) * 1000)
+        return result
+
+    if not usernames:
+        return []
+    workers = max(1, min(max_workers, BULK_WORKERS, len(usernames)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"bulk-{action}") as pool:
+        return list(pool.map(run_one, usernames))
+
+
+# -------------------------------
+# Admin user listings
+# -------------------------------
+# Keyset pages in username order; a page's cursor is the last username of
+# the previous one. ETags are derived from users_version and the container
+# state cache versions alone, so an unchanged listing is answered with 304
+# before the table is read.
+LISTING_EPOCH = uuid.uuid4().hex  # ETags from an earlier process never match
+LISTING_FIELDS = [col for col in USER_COLUMNS if col not in SECRET_COLUMNS] + ["container_status"]
+
+
+def listing_fields(fields: Optional[str]) -> List[str]:
+    if not fields:
+        return list(LISTING_FIELDS)
+    selected = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in selected if f not in LISTING_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields {', '.join(unknown)}; choose from {', '.join(LISTING_FIELDS)}",
+        )
+    return selected
+
+
+def query_user_page(f: "UserListFilter") -> Tuple[List[sqlite3.Row], Optional[str]]:
+    where, params = ["username > ?"], [f.cursor or ""]
+    if f.prefix:
+        where.append("username >= ? AND username < ?")
+        params += [f.prefix, f.prefix + "\U0010ffff"]
+    if f.suspended is not None:
+        where.append("suspended = ?")
+        params.append(int(f.suspended))
+    if f.has_container is not None:
+        provisioned = "(COALESCE(container_name, '') != '' OR COALESCE(shared_instance, '') != '')"
+        where.append(provisioned if f.has_container else f"NOT {provisioned}")
+    if f.port_min is not None:
+        where.append("host_port >= ?")
+        params.append(f.port_min)
+    if f.port_max is not None:
+        where.append("host_port <= ?")
+        params.append(f.port_max)
+    limit = max(1, min(f.limit or USER_LIST_PAGE_SIZE, USER_LIST_MAX_PAGE_SIZE))
+    rows = db_query(
+        f"SELECT * FROM users WHERE {' AND '.join(where)} ORDER BY username LIMIT ?",
+        [*params, limit + 1],
+    )
+    next_cursor = rows[limit - 1]["username"] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def listing_etag(kind: str, f: "UserListFilter", fields: List[str]) -> Optional[str]:
+    # Read before the query: a write in between only makes the tag stale,
+    # which costs the client one extra full response.
+    parts = [LISTING_EPOCH, users_version, kind, vars(f), fields]
+    if "container_status" in fields:
+        hosts = [h for h in docker_hosts.values() if h.client]
+        if not all(h.states_ready.is_set() for h in hosts):
+            return None  # statuses would come from unversioned inspect calls
+        parts.append([(h.name, h.states_version) for h in hosts])
+    return '"' + hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest() + '"'
+
+
+def not_modified(request: Request, etag: Optional[str]) -> Optional[Response]:
+    header = request.headers.get("if-none-match")
+    if not etag or not header:
+        return None
+    tags = {t.strip().removeprefix("W/") for t in header.split(",")}
+    if "*" in tags or etag in tags:
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def listing_container_status(u: Dict) -> Optional[str]:
+    if u.get("shared_instance"):
+        return f"shared:{u['shared_instance']}"
+    h = docker_hosts.get(u.get("host") or DEFAULT_HOST)
+    state = None
+    if h and h.client and u.get("container_name"):
+        state = get_container_state(h, u["container_name"])
+    return state["status"] if state else None
+
+
+# -------------------------------
+# Container logs
+# -------------------------------
+# Docker prefixes each line with an RFC 3339 timestamp (nanoseconds, trailing
+# zeros trimmed). That timestamp is the cursor: a client resumes with
+# cursor=<last ts> and gets only later lines. Lines are read from the
+# Docker stream as they arrive; only tail-before-until paging buffers, and
+# then at most `tail` lines.
+LOG_TS_RE = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?Z$")
+# Follow mode reads in windows this long (seconds). A window with no lines
+# still yields a heartbeat, so the worker thread gets back to Starlette,
+# which notices a disconnected client, instead of blocking on a quiet log.
+LOG_FOLLOW_WINDOW = 5
+
+
+def log_ts_ns(ts: str) -> Optional[int]:
+    m = LOG_TS_RE.match(ts)
+    if not m:
+        return None
+    seconds = calendar.timegm(time.strptime(m.group(1), "%Y-%m-%dT%H:%M:%S"))
+    return seconds * 10**9 + int((m.group(2) or "0")[:9].ljust(9, "0"))
+
+
+def parse_log_time(value: Optional[str]) -> Optional[int]:
+    # Unix seconds or an RFC 3339 UTC timestamp, as nanoseconds.
+    if value is None:
+        return None
+    try:
+        return int(float(value) * 10**9)
+    except ValueError:
+        pass
+    ns = log_ts_ns(value)
+    if ns is None:
+        raise HTTPException(status_code=400, detail=f"Bad timestamp {value!r}; use unix seconds or RFC 3339 UTC")
+    return ns
+
+
+def iter_container_logs(
+    h: DockerHost,
+    name: str,
+    since_ns: Optional[int] = None,
+    until_ns: Optional[int] = None,
+    tail: Optional[int] = None,
+    follow: bool = False,
+):
+    # Yields (ts, line), and None after each idle follow window.
+    started_ns = time.time_ns()
+    after_ns = max(since_ns or 0, started_ns)
+    for ts, line in read_container_logs(h, name, since_ns, until_ns, tail):
+        after_ns = max(after_ns, (log_ts_ns(ts) or 0) + 1)
+        yield ts, line
+    while follow and (until_ns is None or after_ns < until_ns):
+        try:
+            state = get_container_state(h, name)
+        except Exception as e:
+            logger.warning("Log follow for %s on %s stopped: %s", name, h.name, e)
+            return
+        if not state or state["status"] != "running":
+            return
+        window_end = time.time_ns() + LOG_FOLLOW_WINDOW * 10**9
+        if until_ns:
+            window_end = min(window_end, until_ns)
+        for ts, line in read_container_logs(h, name, after_ns, window_end, None, follow=True):
+            after_ns = max(after_ns, (log_ts_ns(ts) or 0) + 1)
+            yield ts, line
+        after_ns = max(after_ns, window_end)
+        yield None
+
+
+def read_container_logs(
+    h: DockerHost,
+    name: str,
+    since_ns: Optional[int] = None,
+    until_ns: Optional[int] = None,
+    tail: Optional[int] = None,
+    follow: bool = False,
+):
+    # Docker gets whole-second bounds; the exact window (since inclusive,
+    # until exclusive) is applied per line.
+    kwargs = {"stream": True, "timestamps": True, "follow": follow}
+    if since_ns:
+        kwargs["since"] = since_ns // 10**9
+    if until_ns:
+        kwargs["until"] = -(-until_ns // 10**9)
+    # With until, "the last N lines" means before until, so tail is applied
+    # here; without it Docker can seek to the end of the log itself.
+    ring = deque(maxlen=tail) if tail is not None and until_ns else None
+    if tail is not None and ring is None:
+        kwargs["tail"] = tail
+    stream = h.client.api.logs(name, **kwargs)
+    pending = b""
+    try:
+        for chunk in stream:
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for raw in lines:
+                ts, _, line = raw.decode(errors="replace").partition(" ")
+                ns = log_ts_ns(ts) or 0
+                if (since_ns and ns < since_ns) or (until_ns and ns >= until_ns):
+                    continue
+                if ring is not None:
+                    ring.append((ts, line))
+                else:
+                    yield ts, line
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
+    if ring is not None:
+        yield from ring
+
+
+def format_log_records(records, fmt: str):
+    for record in records:
+        if record is None:
+            yield b": keepalive\n\n" if fmt == "sse" else b""
+            continue
+        ts, line = record
+        if fmt == "sse":
+            # The id doubles as the cursor, so EventSource resumes on its own.
+            yield f"id: {ts}\ndata: {line}\n\n".encode()
+        else:
+            yield (json.dumps({"ts": ts, "line": line}) + "\n").encode()
+
+
+# -------------------------------
+# Log archive
+# -------------------------------
+# Each collection pass appends new lines per container as one gzip member
+# to the current archive file (so the files still read with zcat) and
+# records the member's offset, user, time range and severity counts in
+# log_chunks. Searches use the index to pick chunks and only decompress
+# those. Files rotate by size and day and are removed after retention.
+LOG_SEVERITY_RE = re.compile(r"\[(ERROR|Warning|Note|System)\]")
+LOG_SEVERITIES = {"ERROR": "error", "Warning": "warning"}
+
+log_archive_lock = threading.Lock()
+log_archive_stop = threading.Event()
+log_archive_state = {"file": None, "day": None}
+log_archive_stats = {"passes": 0, "chunks": 0, "lines": 0, "bytes": 0, "last_pass_seconds": None}
+
+
+def init_log_archive_db() -> None:
+    db_execute(
+        "CREATE TABLE IF NOT EXISTS log_chunks ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "file TEXT NOT NULL, "
+        "offset INTEGER NOT NULL, "
+        "length INTEGER NOT NULL, "
+        "host TEXT NOT NULL, "
+        "container_name TEXT NOT NULL, "
+        "username TEXT NOT NULL, "
+        "first_ns INTEGER NOT NULL, "
+        "last_ns INTEGER NOT NULL, "
+        "lines INTEGER NOT NULL, "
+        "errors INTEGER NOT NULL, "
+        "warnings INTEGER NOT NULL)"
+    )
+    db_execute("CREATE INDEX IF NOT EXISTS idx_log_chunks_user ON log_chunks(username, last_ns)")
+    db_execute("CREATE INDEX IF NOT EXISTS idx_log_chunks_time ON log_chunks(last_ns)")
+    db_execute(
+        "CREATE TABLE IF NOT EXISTS log_cursors ("
+        "host TEXT NOT NULL, "
+        "container_name TEXT NOT NULL, "
+        "last_ns INTEGER NOT NULL, "
+        "PRIMARY KEY (host, container_name))"
+    )
+
+
+def log_severity(line: str) -> str:
+    m = LOG_SEVERITY_RE.search(line)
+    return LOG_SEVERITIES.get(m.group(1), "info") if m else "info"
+
+
+def archive_file_for(size: int) -> Path:
+    # Caller holds log_archive_lock.
+    day = time.strftime("%Y%m%d", time.gmtime())
+    current = log_archive_state["file"]
+    if (
+        current is None
+        or log_archive_state["day"] != day
+        or (current.exists() and current.stat().st_size + size > LOG_ARCHIVE_FILE_MB * 2**20)
+    ):
+        LOG_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+        current = LOG_ARCHIVE_DIR / f"logs-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:6]}.gz"
+        log_archive_state.update(file=current, day=day)
+    return current
+
+
+def write_log_chunk(h: DockerHost, name: str, username: str, records: List[Tuple[int, str]]) -> None:
+    payload = "".join(f"{line}\n" for _, line in records).encode()
+    data = gzip.compress(payload)
+    severities = [log_severity(line) for _, line in records]
+    with log_archive_lock:
+        path = archive_file_for(len(data))
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        db_execute(
+            "INSERT INTO log_chunks (file, offset, length, host, container_name, username, first_ns, "
+            "last_ns, lines, errors, warnings) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                path.name,
+                offset,
+                len(data),
+                h.name,
+                name,
+                username,
+                records[0][0],
+                records[-1][0],
+                len(records),
+                severities.count("error"),
+                severities.count("warning"),
+            ),
+        )
+        db_execute(
+            "INSERT OR REPLACE INTO log_cursors (host, container_name, last_ns) VALUES (?, ?, ?)",
+            (h.name, name, records[-1][0]),
+        )
+        log_archive_stats["chunks"] += 1
+        log_archive_stats["lines"] += len(records)
+        log_archive_stats["bytes"] += len(data)
+
+
+def archive_container_logs(h: DockerHost, username: str, name: str) -> int:
+    # Copies lines newer than the container's cursor; returns how many.
+    rows = db_query("SELECT last_ns FROM log_cursors WHERE host = ? AND container_name = ?", (h.name, name))
+    since_ns = rows[0]["last_ns"] + 1 if rows else None
+    records: List[Tuple[int, str]] = []
+    size = copied = 0
+    try:
+        for ts, line in iter_container_logs(h, name, since_ns=since_ns):
+            ns = log_ts_ns(ts)
+            if ns is None:
+                continue
+            records.append((ns, f"{ts} {line}"))
+            size += len(line) + 32
+            if size >= LOG_ARCHIVE_CHUNK_BYTES:
+                write_log_chunk(h, name, username, records)
+                copied += len(records)
+                records, size = [], 0
+    except Exception as e:
+        logger.warning("Log archive read for %s on %s failed: %s", name, h.name, e)
+    if records:
+        write_log_chunk(h, name, username, records)
+        copied += len(records)
+    return copied
+
+
+def forget_log_cursor(h: DockerHost, name: str) -> None:
+    db_execute("DELETE FROM log_cursors WHERE host = ? AND container_name = ?", (h.name, name))
+
+
+def prune_log_archive() -> None:
+    cutoff_ns = int((time.time() - LOG_ARCHIVE_RETENTION_DAYS * 86400) * 10**9)
+    with log_archive_lock:
+        current = log_archive_state["file"]
+        expired = [
+            r["file"]
+            for r in db_query("SELECT file, MAX(last_ns) AS newest FROM log_chunks GROUP BY file")
+            if r["newest"] < cutoff_ns and (current is None or r["file"] != current.name)
+        ]
+        for name in expired:
+            (LOG_ARCHIVE_DIR / name).unlink(missing_ok=True)
+            db_execute("DELETE FROM log_chunks WHERE file = ?", (name,))
+    if expired:
+        logger.info("Removed %d expired log archive files", len(expired))
+
+
+def log_archive_loop() -> None:
+    with ThreadPoolExecutor(max_workers=IDLE_WORKERS, thread_name_prefix="log-archive") as pool:
+        while not log_archive_stop.wait(timeout=LOG_ARCHIVE_INTERVAL):
+            started = time.time()
+            try:
+                targets = []
+                for username, u in all_users().items():
+                    h = docker_hosts.get(u.get("host") or DEFAULT_HOST)
+                    if not (u.get("container_name") and h and h.client):
+                        continue
+                    try:
+                        if get_container_state(h, u["container_name"]):
+                            targets.append((h, username, u["container_name"]))
+                    except Exception as e:
+                        logger.warning("Log archive skipped %s on %s: %s", u["container_name"], h.name, e)
+                list(pool.map(lambda t: archive_container_logs(*t), targets))
+                prune_log_archive()
+            except Exception as e:
+                logger.error("Log archive pass failed: %s", e)
+            log_archive_stats["passes"] += 1
+            log_archive_stats["last_pass_seconds"] = round(time.time() - started, 3)
+
+
+def read_log_chunk(chunk: Dict) -> List[str]:
+    with open(LOG_ARCHIVE_DIR / chunk["file"], "rb") as f:
+        f.seek(chunk["offset"])
+        return gzip.decompress(f.read(chunk["length"])).decode(errors="replace").splitlines()
+
+
+def search_log_archive(
+    username: Optional[str],
+    since_ns: Optional[int],
+    until_ns: Optional[int],
+    severity: Optional[str],
+    text: Optional[str],
+    limit: int,
+    after: Tuple[int, int] = (0, -1),
+) -> Tuple[List[Dict], Optional[str]]:
+    # Matches come in archive order (chunk id, line within chunk), and the
+    # cursor is that position: chunks of different containers overlap in
+    # time, so a timestamp cursor would skip other users' earlier lines.
+    where, params = ["1 = 1"], []
+    if username:
+        where.append("username = ?")
+        params.append(username)
+    if since_ns:
+        where.append("last_ns >= ?")
+        params.append(since_ns)
+    if until_ns:
+        where.append("first_ns < ?")
+        params.append(until_ns)
+    if severity == "error":
+        where.append("errors > 0")
+    elif severity == "warning":
+        where.append("(errors > 0 OR warnings > 0)")
+    matches: List[Dict] = []
+    last_id = after[0] - 1
+    while True:
+        # Chunks are read a page at a time so a broad search stops early.
+        chunks = db_query(
+            f"SELECT * FROM log_chunks WHERE {' AND '.join(where)} AND id > ? ORDER BY id LIMIT 50",
+            (*params, last_id),
+        )
+        if not chunks:
+            return matches, None
+        for chunk in chunks:
+            last_id = chunk["id"]
+            try:
+                lines = read_log_chunk(dict(chunk))
+            except FileNotFoundError:
+                continue  # pruned after the index query; its rows are gone too
+            for index, line in enumerate(lines):
+                if chunk["id"] == after[0] and index <= after[1]:
+                    continue
+                ts, _, message = line.partition(" ")
+                ns = log_ts_ns(ts) or 0
+                if (since_ns and ns < since_ns) or (until_ns and ns >= until_ns):
+                    continue
+                level = log_severity(message)
+                if severity == "error" and level != "error":
+                    continue
+                if severity == "warning" and level not in ("error", "warning"):
+                    continue
+                if text and text not in message:
+                    continue
+                matches.append({"username": chunk["username"], "ts": ts, "severity": level, "line": message})
+                if len(matches) >= limit:
+                    return matches, f"{chunk['id']}:{index}"
+
+
+# -------------------------------
+# Resource sampler
+# -------------------------------
+# One one-shot `docker stats` call per running user container per interval,
+# kept in a fixed-size deque per container. CPU% and the I/O rates are
+# deltas against the previous sample, so the raw counters are kept too.
+STATS_FIELDS = ("cpu_percent", "mem_bytes", "blk_read_bps", "blk_write_bps", "net_rx_bps", "net_tx_bps")
+
+container_samples: Dict[Tuple[str, str], deque] = {}  # (host, container) -> samples
+container_samples_lock = threading.Lock()
+stats_stop = threading.Event()
+stats_sampler_state = {"sampled_at": None, "last_pass_seconds": None, "errors": 0}
+
+
+def read_container_stats(h: DockerHost, name: str) -> Dict:
+    raw = h.client.api.stats(name, stream=False, one_shot=True)
+    cpu = raw.get("cpu_stats", {})
+    mem = raw.get("memory_stats", {})
+    blk = {"read": 0, "write": 0}
+    for entry in (raw.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []:
+        op = entry.get("op", "").lower()
+        if op in blk:
+            blk[op] += entry.get("value", 0)
+    networks = (raw.get("networks") or {}).values()
+    return {
+        "t": time.time(),
+        "cpu_total": cpu.get("cpu_usage", {}).get("total_usage", 0),
+        "system_total": cpu.get("system_cpu_usage", 0),
+        "online_cpus": cpu.get("online_cpus") or 1,
+        "mem_bytes": max(mem.get("usage", 0) - mem.get("stats", {}).get("inactive_file", 0), 0),
+        "mem_limit": mem.get("limit", 0),
+        "blk_read": blk["read"],
+        "blk_write": blk["write"],
+        "net_rx": sum(n.get("rx_bytes", 0) for n in networks),
+        "net_tx": sum(n.get("tx_bytes", 0) for n in networks),
+    }
+
+
+def derive_sample(raw: Dict, prev: Optional[Dict]) -> Dict:
+    sample = {**raw, "cpu_percent": None, "blk_read_bps": None, "blk_write_bps": None,
+              "net_rx_bps": None, "net_tx_bps": None}
+    if prev is None:
+        return sample
+    dt = raw["t"] - prev["t"]
+    dsys = raw["system_total"] - prev["system_total"]
+    dcpu = raw["cpu_total"] - prev["cpu_total"]
+    if dsys > 0 and dcpu >= 0:
+        sample["cpu_percent"] = round(dcpu / dsys * raw["online_cpus"] * 100, 2)
+    if dt > 0:
+        for field, counter in (
+            ("blk_read_bps", "blk_read"),
+            ("blk_write_bps", "blk_write"),
+            ("net_rx_bps", "net_rx"),
+            ("net_tx_bps", "net_tx"),
+        ):
+            delta = raw[counter] - prev[counter]
+            # Counters reset when a container restarts
+            sample[field] = round(delta / dt) if delta >= 0 else None
+    return sample
+
+
+def sample_container(h: DockerHost, name: str) -> None:
+    try:
+        raw = read_container_stats(h, name)
+    except Exception as e:
+        stats_sampler_state["errors"] += 1
+        logger.debug("Stats sample for %s on %s failed: %s", name, h.name, e)
+        return
+    key = (h.name, name)
+    with container_samples_lock:
+        samples = container_samples.setdefault(key, deque(maxlen=STATS_HISTORY))
+        samples.append(derive_sample(raw, samples[-1] if samples else None))
+
+
+def stats_pass(pool: ThreadPoolExecutor) -> None:
+    started = time.time()
+    targets = []
+    unreachable = set()  # keep their history; they may be back next pass
+    for u in all_users().values():
+        h = docker_hosts.get(u.get("host") or DEFAULT_HOST)
+        name = u.get("container_name")
+        if not name or h is None or h.client is None:
+            continue
+        try:
+            state = get_container_state(h, name)
+        except Exception as e:
+            stats_sampler_state["errors"] += 1
+            logger.warning("Stats sampler could not inspect %s on %s: %s", name, h.name, e)
+            unreachable.add((h.name, name))
+            continue
+        if state and state["status"] == "running":
+            targets.append((h, name))
+    list(pool.map(lambda t: sample_container(*t), targets))
+    live = {(h.name, name) for h, name in targets} | unreachable
+    with container_samples_lock:
+        for key in [k for k in container_samples if k not in live]:
+            del container_samples[key]
+    stats_sampler_state.update(
+        sampled_at=started, last_pass_seconds=round(time.time() - started, 3)
+    )
+
+
+def stats_loop() -> None:
+    with ThreadPoolExecutor(max_workers=IDLE_WORKERS, thread_name_prefix="stats") as pool:
+        while not stats_stop.wait(timeout=STATS_INTERVAL):
+            try:
+                stats_pass(pool)
+            except Exception as e:
+                logger.error("Stats pass failed: %s", e)
+
+
 # -------------------------------
 # Models
 # -------------------------------
@@ -153,22 +2966,212 @@ class UserActionModel(BaseModel):
     username: str
 
 
+class BulkFilterModel(BaseModel):
+    prefix: Optional[str] = None
+    suspended: Optional[bool] = None
+    has_container: Optional[bool] = None
+    desired_state: Optional[str] = None  # "running" or "stopped"
+    host: Optional[str] = None
+    mode: Optional[str] = None
+
+
+class UserListFilter(BaseModel):
+    prefix: Optional[str] = None
+    suspended: Optional[bool] = None
+    has_container: Optional[bool] = None
+    port_min: Optional[int] = None
+    port_max: Optional[int] = None
+    cursor: Optional[str] = None  # next_cursor of the previous page
+    limit: Optional[int] = None
+
+
+class BulkActionModel(BaseModel):
+    usernames: Optional[List[str]] = None
+    filter: Optional[BulkFilterModel] = None
+    stop_timeout: Optional[conint(ge=0, le=600)] = None  # seconds Docker waits before SIGKILL
+    max_workers: Optional[conint(ge=1, le=BULK_WORKERS)] = None
+
+
+class SQLModel(BaseModel):
+    sql: str
+    database: Optional[str] = None
+    format: str = "ndjson"  # or "arrow"
+    max_rows: Optional[int] = None
+    query_id: Optional[str] = None  # chosen by the client so it can cancel before results arrive
+    timeout: Optional[float] = None
+
+
+class CancelModel(BaseModel):
+    query_id: str
+
+
+class ModeModel(BaseModel):
+    username: str
+    mode: str
+
+
+class TierModel(BaseModel):
+    username: str
+    tier: Optional[str] = None
+    mem_limit_mb: Optional[int] = None
+    cpus: Optional[float] = None
+    pids_limit: Optional[int] = None
+
+
+# -------------------------------
+# Scrape-time metrics and middleware
+# -------------------------------
+def collect_container_states():
+    for h in docker_hosts.values():
+        counts: Dict[str, int] = {}
+        with h.states_lock:
+            for state in h.container_states.values():
+                counts[state["status"]] = counts.get(state["status"], 0) + 1
+        for status, n in counts.items():
+            yield {"host": h.name, "state": status}, n
+
+
+def collect_ports():
+    for h in docker_hosts.values():
+        ports = h.ports.stats()
+        yield {"host": h.name, "state": "used"}, ports["used"]
+        yield {"host": h.name, "state": "free"}, ports["free"]
+
+
+def collect_memory():
+    for h in docker_hosts.values():
+        memory = h.admission.stats()
+        yield {"host": h.name, "kind": "budget"}, memory["budget_mb"]
+        yield {"host": h.name, "kind": "committed"}, memory["committed_mb"]
+
+
+def collect_active_jobs():
+    rows = db_query(
+        f"SELECT COUNT(*) AS n FROM jobs WHERE status IN ({', '.join('?' for _ in JOB_ACTIVE_STATES)})",
+        JOB_ACTIVE_STATES,
+    )
+    yield {}, rows[0]["n"]
+
+
+metrics.Gauge("sqllab_containers", "Managed containers by state", ("host", "state"), collect=collect_container_states)
+metrics.Gauge("sqllab_ports", "Host port pool", ("host", "state"), collect=collect_ports)
+metrics.Gauge("sqllab_memory_mb", "Admission memory budget and commitment", ("host", "kind"), collect=collect_memory)
+metrics.Gauge(
+    "sqllab_warm_pool_containers",
+    "Unassigned warm pool containers",
+    ("host",),
+    collect=lambda: [({"host": h.name}, warm_pool_size(h)) for h in docker_hosts.values()],
+)
+metrics.Gauge("sqllab_provision_jobs_active", "Queued or running provisioning jobs", collect=collect_active_jobs)
+metrics.Gauge("sqllab_sql_queries_running", "Statements in flight on /sql/execute/", collect=lambda: [({}, len(running_queries))])
+metrics.Gauge("sqllab_sql_pool_connections", "Idle pooled SQL connections", collect=lambda: [({}, sql_pool.pooled())])
+metrics.Gauge("sqllab_users", "Registered users", collect=lambda: [({}, db_query("SELECT COUNT(*) AS n FROM users")[0]["n"])])
+
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    with tracing.span(
+        f"{request.method} {request.url.path}", traceparent=request.headers.get("traceparent")
+    ) as s:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        if route:
+            s.rename(f"{request.method} {route.path}")
+        s.set(status=response.status_code)
+        return response
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    http_in_flight.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        http_in_flight.dec()
+        # The route template keeps label cardinality bounded (/jobs/{job_id}/).
+        route = request.scope.get("route")
+        path = route.path if route else "unmatched"
+        http_requests.inc(method=request.method, route=path, status=str(status))
+        http_latency.observe(time.perf_counter() - started, method=request.method, route=path)
+
+
 # -------------------------------
 # Startup
 # -------------------------------
 @app.on_event("startup")
 def startup() -> None:
     load_users_db()
-    if ADMIN_USERNAME not in users_db:
-        users_db[ADMIN_USERNAME] = {
-            "password_hash": hash_password(ADMIN_PASSWORD),
-            "is_admin": True,
-            "container_name": None,
-            "host_port": None,
-            "suspended": False,
-        }
-        save_users_db()
-    logger.info("Loaded users: %s", list(users_db.keys()))
+    init_jobs_db()
+    init_warm_pool_db()
+    init_timings_db()
+    init_log_archive_db()
+    init_port_allocators()
+    init_admission()
+    if not user_exists(ADMIN_USERNAME):
+        insert_user(
+            ADMIN_USERNAME,
+            password_hash=hash_password(ADMIN_PASSWORD),
+            is_admin=True,
+            container_name=None,
+            host_port=None,
+            suspended=False,
+        )
+    logger.info("Loaded users DB from %s", DB_FILE)
+    resume_provision_jobs()
+    for h in live_hosts():
+        try:
+            ensure_network(h)
+        except Exception as e:
+            logger.error("Failed to create network %s on %s: %s", MYSQL_NETWORK, h.name, e)
+        threading.Thread(
+            target=container_events_loop, args=(h,), name=f"docker-events-{h.name}", daemon=True
+        ).start()
+        if MYSQL_PREINIT:
+            threading.Thread(
+                target=ensure_mysql_image, args=(h,), name=f"mysql-image-{h.name}", daemon=True
+            ).start()
+        if WARM_POOL_SIZE > 0:
+            threading.Thread(
+                target=warm_pool_loop, args=(h,), name=f"warm-pool-{h.name}", daemon=True
+            ).start()
+    if live_hosts() and RECONCILE_INTERVAL > 0:
+        threading.Thread(target=reconcile_loop, name="reconciler", daemon=True).start()
+    if live_hosts() and IDLE_TIMEOUT > 0:
+        threading.Thread(target=idle_loop, name="idle-detector", daemon=True).start()
+    if live_hosts() and STATS_INTERVAL > 0:
+        threading.Thread(target=stats_loop, name="stats-sampler", daemon=True).start()
+    if live_hosts() and LOG_ARCHIVE_INTERVAL > 0:
+        threading.Thread(target=log_archive_loop, name="log-archive", daemon=True).start()
+    if MYSQL_PROXY_PORT:
+        threading.Thread(target=mysql_proxy.run, name="mysql-proxy", daemon=True).start()
+    threading.Thread(target=sql_pool_loop, name="sql-pool", daemon=True).start()
+    threading.Thread(target=sql_watchdog_loop, name="sql-watchdog", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def shutdown() -> None:
+    container_events_stop.set()
+    reconcile_stop.set()
+    idle_stop.set()
+    log_archive_stop.set()
+    stats_stop.set()
+    mysql_proxy.stop()
+    sql_pool_stop.set()
+    warm_pool_stop.set()
+    for h in docker_hosts.values():
+        h.warm_pool_wakeup.set()
+    provision_executor.shutdown(wait=False)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 # -------------------------------
@@ -176,22 +3179,24 @@ def startup() -> None:
 # -------------------------------
 @app.post("/auth/register/")
 def register_user(auth: AuthModel):
-    if auth.username in users_db:
+    enforce_rate_limit("auth", auth.username)
+    created = insert_user(
+        auth.username,
+        password_hash=hash_password(auth.password),
+        is_admin=False,
+        container_name=None,
+        host_port=None,
+        suspended=False,
+    )
+    if not created:
         raise HTTPException(status_code=400, detail="Username already exists")
-    users_db[auth.username] = {
-        "password_hash": hash_password(auth.password),
-        "is_admin": False,
-        "container_name": None,
-        "host_port": None,
-        "suspended": False,
-    }
-    save_users_db()
     return {"message": f"User {auth.username} registered successfully"}
 
 
 @app.post("/auth/login/")
 def login_user(auth: AuthModel):
-    user = users_db.get(auth.username)
+    enforce_rate_limit("auth", auth.username)
+    user = get_user(auth.username)
     if not user or not verify_password(auth.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     return {"token": auth.username}
@@ -200,117 +3205,541 @@ def login_user(auth: AuthModel):
 # -------------------------------
 # User endpoint
 # -------------------------------
-@app.post("/register_user/")
+@app.post("/register_user/", dependencies=[Depends(rate_limit("provision"))])
 def create_user_container(user: Dict = Depends(require_auth)):
     username = user["username"]
+    if user.get("shared_instance"):
+        info = connection_info(username, user)
+        return {
+            "message": f"MySQL database {username} ready on port {info['port']}",
+            "status": "running",
+            "host_port": info["port"],
+            "resumed": False,
+            "resume_ms": None,
+            **info,
+        }
     # If already has a container, return current port
-    if user.get("container_name") and user.get("host_port"):
-        return {"message": f"MySQL container already exists on port {user['host_port']}"}
+    if user.get("container_name"):
+        resume = ensure_container_running(username)
+        if resume["resumed"]:
+            return {
+                "message": f"MySQL container resumed on port {resume['host_port']} in {resume['resume_ms']} ms",
+                "status": "running",
+                **connection_info(username, user),
+                **resume,
+            }
+        return {
+            "message": f"MySQL container already exists on port {resume['host_port']}",
+            "status": "running",
+            **connection_info(username, user),
+            **resume,
+        }
 
-    port = start_mysql_container(username)
+    job = enqueue_provision(username)
     return {
-        "message": "Container started",
-        "host": "13.61.141.60",
-        "port": port,
-        "user": "root",
-        "password": MYSQL_ROOT_PASSWORD,
+        "message": "Container provisioning queued",
+        "job_id": job["job_id"],
+        "status": job["status"],
     }
 
 
+@app.post("/ensure_running/", dependencies=[Depends(rate_limit("provision"))])
+def ensure_running(user: Dict = Depends(require_auth)):
+    if user.get("shared_instance"):
+        # Shared instances are always up; nothing to resume.
+        info = connection_info(user["username"], user)
+        return {"host": info["host"], "host_port": info["port"], "resumed": False, "resume_ms": None}
+    return ensure_container_running(user["username"])
+
+
+@app.post("/sql/execute/", dependencies=[Depends(rate_limit("sql"))])
+def execute_sql(query: SQLModel, user: Dict = Depends(require_auth)):
+    if query.format not in ("ndjson", "arrow"):
+        raise HTTPException(status_code=400, detail=f"Unknown format {query.format}")
+    if query.format == "arrow" and pyarrow is None:
+        raise HTTPException(status_code=400, detail="Arrow output needs pyarrow on the server")
+    if not is_provisioned(user):
+        raise HTTPException(status_code=404, detail="Container not found")
+    with tracing.span("sql.route", root=False) as s:
+        route, resume = mysql_backend(user["username"])
+        s.set(resumed=resume["resumed"], resume_ms=resume["resume_ms"])
+    try:
+        conn = sql_pool.acquire(route)
+    except pymysql.MySQLError as e:
+        raise HTTPException(status_code=503, detail=f"Cannot connect to MySQL: {e}")
+    timeout = min(query.timeout or SQL_QUERY_TIMEOUT, SQL_QUERY_TIMEOUT)
+    try:
+        q = register_query(query.query_id or uuid.uuid4().hex, user["username"], route, conn, timeout)
+    except HTTPException:
+        sql_pool.release(route, conn)
+        raise
+    started = time.time()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET SESSION max_execution_time = %s", (int(timeout * 1000),))
+        if query.database:
+            conn.select_db(query.database)
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        with tracing.span("mysql.execute", root=False, query_id=q["query_id"]):
+            cursor.execute(query.sql)
+    except pymysql.MySQLError as e:
+        finish_query(q)
+        sql_pool.release(route, conn)
+        raise HTTPException(status_code=400, detail=sql_error(e, q))
+    header = {"query_id": q["query_id"], "resume_ms": resume["resume_ms"]}
+    if cursor.description is None:
+        rowcount = cursor.rowcount
+        finish_query(q)
+        sql_pool.release(route, conn)
+        return {
+            "type": "message",
+            "rowcount": rowcount,
+            "elapsed_ms": round((time.time() - started) * 1000),
+            **header,
+        }
+    max_rows = min(query.max_rows or SQL_MAX_ROWS, SQL_MAX_ROWS)
+    media_type = "application/vnd.apache.arrow.stream" if query.format == "arrow" else "application/x-ndjson"
+    return StreamingResponse(
+        stream_rows(route, conn, cursor, query.format, max_rows, header, q, tracing.current()),
+        media_type=media_type,
+        headers={"X-Query-Id": q["query_id"]},
+    )
+
+
+@app.post("/sql/cancel/")
+def cancel_sql(req: CancelModel, user: Dict = Depends(require_auth)):
+    with running_queries_lock:
+        q = running_queries.get(req.query_id)
+    if not q or (q["username"] != user["username"] and not user.get("is_admin")):
+        raise HTTPException(status_code=404, detail="Query not found or already finished")
+    return {"query_id": req.query_id, "cancelled": kill_query(q, "cancelled")}
+
+
+@app.get("/jobs/{job_id}/")
+def job_status(job_id: str, user: Dict = Depends(require_auth)):
+    job = get_job(job_id)
+    if not job or (job["username"] != user["username"] and not user.get("is_admin")):
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == "ready":
+        job.update(connection_info(job["username"], get_user(job["username"]) or {}))
+    return job
+
+
 # -------------------------------
 # Admin endpoints
 # -------------------------------
 @app.get("/admin/list_user/")
-def list_users(admin: Dict = Depends(require_admin)):
-    return {"users": list(users_db.keys())}
+def list_users(
+    request: Request,
+    response: Response,
+    f: UserListFilter = Depends(),
+    admin: Dict = Depends(require_admin),
+):
+    etag = listing_etag("names", f, [])
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    rows, next_cursor = query_user_page(f)
+    response.headers["ETag"] = etag
+    return {"users": [r["username"] for r in rows], "next_cursor": next_cursor}
 
 
 @app.get("/admin/list_users_detailed/")
-def list_users_detailed(admin: Dict = Depends(require_admin)):
-    return users_db
+def list_users_detailed(
+    request: Request,
+    response: Response,
+    f: UserListFilter = Depends(),
+    fields: Optional[str] = None,  # comma-separated, default all of LISTING_FIELDS
+    admin: Dict = Depends(require_admin),
+):
+    selected = listing_fields(fields)
+    etag = listing_etag("detailed", f, selected)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    rows, next_cursor = query_user_page(f)
+    users = []
+    for row in rows:
+        u = row_to_user(row)
+        entry = {"username": row["username"]}
+        for field in selected:
+            entry[field] = listing_container_status(u) if field == "container_status" else u.get(field)
+        users.append(entry)
+    if etag:
+        response.headers["ETag"] = etag
+    return {"users": users, "next_cursor": next_cursor}
+
+
+@app.get("/admin/idle/")
+def idle_status(admin: Dict = Depends(require_admin)):
+    return idle_summary()
+
+
+@app.get("/admin/reconcile/")
+def reconcile_status(admin: Dict = Depends(require_admin)):
+    return {"last_run": last_reconcile_report or None, "totals": reconcile_totals}
+
+
+@app.post("/admin/reconcile/")
+def reconcile_now(admin: Dict = Depends(require_admin)):
+    if not live_hosts():
+        raise HTTPException(status_code=500, detail="Docker not available")
+    return reconcile()
 
 
-@app.post("/admin/delete_user/")
-def delete_user(data: UserActionModel, admin: Dict = Depends(require_admin)):
-    u = users_db.get(data.username)
+@app.get("/admin/capacity/")
+def capacity(admin: Dict = Depends(require_admin)):
+    hosts = {h.name: h.admission.stats() for h in docker_hosts.values()}
+    return {
+        "budget_mb": sum(s["budget_mb"] for s in hosts.values()),
+        "committed_mb": sum(s["committed_mb"] for s in hosts.values()),
+        "hosts": hosts,
+        "default_tier": DEFAULT_TIER,
+        "tiers": RESOURCE_TIERS,
+    }
+
+
+@app.get("/admin/hosts/")
+def list_hosts(admin: Dict = Depends(require_admin)):
+    counts = {
+        r["host"]: r["n"]
+        for r in db_query(
+            "SELECT COALESCE(host, ?) AS host, COUNT(*) AS n FROM users "
+            "WHERE container_name IS NOT NULL GROUP BY 1",
+            (DEFAULT_HOST,),
+        )
+    }
+    return {
+        "placement_strategy": PLACEMENT_STRATEGY,
+        "hosts": [
+            {**h.stats(), "containers": counts.get(h.name, 0), "warm_pool": warm_pool_size(h)}
+            for h in docker_hosts.values()
+        ],
+    }
+
+
+@app.post("/admin/set_tier/")
+def set_tier(data: TierModel, admin: Dict = Depends(require_admin)):
+    u = get_user(data.username)
     if not u:
         raise HTTPException(status_code=404, detail="User not found")
-    if u.get("container_name") and client:
+    if data.tier is not None and data.tier not in RESOURCE_TIERS:
+        raise HTTPException(status_code=400, detail=f"Unknown tier {data.tier}")
+    # Only the fields sent are changed; an explicit null clears an override.
+    fields = data.dict(exclude={"username"}, exclude_unset=True)
+    u.update(fields)
+    limits = resource_limits(u)
+    message = f"Limits for {data.username} set to {limits}"
+    running = False
+    if u.get("container_name"):
+        state = get_container_state(host_of(u), u["container_name"])
+        running = bool(state and state["status"] == "running")
+    if running:
+        # Before persisting: a 503 here must leave the old limits in place.
+        admit_container(host_of(u), u["container_name"], u, timeout=0)
+    update_user(data.username, **fields)
+    if u.get("container_name"):
+        h = host_of(u)
         try:
-            c = client.containers.get(u["container_name"])
-            c.stop()
-            c.remove()
-        except Exception:
-            logger.debug("Failed to remove container for %s", data.username)
-    del users_db[data.username]
-    save_users_db()
-    return {"message": f"User {data.username} deleted"}
+            h.client.api.update_container(u["container_name"], **docker_limits(limits))
+        except Exception as e:
+            logger.warning("Failed to apply limits to %s: %s", u["container_name"], e)
+            message += " (applies from the next container start)"
+    return {"message": message, "limits": limits}
+
+
+@app.post("/admin/set_mode/")
+def set_mode(data: ModeModel, admin: Dict = Depends(require_admin)):
+    u = get_user(data.username)
+    if not u:
+        raise HTTPException(status_code=404, detail="User not found")
+    if data.mode not in ("container", "shared"):
+        raise HTTPException(status_code=400, detail=f"Unknown mode {data.mode}")
+    if is_provisioned(u) and user_mode(u) != data.mode:
+        raise HTTPException(status_code=409, detail="User already provisioned; delete and re-provision to switch")
+    update_user(data.username, mode=data.mode)
+    return {"message": f"Provisioning mode for {data.username} set to {data.mode}"}
+
+
+@app.get("/admin/proxy/")
+def proxy_status(admin: Dict = Depends(require_admin)):
+    return {
+        "enabled": bool(MYSQL_PROXY_PORT),
+        "public_host": MYSQL_PROXY_PUBLIC_HOST,
+        "publish_ports": {h.name: h.publish_ports for h in docker_hosts.values()},
+        **mysql_proxy.stats(),
+    }
+
+
+@app.get("/admin/rate_limits/")
+def rate_limit_status(admin: Dict = Depends(require_admin)):
+    return {kind: limiter.stats() for kind, limiter in rate_limiters.items()}
+
+
+@app.get("/admin/sql_pool/")
+def sql_pool_status(admin: Dict = Depends(require_admin)):
+    return {
+        "pool_size": SQL_POOL_SIZE,
+        "idle_seconds": SQL_POOL_IDLE,
+        "pooled": sql_pool.pooled(),
+        "max_rows": SQL_MAX_ROWS,
+        "max_bytes": SQL_MAX_BYTES,
+        "query_timeout": SQL_QUERY_TIMEOUT,
+        "running_queries": len(running_queries),
+        **sql_pool.counters(),
+        **sql_query_stats(),
+    }
+
+
+@app.get("/admin/shared_instances/")
+def list_shared_instances(admin: Dict = Depends(require_admin)):
+    load = shared_instance_load()
+    instances = []
+    for inst in shared_instances.values():
+        info = {
+            "name": inst.name,
+            "public_host": inst.public_host,
+            "public_port": inst.public_port,
+            "users": load[inst.name],
+            "max_users": inst.max_users,
+        }
+        try:
+            with inst.connect() as conn, conn.cursor() as cur:
+                cur.execute("SHOW GLOBAL STATUS WHERE Variable_name IN ('Threads_connected', 'Uptime')")
+                info.update({k.lower(): int(v) for k, v in cur.fetchall()})
+            info["reachable"] = True
+        except pymysql.MySQLError as e:
+            info.update(reachable=False, error=str(e))
+        instances.append(info)
+    return {"default_mode": PROVISION_MODE, "instances": instances}
+
+
+@app.get("/admin/container_states/")
+def list_container_states(admin: Dict = Depends(require_admin)):
+    hosts = {}
+    for h in docker_hosts.values():
+        with h.states_lock:
+            states = {name: dict(state) for name, state in h.container_states.items()}
+        hosts[h.name] = {"live": h.states_ready.is_set(), "containers": states}
+    return {"hosts": hosts}
+
+
+@app.get("/admin/provision_timings/")
+def provision_timings(limit: int = 100, admin: Dict = Depends(require_admin)):
+    rows = [
+        dict(r)
+        for r in db_query("SELECT * FROM provision_timings ORDER BY id DESC LIMIT ?", (limit,))
+    ]
+    summary = {}
+    for phase in ("create_seconds", "start_seconds", "ready_seconds", "total_seconds"):
+        values = sorted(r[phase] for r in rows if r[phase] is not None)
+        summary[phase] = {
+            "p50": values[len(values) // 2] if values else None,
+            "p95": values[int(len(values) * 0.95)] if values else None,
+            "max": values[-1] if values else None,
+        }
+    return {
+        "count": len(rows),
+        "pool_hits": sum(1 for r in rows if r["source"] == "pool"),
+        "coalesced": {"provision": provision_flight.stats, "resume": resume_flight.stats},
+        "summary": summary,
+        "recent": rows,
+    }
+
+
+@app.get("/admin/warm_pool/")
+def warm_pool_status(admin: Dict = Depends(require_admin)):
+    lookups = warm_pool_stats["hits"] + warm_pool_stats["misses"]
+    refills = sorted(warm_pool_refill_seconds)
+    return {
+        "size": warm_pool_size(),
+        "target_size": WARM_POOL_SIZE * len(live_hosts()),
+        "per_host": {h.name: warm_pool_size(h) for h in docker_hosts.values()},
+        **warm_pool_stats,
+        "hit_rate": warm_pool_stats["hits"] / lookups if lookups else None,
+        "refill_latency_seconds": {
+            "count": len(refills),
+            "avg": sum(refills) / len(refills) if refills else None,
+            "p50": refills[len(refills) // 2] if refills else None,
+            "max": refills[-1] if refills else None,
+        },
+    }
+
+
+@app.post("/admin/delete_user/")
+def delete_user(data: UserActionModel, admin: Dict = Depends(require_admin)):
+    return admin_delete_user(data.username)
 
 
 @app.post("/admin/restart_user/")
 def restart_user(data: UserActionModel, admin: Dict = Depends(require_admin)):
-    u = users_db.get(data.username)
-    if not u or not u.get("container_name"):
-        raise HTTPException(status_code=404, detail="Container not found")
-    if not client:
-        raise HTTPException(status_code=500, detail="Docker not available")
-    client.containers.get(u["container_name"]).restart()
-    return {"message": f"Container for {data.username} restarted"}
+    return admin_restart_user(data.username)
 
 
 @app.post("/admin/start_user/")
 def start_user(data: UserActionModel, admin: Dict = Depends(require_admin)):
-    u = users_db.get(data.username)
-    if not u:
-        raise HTTPException(status_code=404, detail="User not found")
-    if not u.get("container_name"):
-        port = start_mysql_container(data.username)
-        return {"message": f"Container started on port {port}"}
-    if not client:
-        raise HTTPException(status_code=500, detail="Docker not available")
-    client.containers.get(u["container_name"]).start()
-    return {"message": f"Container for {data.username} started"}
+    return admin_start_user(data.username)
 
 
 @app.post("/admin/stop_user/")
 def stop_user(data: UserActionModel, admin: Dict = Depends(require_admin)):
-    u = users_db.get(data.username)
-    if not u or not u.get("container_name"):
-        raise HTTPException(status_code=404, detail="Container not found")
-    if not client:
-        raise HTTPException(status_code=500, detail="Docker not available")
-    client.containers.get(u["container_name"]).stop()
-    return {"message": f"Container for {data.username} stopped"}
+    return admin_stop_user(data.username)
 
 
 @app.post("/admin/suspend_user/")
 def suspend_user(data: UserActionModel, admin: Dict = Depends(require_admin)):
-    u = users_db.get(data.username)
-    if not u:
-        raise HTTPException(status_code=404, detail="User not found")
-    u["suspended"] = True
-    save_users_db()
-    return {"message": f"User {data.username} suspended"}
+    return admin_suspend_user(data.username)
 
 
 @app.post("/admin/unsuspend_user/")
 def unsuspend_user(data: UserActionModel, admin: Dict = Depends(require_admin)):
-    u = users_db.get(data.username)
-    if not u:
-        raise HTTPException(status_code=404, detail="User not found")
-    u["suspended"] = False
-    save_users_db()
-    return {"message": f"User {data.username} unsuspended"}
+    return admin_unsuspend_user(data.username)
+
+
+@app.post("/admin/bulk/{action}/")
+def bulk_action(action: str, data: BulkActionModel, admin: Dict = Depends(require_admin)):
+    if action not in ADMIN_USER_ACTIONS:
+        raise HTTPException(status_code=404, detail=f"Unknown action {action}; one of {', '.join(ADMIN_USER_ACTIONS)}")
+    if (data.usernames is None) == (data.filter is None):
+        raise HTTPException(status_code=400, detail="Give either usernames or filter")
+    usernames = data.usernames if data.usernames is not None else filter_usernames(data.filter)
+    admins = {r["username"] for r in db_query("SELECT username FROM users WHERE is_admin = 1")} | {ADMIN_USERNAME}
+    usernames = [u for u in dict.fromkeys(usernames) if u not in admins]
+    stop_timeout = STOP_TIMEOUT if data.stop_timeout is None else data.stop_timeout
+    started = time.time()
+    results = run_bulk_action(action, usernames, stop_timeout, data.max_workers or BULK_WORKERS)
+    return {
+        "action": action,
+        "count": len(results),
+        "succeeded": sum(1 for r in results if r["ok"]),
+        "failed": sum(1 for r in results if not r["ok"]),
+        "elapsed_ms": round((time.time() - started) * 1000),
+        "results": results,
+    }
+
+
+@app.get("/admin/container_logs/stream/")
+def stream_container_logs(
+    username: str,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    cursor: Optional[str] = None,
+    tail: Optional[int] = None,
+    follow: bool = False,
+    format: str = "ndjson",
+    last_event_id: Optional[str] = Header(None),
+    admin: Dict = Depends(require_admin),
+):
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}")
+    u = require_container(username)
+    since_ns = parse_log_time(since)
+    cursor = cursor or last_event_id
+    if cursor:
+        after_ns = log_ts_ns(cursor)
+        if after_ns is None:
+            raise HTTPException(status_code=400, detail=f"Bad cursor {cursor!r}")
+        since_ns = max(since_ns or 0, after_ns + 1)
+    until_ns = parse_log_time(until)
+    if tail is None and not (since_ns or until_ns):
+        tail = 100
+    records = iter_container_logs(
+        host_of(u), u["container_name"], since_ns=since_ns, until_ns=until_ns, tail=tail, follow=follow
+    )
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(format_log_records(records, format), media_type=media_type)
+
+
+@app.get("/admin/stats/")
+def container_stats(
+    sort: str = "cpu_percent",
+    top: int = 20,
+    history: bool = False,
+    username: Optional[str] = None,
+    admin: Dict = Depends(require_admin),
+):
+    if sort not in STATS_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(STATS_FIELDS)}")
+    owners = {
+        (u.get("host") or DEFAULT_HOST, u["container_name"]): name
+        for name, u in all_users().items()
+        if u.get("container_name")
+    }
+    with container_samples_lock:
+        snapshot = {key: list(samples) for key, samples in container_samples.items()}
+    rows = []
+    for (host, container), samples in snapshot.items():
+        owner = owners.get((host, container))
+        if not samples or (username and owner != username):
+            continue
+        current = {k: samples[-1][k] for k in (*STATS_FIELDS, "mem_limit", "t")}
+        recent_avg = {}
+        for field in STATS_FIELDS:
+            values = [s[field] for s in samples if s[field] is not None]
+            recent_avg[field] = round(sum(values) / len(values), 2) if values else None
+        row = {"username": owner, "host": host, "container": container, "current": current, "avg": recent_avg}
+        if history:
+            row["recent"] = [{k: s[k] for k in ("t", *STATS_FIELDS)} for s in samples]
+        rows.append(row)
+    rows.sort(key=lambda r: r["current"][sort] or 0, reverse=True)
+    return {
+        "interval": STATS_INTERVAL,
+        "history_size": STATS_HISTORY,
+        "containers_sampled": len(rows),
+        **stats_sampler_state,
+        "containers": rows[: max(top, 0)],
+    }
+
+
+@app.get("/admin/logs/search/")
+def search_logs(
+    username: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    cursor: Optional[str] = None,
+    severity: Optional[str] = None,
+    q: Optional[str] = None,
+    limit: int = 200,
+    admin: Dict = Depends(require_admin),
+):
+    if severity not in (None, "error", "warning"):
+        raise HTTPException(status_code=400, detail="severity must be error or warning")
+    after = (0, -1)
+    if cursor:
+        try:
+            chunk_id, index = cursor.split(":")
+            after = (int(chunk_id), int(index))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Bad cursor {cursor!r}")
+    matches, next_cursor = search_log_archive(
+        username, parse_log_time(since), parse_log_time(until), severity, q, max(1, min(limit, 5000)), after
+    )
+    return {"matches": matches, "next_cursor": next_cursor}
+
+
+@app.get("/admin/logs/summary/")
+def log_summary(since: Optional[str] = None, admin: Dict = Depends(require_admin)):
+    # Per-user line and severity counts straight from the index; defaults to today (UTC).
+    since_ns = parse_log_time(since)
+    if since_ns is None:
+        since_ns = calendar.timegm(time.gmtime()[:3] + (0, 0, 0, 0, 0, 0)) * 10**9
+    rows = db_query(
+        "SELECT username, SUM(lines) AS lines, SUM(errors) AS errors, SUM(warnings) AS warnings, "
+        "MAX(last_ns) AS last_ns FROM log_chunks WHERE last_ns >= ? GROUP BY username "
+        "ORDER BY errors DESC, warnings DESC, username",
+        (since_ns,),
+    )
+    return {
+        "since_ns": since_ns,
+        "users": [dict(r) for r in rows],
+        "archive": {"dir": str(LOG_ARCHIVE_DIR), "interval": LOG_ARCHIVE_INTERVAL, **log_archive_stats},
+    }
 
 
 @app.get("/admin/container_logs/")
 def container_logs(username: str, admin: Dict = Depends(require_admin)):
-    u = users_db.get(username)
-    if not u or not u.get("container_name"):
-        raise HTTPException(status_code=404, detail="Container not found")
-    if not client:
-        raise HTTPException(status_code=500, detail="Docker not available")
-    logs = client.containers.get(u["container_name"]).logs(tail=100)
+    u = require_container(username)
+    logs = host_of(u).client.api.logs(u["container_name"], tail=100)
     # logs may be bytes
     if isinstance(logs, bytes):
         logs = logs.decode(errors="ignore")
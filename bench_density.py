@@ -0,0 +1,106 @@
+"""Compare memory per user for container-per-user vs shared-instance mode.
+
+Usage: python bench_density.py [--users 10]
+
+Needs a Docker daemon (the first entry of DOCKER_HOSTS). Container mode
+starts --users MySQL containers with the default tier limits; shared mode
+starts one MySQL container and creates --users databases and scoped
+accounts on it through api.py. In both modes every user connects once and
+creates a small table, then the working set is read from `docker stats`.
+"""
+import argparse
+import socket
+import time
+
+import pymysql
+
+import api
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_container(h: api.DockerHost, image: str, limits: dict, timeout: float):
+    port = free_port()
+    container = h.client.containers.run(
+        image,
+        environment={"MYSQL_ROOT_PASSWORD": api.MYSQL_ROOT_PASSWORD, "MYSQL_ROOT_HOST": "%"},
+        ports={"3306/tcp": port},
+        labels={"sqllab.bench": "1"},
+        pids_limit=limits["pids_limit"],
+        detach=True,
+        **api.docker_limits(limits),
+    )
+    if not api.wait_for_mysql(h.readiness_host, port, timeout=timeout):
+        container.remove(force=True, v=True)
+        raise TimeoutError(f"{image} did not become ready within {timeout}s")
+    return container, port
+
+
+def touch(host: str, port: int, user: str, password: str, database: str, timeout: float) -> None:
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn = pymysql.connect(host=host, port=port, user=user, password=password, autocommit=True)
+            break
+        except pymysql.err.OperationalError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+    with conn, conn.cursor() as cur:
+        cur.execute(f"CREATE DATABASE IF NOT EXISTS {api.quote_ident(database)}")
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {api.quote_ident(database)}.t (id INT PRIMARY KEY)")
+        cur.execute(f"REPLACE INTO {api.quote_ident(database)}.t VALUES (1)")
+
+
+def bench_containers(h: api.DockerHost, image: str, users: int, timeout: float) -> int:
+    containers = []
+    try:
+        for i in range(users):
+            container, port = start_container(h, image, api.resource_limits(), timeout)
+            containers.append(container)
+            touch(h.readiness_host, port, "root", api.MYSQL_ROOT_PASSWORD, f"bench{i}", timeout)
+        time.sleep(5)
+        return sum(api.container_memory_bytes(h, c.name) for c in containers)
+    finally:
+        for c in containers:
+            c.remove(force=True, v=True)
+
+
+def bench_shared(h: api.DockerHost, image: str, users: int, timeout: float) -> int:
+    container, port = start_container(h, image, api.RESOURCE_TIERS["large"], timeout)
+    try:
+        inst = api.SharedInstance({"name": "bench", "host": h.readiness_host, "port": port})
+        touch(h.readiness_host, port, "root", api.MYSQL_ROOT_PASSWORD, "bench", timeout)
+        for i in range(users):
+            account, password = api.create_shared_account(inst, f"bench{i}")
+            touch(h.readiness_host, port, account, password, f"bench{i}", timeout)
+        time.sleep(5)
+        return api.container_memory_bytes(h, container.name)
+    finally:
+        container.remove(force=True, v=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    h = api.docker_hosts[api.DEFAULT_HOST]
+    if h.client is None:
+        raise SystemExit("Docker not available")
+    image = api.ensure_mysql_image(h)
+
+    print(f"{'mode':<12} {'users':>6} {'total MB':>10} {'MB/user':>9} {'users/GB':>9}")
+    for mode, bench in (("container", bench_containers), ("shared", bench_shared)):
+        total = bench(h, image, args.users, args.timeout) / 2**20
+        per_user = total / args.users
+        print(f"{mode:<12} {args.users:>6} {total:>10.0f} {per_user:>9.1f} {1024 / per_user:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Compare time to first accepted connection for plain vs pre-initialised MySQL images.
+
+Usage: python bench_mysql_image.py [--runs 3]
+
+Needs a Docker daemon (the first entry of DOCKER_HOSTS). Builds the
+pre-initialised image through api.py if it is not cached yet, then starts
+each image --runs times and measures from `docker run` until pymysql
+completes a login as root.
+"""
+import argparse
+import socket
+import statistics
+import time
+
+import pymysql
+
+import api
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_connection(h: api.DockerHost, image: str, timeout: float) -> float:
+    port = free_port()
+    started = time.time()
+    container = h.client.containers.run(
+        image,
+        environment={"MYSQL_ROOT_PASSWORD": api.MYSQL_ROOT_PASSWORD, "MYSQL_ROOT_HOST": "%"},
+        ports={"3306/tcp": port},
+        detach=True,
+    )
+    try:
+        while time.time() - started < timeout:
+            try:
+                pymysql.connect(
+                    host=h.readiness_host,
+                    port=port,
+                    user="root",
+                    password=api.MYSQL_ROOT_PASSWORD,
+                    connect_timeout=1,
+                ).close()
+                return time.time() - started
+            except pymysql.err.OperationalError:
+                time.sleep(0.05)
+        raise TimeoutError(f"{image} did not accept a connection within {timeout}s")
+    finally:
+        container.remove(force=True, v=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    h = api.docker_hosts[api.DEFAULT_HOST]
+    if h.client is None:
+        raise SystemExit("Docker not available")
+    preinit = api.ensure_mysql_image(h)
+    if preinit == api.MYSQL_IMAGE:
+        raise SystemExit("Pre-initialised image could not be built")
+
+    print(f"{'image':<40} {'min':>8} {'median':>8} {'max':>8}")
+    for image in (api.MYSQL_IMAGE, preinit):
+        samples = [time_to_first_connection(h, image, args.timeout) for _ in range(args.runs)]
+        print(
+            f"{image:<40} {min(samples):>7.2f}s {statistics.median(samples):>7.2f}s {max(samples):>7.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
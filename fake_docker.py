@@ -0,0 +1,363 @@
+"""In-process stand-in for docker.DockerClient, selected with base_url fake://<name>.
+
+Covers the subset of the Docker SDK that api.py uses, so several "hosts" can
+be exercised without real daemons, e.g.
+
+    DOCKER_HOSTS='[{"name": "a", "base_url": "fake://a", "port_range_start": 40000, "port_range_end": 40100},
+                   {"name": "b", "base_url": "fake://b", "port_range_start": 41000, "port_range_end": 41100}]'
+
+Running containers answer with a MySQL protocol-10 greeting, which is enough
+for the readiness probe: on 127.0.0.1:<published port>, or on 3306 of their
+own loopback address (reported as the network IP) when nothing is published.
+"""
+import calendar
+import itertools
+import queue
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+from docker.errors import APIError, ImageNotFound, NotFound
+
+GREETING = b"\x0a8.0.0-fake\x00" + b"\x00" * 4 + b"fakeseed\x00"
+GREETING_PACKET = len(GREETING).to_bytes(3, "little") + b"\x00" + GREETING
+
+
+class FakeContainer:
+    def __init__(self, daemon: "FakeDaemon", name: str, image: str, **kwargs):
+        self.daemon = daemon
+        self.id = f"{daemon.name}-{len(daemon.containers)}-{int(time.time() * 1000)}"
+        self.name = name
+        self.image = image
+        self.kwargs = kwargs
+        self.labels = kwargs.get("labels") or {}
+        self.ports = kwargs.get("ports") or {}
+        self.network = kwargs.get("network")
+        self.ip = daemon.next_ip()
+        self.status = "created"
+        self.exit_code = 0
+        self.created = time.time()
+        self.started_at: Optional[float] = None
+        self.questions = 0
+        self.log_lines: List[str] = []
+        self._listener: Optional[socket.socket] = None
+
+    @property
+    def attrs(self) -> Dict:
+        return {
+            "Id": self.id,
+            "Name": f"/{self.name}",
+            "State": {
+                "Status": self.status,
+                "ExitCode": self.exit_code,
+                "StartedAt": self.started_at,
+            },
+            "Config": {"Image": self.image, "Labels": self.labels},
+            "NetworkSettings": {
+                "Networks": {self.network: {"IPAddress": self.ip}} if self.network else {},
+            },
+        }
+
+    def _listen(self) -> None:
+        addresses = [("127.0.0.1", port) for port in self.ports.values()] or [(self.ip, 3306)]
+        for address in addresses:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(address)
+            except OSError as e:
+                sock.close()
+                raise APIError(f"{address[0]}:{address[1]} already allocated: {e}")
+            sock.listen(16)
+            self._listener = sock
+            threading.Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock: socket.socket) -> None:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    conn.sendall(GREETING_PACKET)
+                except OSError:
+                    pass
+
+    def start(self) -> None:
+        if self.status == "running":
+            return
+        self._listen()
+        self.status = "running"
+        self.started_at = time.time()
+        self.log(f"[System] [MY-010931] [Server] {self.name}: ready for connections.")
+        self.daemon.emit("start", self)
+
+    def stop(self, timeout: int = 10) -> None:
+        if self.status != "running":
+            return
+        if self._listener:
+            # shutdown() wakes the blocked accept() so the port is freed now.
+            try:
+                self._listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._listener.close()
+            self._listener = None
+        self.status = "exited"
+        self.exit_code = 0
+        self.daemon.emit("die", self, exitCode="0")
+        self.daemon.emit("stop", self)
+
+    def restart(self, timeout: int = 10) -> None:
+        self.stop(timeout)
+        self.start()
+
+    def remove(self, force: bool = False, v: bool = False) -> None:
+        if self.status == "running":
+            if not force:
+                raise APIError(f"container {self.name} is running")
+            self.stop()
+        self.daemon.containers.pop(self.name, None)
+        self.daemon.emit("destroy", self)
+
+    def rename(self, name: str) -> None:
+        if name in self.daemon.containers:
+            raise APIError(f"name {name} already in use")
+        old = self.name
+        self.daemon.containers.pop(old)
+        self.name = name
+        self.daemon.containers[name] = self
+        self.daemon.emit("rename", self, oldName=f"/{old}")
+
+    def update(self, **kwargs) -> None:
+        self.kwargs.update(kwargs)
+
+    def reload(self) -> None:
+        pass
+
+    def log(self, message: str) -> None:
+        ts = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + f".{int(time.time() % 1 * 1e9):09d}Z"
+        self.log_lines.append(f"{ts} {message}")
+
+    def logs(self, **kwargs):
+        return self.daemon.api.logs(self.name, **kwargs)
+
+
+class FakeContainers:
+    def __init__(self, daemon: "FakeDaemon"):
+        self.daemon = daemon
+
+    def create(self, image: str, name: Optional[str] = None, **kwargs) -> FakeContainer:
+        name = name or f"fake_{len(self.daemon.containers)}"
+        if name in self.daemon.containers:
+            raise APIError(f"Conflict. The container name /{name} is already in use")
+        container = FakeContainer(self.daemon, name, image, **kwargs)
+        self.daemon.containers[name] = container
+        self.daemon.emit("create", container)
+        return container
+
+    def run(self, image: str, name: Optional[str] = None, **kwargs) -> FakeContainer:
+        container = self.create(image, name=name, **kwargs)
+        container.start()
+        return container
+
+    def get(self, name: str) -> FakeContainer:
+        try:
+            return self.daemon.containers[name]
+        except KeyError:
+            raise NotFound(f"No such container: {name}")
+
+    def list(self, all: bool = False, filters=None) -> List[FakeContainer]:
+        return [c for c in self.daemon.containers.values() if all or c.status == "running"]
+
+
+class FakeImages:
+    def __init__(self, daemon: "FakeDaemon"):
+        self.daemon = daemon
+
+    def get(self, tag: str) -> str:
+        if tag not in self.daemon.images:
+            raise ImageNotFound(tag)
+        return tag
+
+    def build(self, tag: str, **kwargs):
+        self.daemon.images.add(tag)
+        return tag, []
+
+
+class FakeNetworks:
+    def __init__(self, daemon: "FakeDaemon"):
+        self.daemon = daemon
+
+    def get(self, name: str) -> str:
+        if name not in self.daemon.networks:
+            raise NotFound(f"network {name} not found")
+        return name
+
+    def create(self, name: str, **kwargs) -> str:
+        self.daemon.networks.add(name)
+        return name
+
+
+class FakeAPI:
+    def __init__(self, daemon: "FakeDaemon"):
+        self.daemon = daemon
+
+    def _get(self, name: str) -> FakeContainer:
+        return self.daemon.containers_api.get(name)
+
+    def containers(self, all: bool = False, filters=None) -> List[Dict]:
+        result = []
+        for c in self.daemon.containers.values():
+            if not all and c.status != "running":
+                continue
+            result.append(
+                {
+                    "Id": c.id,
+                    "Names": [f"/{c.name}"],
+                    "Image": c.image,
+                    "State": c.status,
+                    "Status": "Up" if c.status == "running" else f"Exited ({c.exit_code})",
+                    "Labels": c.labels,
+                    "Created": int(c.created),
+                    "Ports": [
+                        {"PrivatePort": int(k.split("/")[0]), "PublicPort": v, "Type": "tcp"}
+                        for k, v in c.ports.items()
+                    ],
+                }
+            )
+        return result
+
+    def inspect_container(self, name: str) -> Dict:
+        return self._get(name).attrs
+
+    def start(self, name: str) -> None:
+        self._get(name).start()
+
+    def stop(self, name: str, timeout: int = 10) -> None:
+        self._get(name).stop(timeout)
+
+    def restart(self, name: str, timeout: int = 10) -> None:
+        self._get(name).restart(timeout)
+
+    def remove_container(self, name: str, force: bool = False, v: bool = False) -> None:
+        self._get(name).remove(force=force, v=v)
+
+    def update_container(self, name: str, **kwargs) -> None:
+        self._get(name).update(**kwargs)
+
+    def exec_create(self, name: str, cmd, **kwargs) -> Dict:
+        self._get(name)
+        return {"Id": name}
+
+    def exec_start(self, exec_id: str, **kwargs) -> bytes:
+        c = self._get(exec_id)
+        c.questions += 1
+        return f"Threads_connected\t1\nQuestions\t{c.questions}\n".encode()
+
+    def stats(self, name: str, stream: bool = True, decode=None, one_shot=None) -> Dict:
+        c = self._get(name)
+        return {
+            "read": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "cpu_stats": {"cpu_usage": {"total_usage": int((time.time() - c.created) * 1e7)},
+                          "system_cpu_usage": int(time.time() * 1e9), "online_cpus": 1},
+            "precpu_stats": {},
+            "memory_stats": {"usage": 400 * 2**20, "limit": 512 * 2**20, "stats": {"inactive_file": 0}},
+            "blkio_stats": {"io_service_bytes_recursive": []},
+            "networks": {"eth0": {"rx_bytes": 0, "tx_bytes": 0}},
+        }
+
+    def logs(self, name: str, stdout=True, stderr=True, stream=False, timestamps=False,
+             tail="all", since=None, follow=None, until=None):
+        c = self._get(name)
+        lines = [line for line in c.log_lines if _in_window(line, since, until)]
+        if tail != "all":
+            lines = lines[-int(tail):] if int(tail) else []
+        if stream and follow:
+            return self._follow(c, lines, timestamps, until)
+        data = [_format_log(line, timestamps) for line in lines]
+        return iter(data) if stream else b"".join(data)
+
+    def _follow(self, c: FakeContainer, lines: List[str], timestamps: bool, until):
+        yield from (_format_log(line, timestamps) for line in lines)
+        seen = len(c.log_lines)
+        while c.status == "running" and (until is None or time.time() < until):
+            time.sleep(0.05)
+            for line in c.log_lines[seen:]:
+                yield _format_log(line, timestamps)
+            seen = len(c.log_lines)
+
+
+def _log_time(line: str) -> float:
+    stamp, fraction = line.split(" ", 1)[0].rstrip("Z").split(".")
+    return calendar.timegm(time.strptime(stamp, "%Y-%m-%dT%H:%M:%S")) + float(f"0.{fraction}")
+
+
+def _in_window(line: str, since, until) -> bool:
+    t = _log_time(line)
+    return (not since or t >= since) and (not until or t < until)
+
+
+def _format_log(line: str, timestamps: bool) -> bytes:
+    return f"{line if timestamps else line.split(' ', 1)[1]}\n".encode()
+
+
+class FakeDaemon:
+    """One fake Docker daemon; exposes the DockerClient surface api.py relies on."""
+
+    _count = 0
+
+    def __init__(self, name: str):
+        FakeDaemon._count += 1
+        self.name = name
+        self.index = FakeDaemon._count
+        self.containers: Dict[str, FakeContainer] = {}
+        self.images: set = set()
+        self.networks: set = set()
+        self.networks_api = FakeNetworks(self)
+        self._addresses = itertools.count(2)
+        self.containers_api = FakeContainers(self)
+        self.images_api = FakeImages(self)
+        self.api = FakeAPI(self)
+        self._subscribers: List[queue.Queue] = []
+
+    def next_ip(self) -> str:
+        n = next(self._addresses)
+        return f"127.{self.index}.{n // 250}.{n % 250 + 1}"
+
+    def emit(self, action: str, container: FakeContainer, **attributes) -> None:
+        event = {
+            "Type": "container",
+            "Action": action,
+            "id": container.id,
+            "time": int(time.time()),
+            "timeNano": time.time_ns(),
+            "Actor": {"ID": container.id, "Attributes": {"name": container.name, **attributes}},
+        }
+        for q in list(self._subscribers):
+            q.put(event)
+
+    def events(self, decode: bool = True, since=None, until=None, filters=None):
+        q: queue.Queue = queue.Queue()
+        self._subscribers.append(q)
+        try:
+            while True:
+                yield q.get()
+        finally:
+            self._subscribers.remove(q)
+
+    def ping(self) -> bool:
+        return True
+
+
+class FakeDockerClient:
+    def __init__(self, name: str):
+        self._daemon = FakeDaemon(name)
+        self.containers = self._daemon.containers_api
+        self.images = self._daemon.images_api
+        self.networks = self._daemon.networks_api
+        self.api = self._daemon.api
+        self.events = self._daemon.events
+        self.ping = self._daemon.ping
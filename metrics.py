@@ -0,0 +1,202 @@
+"""Minimal Prometheus metrics: counters, gauges and histograms in text format.
+
+Just enough of the client library for api.py's /metrics endpoint, without a
+dependency. Metrics register themselves on creation; render() produces the
+exposition text for all of them. Gauges may take a collect callback that is
+run at scrape time for values that live elsewhere (container states, port
+pools), e.g.
+
+    requests = Counter("http_requests_total", "Requests", ("method", "status"))
+    requests.inc(method="GET", status="200")
+    ports = Gauge("ports", "Ports by state", ("state",), collect=lambda: [({"state": "free"}, 12)])
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REGISTRY: List["Metric"] = []
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, format_labels(self.labels, key), value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], Iterable[Tuple[Dict[str, str], float]]]] = None,
+    ):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._collect = collect
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self._collect is not None:
+            items = sorted((self.key(labels), value) for labels, value in self._collect())
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, format_labels(self.labels, key), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts..., +Inf count], sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[i] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, (list(c), t[0])) for k, (c, t) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                yield f"{self.name}_bucket", format_labels(self.labels, key, le), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, key), total
+            yield f"{self.name}_count", format_labels(self.labels, key), cumulative
+
+
+class Instrumented:
+    """Proxy that times every method call on target into a histogram.
+
+    Attributes listed in nested are wrapped too, with their name as a
+    prefix of the call label (client.api.start -> "api.start"). Calls that
+    raise are also counted in errors.
+    """
+
+    def __init__(
+        self,
+        target,
+        histogram: Histogram,
+        errors: Counter,
+        labels: Dict[str, str],
+        nested: Sequence[str] = (),
+        prefix: str = "",
+    ):
+        self._target = target
+        self._histogram = histogram
+        self._errors = errors
+        self._labels = labels
+        self._nested = tuple(nested)
+        self._prefix = prefix
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name in self._nested:
+            return Instrumented(attr, self._histogram, self._errors, self._labels, prefix=f"{self._prefix}{name}.")
+        if not callable(attr):
+            return attr
+        call = f"{self._prefix}{name}"
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                self._errors.inc(call=call, **self._labels)
+                raise
+            finally:
+                self._histogram.observe(time.perf_counter() - started, call=call, **self._labels)
+
+        return timed
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
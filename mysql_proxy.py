@@ -0,0 +1,566 @@
+"""MySQL wire-protocol proxy: one listening port routed to per-user servers.
+
+Clients log in with their lab username and the password the backend issued
+them. The proxy checks the scramble itself (the caching_sha2_password fast
+path, or mysql_native_password for older clients), asks ``route(username)`` where that user's
+server lives and splices the session onto a backend connection: one parked
+in the pool for the same route, capabilities and character set if there is
+one, otherwise a fresh login (over TLS when the server offers it, so
+caching_sha2_password full authentication works without RSA keys).
+
+COM_QUIT from the client is intercepted; the backend session is cleared
+with COM_RESET_CONNECTION and parked instead of closed. Pooled connections
+idle for longer than ``pool_idle`` seconds are closed so they do not keep a
+container looking busy.
+"""
+import asyncio
+import hmac
+import hashlib
+import itertools
+import logging
+import secrets
+import ssl
+import string
+import struct
+import time
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CLIENT_LONG_PASSWORD = 1
+CLIENT_FOUND_ROWS = 1 << 1
+CLIENT_LONG_FLAG = 1 << 2
+CLIENT_CONNECT_WITH_DB = 1 << 3
+CLIENT_LOCAL_FILES = 1 << 7
+CLIENT_IGNORE_SPACE = 1 << 8
+CLIENT_PROTOCOL_41 = 1 << 9
+CLIENT_INTERACTIVE = 1 << 10
+CLIENT_SSL = 1 << 11
+CLIENT_TRANSACTIONS = 1 << 13
+CLIENT_SECURE_CONNECTION = 1 << 15
+CLIENT_MULTI_STATEMENTS = 1 << 16
+CLIENT_MULTI_RESULTS = 1 << 17
+CLIENT_PS_MULTI_RESULTS = 1 << 18
+CLIENT_PLUGIN_AUTH = 1 << 19
+CLIENT_CONNECT_ATTRS = 1 << 20
+CLIENT_PLUGIN_AUTH_LENENC_CLIENT_DATA = 1 << 21
+CLIENT_SESSION_TRACK = 1 << 23
+CLIENT_DEPRECATE_EOF = 1 << 24
+
+# Flags that change the command phase; a pooled backend connection can only
+# serve a client that negotiated the same set.
+SESSION_CAPABILITIES = (
+    CLIENT_PROTOCOL_41
+    | CLIENT_FOUND_ROWS
+    | CLIENT_LONG_FLAG
+    | CLIENT_LOCAL_FILES
+    | CLIENT_IGNORE_SPACE
+    | CLIENT_INTERACTIVE
+    | CLIENT_TRANSACTIONS
+    | CLIENT_MULTI_STATEMENTS
+    | CLIENT_MULTI_RESULTS
+    | CLIENT_PS_MULTI_RESULTS
+    | CLIENT_SESSION_TRACK
+    | CLIENT_DEPRECATE_EOF
+)
+LOGIN_CAPABILITIES = (
+    CLIENT_LONG_PASSWORD
+    | CLIENT_SECURE_CONNECTION
+    | CLIENT_PLUGIN_AUTH
+    | CLIENT_PLUGIN_AUTH_LENENC_CLIENT_DATA
+)
+# No CLIENT_SSL (clients talk to the proxy in plain text) and no compression.
+PROXY_CAPABILITIES = SESSION_CAPABILITIES | LOGIN_CAPABILITIES | CLIENT_CONNECT_WITH_DB | CLIENT_CONNECT_ATTRS
+
+COM_QUIT = 0x01
+COM_INIT_DB = 0x02
+COM_PING = 0x0E
+COM_CHANGE_USER = 0x11
+COM_RESET_CONNECTION = 0x1F
+
+CHARSET_UTF8MB4 = 255
+SERVER_STATUS_AUTOCOMMIT = 0x0002
+MAX_PACKET = 1 << 24
+SERVER_VERSION = "8.0.0-sqllab-proxy"
+
+ER_ACCESS_DENIED = 1045
+ER_NOT_SUPPORTED_AUTH_MODE = 1251
+CR_CONN_HOST_ERROR = 2003
+CR_MALFORMED_PACKET = 2027
+
+
+class ProxyError(Exception):
+    # Sent to the client as an ERR packet.
+    def __init__(self, errno: int, message: str, sqlstate: str = "HY000"):
+        super().__init__(message)
+        self.errno = errno
+        self.message = message
+        self.sqlstate = sqlstate
+
+
+# -------------------------------
+# Packet helpers
+# -------------------------------
+async def read_packet(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    header = await reader.readexactly(4)
+    return header[3], await reader.readexactly(int.from_bytes(header[:3], "little"))
+
+
+def write_packet(writer: asyncio.StreamWriter, seq: int, payload: bytes) -> None:
+    writer.write(len(payload).to_bytes(3, "little") + bytes([seq & 0xFF]) + payload)
+
+
+def lenenc_int(n: int) -> bytes:
+    if n < 251:
+        return bytes([n])
+    if n < 1 << 16:
+        return b"\xfc" + n.to_bytes(2, "little")
+    if n < 1 << 24:
+        return b"\xfd" + n.to_bytes(3, "little")
+    return b"\xfe" + n.to_bytes(8, "little")
+
+
+def read_lenenc_int(data: bytes, pos: int) -> Tuple[int, int]:
+    first = data[pos]
+    if first < 0xFB:
+        return first, pos + 1
+    size = {0xFC: 2, 0xFD: 3, 0xFE: 8}[first]
+    return int.from_bytes(data[pos + 1 : pos + 1 + size], "little"), pos + 1 + size
+
+
+def read_nul(data: bytes, pos: int) -> Tuple[bytes, int]:
+    end = data.index(b"\0", pos)
+    return data[pos:end], end + 1
+
+
+def err_packet(e: ProxyError) -> bytes:
+    return b"\xff" + struct.pack("<H", e.errno) + b"#" + e.sqlstate.encode() + e.message.encode()
+
+
+def parse_err(data: bytes) -> ProxyError:
+    errno = struct.unpack_from("<H", data, 1)[0]
+    if data[3:4] == b"#":
+        return ProxyError(errno, data[9:].decode(errors="replace"), data[4:9].decode())
+    return ProxyError(errno, data[3:].decode(errors="replace"))
+
+
+def ok_packet(client_flags: int) -> bytes:
+    payload = b"\x00\x00\x00" + struct.pack("<HH", SERVER_STATUS_AUTOCOMMIT, 0)
+    # With session tracking the (empty) info string is length-encoded.
+    return payload + (b"\x00" if client_flags & CLIENT_SESSION_TRACK else b"")
+
+
+# -------------------------------
+# Authentication
+# -------------------------------
+def make_nonce() -> bytes:
+    alphabet = string.ascii_letters + string.digits
+    return "".join(secrets.choice(alphabet) for _ in range(20)).encode()
+
+
+def scramble(plugin: str, password: bytes, nonce: bytes) -> bytes:
+    if not password:
+        return b""
+    if plugin == "mysql_native_password":
+        p1 = hashlib.sha1(password).digest()
+        p3 = hashlib.sha1(nonce + hashlib.sha1(p1).digest()).digest()
+    elif plugin == "caching_sha2_password":
+        p1 = hashlib.sha256(password).digest()
+        p3 = hashlib.sha256(hashlib.sha256(p1).digest() + nonce).digest()
+    else:
+        raise ProxyError(ER_NOT_SUPPORTED_AUTH_MODE, f"Authentication plugin {plugin} not supported")
+    return bytes(a ^ b for a, b in zip(p1, p3))
+
+
+def greeting_packet(conn_id: int, nonce: bytes) -> bytes:
+    return (
+        b"\x0a"
+        + SERVER_VERSION.encode()
+        + b"\0"
+        + struct.pack("<I", conn_id)
+        + nonce[:8]
+        + b"\0"
+        + struct.pack(
+            "<HBHH",
+            PROXY_CAPABILITIES & 0xFFFF,
+            CHARSET_UTF8MB4,
+            SERVER_STATUS_AUTOCOMMIT,
+            PROXY_CAPABILITIES >> 16,
+        )
+        + bytes([len(nonce) + 1])
+        + b"\0" * 10
+        + nonce[8:]
+        + b"\0"
+        + b"caching_sha2_password\0"
+    )
+
+
+def parse_handshake_response(data: bytes) -> Dict:
+    flags, _, charset = struct.unpack_from("<IIB", data)
+    if len(data) == 32 and flags & CLIENT_SSL:
+        raise ProxyError(ER_NOT_SUPPORTED_AUTH_MODE, "The MySQL proxy does not support TLS; connect without SSL")
+    user, pos = read_nul(data, 32)
+    if flags & CLIENT_PLUGIN_AUTH_LENENC_CLIENT_DATA:
+        n, pos = read_lenenc_int(data, pos)
+        auth, pos = data[pos : pos + n], pos + n
+    elif flags & CLIENT_SECURE_CONNECTION:
+        n = data[pos]
+        auth, pos = data[pos + 1 : pos + 1 + n], pos + 1 + n
+    else:
+        auth, pos = read_nul(data, pos)
+    database = None
+    if flags & CLIENT_CONNECT_WITH_DB and pos < len(data):
+        db, pos = read_nul(data, pos)
+        database = db.decode() or None
+    plugin = "mysql_native_password"
+    if flags & CLIENT_PLUGIN_AUTH and pos < len(data):
+        name, pos = read_nul(data, pos)
+        plugin = name.decode() or plugin
+    return {
+        "flags": flags,
+        "charset": charset,
+        "user": user.decode(errors="replace"),
+        "auth": auth,
+        "database": database,
+        "plugin": plugin,
+    }
+
+
+def parse_greeting(data: bytes) -> Dict:
+    if data[:1] == b"\xff":
+        raise parse_err(data)
+    pos = data.index(b"\0", 1) + 1 + 4  # server version, connection id
+    nonce = data[pos : pos + 8]
+    pos += 9
+    caps, _, _, caps_high = struct.unpack_from("<HBHH", data, pos)
+    pos += 7
+    caps |= caps_high << 16
+    pos += 1 + 10  # auth data length, reserved
+    nonce += data[pos : pos + 12]
+    pos += 13
+    plugin = "mysql_native_password"
+    if caps & CLIENT_PLUGIN_AUTH and pos < len(data):
+        plugin = read_nul(data, pos)[0].decode()
+    return {"caps": caps, "nonce": nonce, "plugin": plugin}
+
+
+# -------------------------------
+# Backend connections
+# -------------------------------
+class Backend:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    async def command(self, payload: bytes) -> bytes:
+        write_packet(self.writer, 0, payload)
+        await self.writer.drain()
+        return (await read_packet(self.reader))[1]
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+async def open_backend(
+    route: Dict,
+    client_flags: int,
+    charset: int,
+    database: Optional[str],
+    tls: Optional[ssl.SSLContext],
+    timeout: float,
+) -> Backend:
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(route["host"], route["port"]), timeout)
+    backend = Backend(reader, writer)
+    try:
+        await asyncio.wait_for(login(backend, route, client_flags, charset, database, tls), timeout)
+    except BaseException:
+        backend.close()
+        raise
+    return backend
+
+
+async def login(
+    b: Backend,
+    route: Dict,
+    client_flags: int,
+    charset: int,
+    database: Optional[str],
+    tls: Optional[ssl.SSLContext],
+) -> None:
+    seq, data = await read_packet(b.reader)
+    server = parse_greeting(data)
+    flags = (client_flags & SESSION_CAPABILITIES) | LOGIN_CAPABILITIES
+    if database:
+        flags |= CLIENT_CONNECT_WITH_DB
+    flags &= server["caps"]
+    secure = tls is not None and bool(server["caps"] & CLIENT_SSL)
+    if secure:
+        flags |= CLIENT_SSL
+        seq += 1
+        write_packet(b.writer, seq, struct.pack("<IIB23x", flags, MAX_PACKET, charset))
+        await b.writer.drain()
+        await b.writer.start_tls(tls)
+    password = route["password"].encode()
+    plugin = server["plugin"]
+    auth = scramble(plugin, password, server["nonce"])
+    payload = (
+        struct.pack("<IIB23x", flags, MAX_PACKET, charset)
+        + route["user"].encode()
+        + b"\0"
+        + lenenc_int(len(auth))
+        + auth
+        + (database.encode() + b"\0" if database else b"")
+        + plugin.encode()
+        + b"\0"
+    )
+    seq += 1
+    write_packet(b.writer, seq, payload)
+    await b.writer.drain()
+    while True:
+        seq, data = await read_packet(b.reader)
+        kind = data[:1]
+        if kind == b"\x00":
+            return
+        if kind == b"\xff":
+            raise parse_err(data)
+        if kind == b"\xfe":  # auth switch
+            name, pos = read_nul(data, 1)
+            plugin = name.decode()
+            response = scramble(plugin, password, data[pos:].rstrip(b"\0"))
+        elif kind == b"\x01" and plugin == "caching_sha2_password" and data[1:2] == b"\x03":
+            continue  # fast auth succeeded, OK follows
+        elif kind == b"\x01" and plugin == "caching_sha2_password" and data[1:2] == b"\x04":
+            if not secure:
+                raise ProxyError(ER_ACCESS_DENIED, "Backend needs caching_sha2_password full auth over TLS")
+            response = password + b"\0"
+        else:
+            raise ProxyError(CR_MALFORMED_PACKET, "Unexpected packet during backend authentication")
+        write_packet(b.writer, seq + 1, response)
+        await b.writer.drain()
+
+
+# -------------------------------
+# Proxy server
+# -------------------------------
+class MySQLProxy:
+    def __init__(
+        self,
+        authenticate: Callable[[str], Optional[str]],
+        route: Callable[[str], Dict],
+        host: str = "0.0.0.0",
+        port: int = 6033,
+        pool_size: int = 4,
+        pool_idle: float = 30,
+        connect_timeout: float = 10,
+    ):
+        # authenticate(username) -> the password the client must present, or
+        # None for unknown users. route(username) -> {"host", "port", "user",
+        # "password"} of the server to log in to; may block (e.g. resuming a
+        # stopped container) and may raise ProxyError.
+        self.authenticate = authenticate
+        self.route = route
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.pool_idle = pool_idle
+        self.connect_timeout = connect_timeout
+        self.tls = ssl.create_default_context()
+        # Backends sit on a private network with self-signed server certs.
+        self.tls.check_hostname = False
+        self.tls.verify_mode = ssl.CERT_NONE
+        self._pool: Dict[Tuple, Deque[Backend]] = defaultdict(deque)
+        self._ids = itertools.count(1)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+        self.active = 0
+        self.counters = {
+            "connections": 0,
+            "auth_failures": 0,
+            "backend_errors": 0,
+            "pool_hits": 0,
+            "pool_misses": 0,
+            "pool_resets": 0,
+        }
+
+    def stats(self) -> Dict:
+        return {
+            "port": self.port,
+            "active": self.active,
+            "pooled": sum(len(conns) for conns in self._pool.values()),
+            **self.counters,
+        }
+
+    def run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._stopped = asyncio.Event()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._loop.close()
+
+    def stop(self) -> None:
+        if self._loop and self._stopped:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _serve(self) -> None:
+        server = await asyncio.start_server(self._handle_client, self.host, self.port, reuse_address=True)
+        logger.info("MySQL proxy listening on %s:%d", self.host, self.port)
+        reaper = asyncio.create_task(self._reap())
+        async with server:
+            await self._stopped.wait()
+        reaper.cancel()
+        for conns in self._pool.values():
+            while conns:
+                conns.pop().close()
+
+    async def _reap(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.pool_idle / 2, 1))
+            cutoff = time.monotonic() - self.pool_idle
+            for conns in self._pool.values():
+                while conns and conns[0].last_used < cutoff:
+                    conns.popleft().close()
+
+    def _checkin(self, key: Tuple, b: Backend) -> None:
+        conns = self._pool[key]
+        if len(conns) >= self.pool_size or b.closed:
+            b.close()
+            return
+        b.last_used = time.monotonic()
+        conns.append(b)
+
+    async def _checkout(self, key: Tuple, route: Dict, hs: Dict) -> Backend:
+        conns = self._pool[key]
+        probe = bytes([COM_INIT_DB]) + hs["database"].encode() if hs["database"] else bytes([COM_PING])
+        while conns:
+            b = conns.pop()
+            if b.closed:
+                b.close()
+                continue
+            try:
+                response = await asyncio.wait_for(b.command(probe), self.connect_timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                b.close()
+                continue
+            if response[:1] == b"\xff":
+                self._checkin(key, b)
+                raise parse_err(response)
+            self.counters["pool_hits"] += 1
+            return b
+        self.counters["pool_misses"] += 1
+        try:
+            return await open_backend(
+                route, hs["flags"], hs["charset"], hs["database"], self.tls, self.connect_timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            self.counters["backend_errors"] += 1
+            raise ProxyError(CR_CONN_HOST_ERROR, f"Can't connect to MySQL server for {hs['user']}: {e}")
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.counters["connections"] += 1
+        self.active += 1
+        loop = asyncio.get_running_loop()
+        seq = 0
+        try:
+            nonce = make_nonce()
+            write_packet(writer, 0, greeting_packet(next(self._ids), nonce))
+            await writer.drain()
+            seq, data = await asyncio.wait_for(read_packet(reader), self.connect_timeout)
+            seq += 1
+            hs = parse_handshake_response(data)
+            expected = await loop.run_in_executor(None, self.authenticate, hs["user"])
+            plugin, auth = hs["plugin"], hs["auth"]
+            if plugin not in ("mysql_native_password", "caching_sha2_password"):
+                write_packet(writer, seq, b"\xfecaching_sha2_password\0" + nonce + b"\0")
+                await writer.drain()
+                seq, auth = await asyncio.wait_for(read_packet(reader), self.connect_timeout)
+                seq += 1
+                plugin = "caching_sha2_password"
+            if expected is None or not hmac.compare_digest(auth, scramble(plugin, expected.encode(), nonce)):
+                self.counters["auth_failures"] += 1
+                raise ProxyError(ER_ACCESS_DENIED, f"Access denied for user '{hs['user']}'", "28000")
+            if plugin == "caching_sha2_password":
+                write_packet(writer, seq, b"\x01\x03")  # fast auth success
+                seq += 1
+
+            route = await loop.run_in_executor(None, self.route, hs["user"])
+            key = (
+                hs["user"],
+                route["host"],
+                route["port"],
+                route["user"],
+                hs["flags"] & SESSION_CAPABILITIES,
+                hs["charset"],
+            )
+            backend = await self._checkout(key, route, hs)
+            write_packet(writer, seq, ok_packet(hs["flags"]))
+            await writer.drain()
+            if await self._relay(reader, writer, backend) and await self._reset(backend):
+                self._checkin(key, backend)
+            else:
+                backend.close()
+        except ProxyError as e:
+            try:
+                write_packet(writer, seq, err_packet(e))
+                await writer.drain()
+            except OSError:
+                pass
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            logger.exception("MySQL proxy session failed: %s", e)
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def _relay(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, backend: Backend
+    ) -> bool:
+        # True if the client ended with COM_QUIT, leaving the backend reusable.
+        async def client_to_backend() -> bool:
+            while True:
+                header = await reader.readexactly(4)
+                payload = await reader.readexactly(int.from_bytes(header[:3], "little"))
+                # Sequence 0 starts a command; later packets (continuations,
+                # LOAD DATA LOCAL content) are passed through untouched.
+                if header[3] == 0 and payload[:1] == bytes([COM_QUIT]):
+                    return True
+                if header[3] == 0 and payload[:1] == bytes([COM_CHANGE_USER]):
+                    error = ProxyError(ER_NOT_SUPPORTED_AUTH_MODE, "COM_CHANGE_USER is not supported by the proxy")
+                    write_packet(writer, 1, err_packet(error))
+                    await writer.drain()
+                    continue
+                backend.writer.write(header + payload)
+                await backend.writer.drain()
+
+        async def backend_to_client() -> bool:
+            while True:
+                chunk = await backend.reader.read(65536)
+                if not chunk:
+                    return False
+                writer.write(chunk)
+                await writer.drain()
+
+        upstream = asyncio.create_task(client_to_backend())
+        downstream = asyncio.create_task(backend_to_client())
+        done, pending = await asyncio.wait({upstream, downstream}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            task.exception()  # a dropped connection on either side just ends the session
+        return upstream in done and upstream.exception() is None and upstream.result()
+
+    async def _reset(self, backend: Backend) -> bool:
+        try:
+            response = await asyncio.wait_for(backend.command(bytes([COM_RESET_CONNECTION])), self.connect_timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return False
+        self.counters["pool_resets"] += 1
+        return response[:1] == b"\x00"
@@ -1,24 +1,40 @@
 import streamlit as st
 from streamlit_ace import st_ace
 import pandas as pd
-import requests
-import mysql.connector
+import contextvars
+import json
 import re
+import threading
+import time
+import uuid
+
+import tracing
 
 # -------------------------------
 # Config from secrets.toml
 # -------------------------------
 BACKEND_URL = st.secrets["BACKEND_URL"]
-BACKEND_IP = st.secrets["BACKEND_IP"]
-MYSQL_ROOT_PASSWORD = st.secrets["MYSQL_PASSWORD"]
 TABLE_PREVIEW_LIMIT = 20
+QUERY_TIMEOUTS = [5, 10, 30]  # seconds; the backend caps this with SQL_QUERY_TIMEOUT
+JOB_POLL_TIMEOUT = 120
+DETAIL_FIELDS = [
+    "is_admin", "container_name", "host_port", "suspended", "desired_state", "idle_stopped_at",
+    "idle_reclaimed_bytes", "tier", "mem_limit_mb", "cpus", "pids_limit", "host", "mode",
+    "shared_instance", "mysql_user", "container_status",
+]
+DETAIL_DEFAULT_FIELDS = ["host", "host_port", "suspended", "mode", "tier", "container_status"]
+
+# Backend calls go through a session that records a span per request and
+# sends its traceparent, so console queries can be followed end to end.
+tracing.SERVICE = tracing.SERVICE or "streamlit"
+http = tracing.traced_session()
 
 # -------------------------------
 # Backend API helpers
 # -------------------------------
 def register_user(username, password):
     try:
-        resp = requests.post(
+        resp = http.post(
             f"{BACKEND_URL}/auth/register/",
             json={"username": username, "password": password}
         )
@@ -28,7 +44,7 @@ def register_user(username, password):
 
 def login_user(username, password):
     try:
-        resp = requests.post(
+        resp = http.post(
             f"{BACKEND_URL}/auth/login/",
             json={"username": username, "password": password}
         )
@@ -38,29 +54,92 @@ def login_user(username, password):
     except:
         return None
 
+def get_job_status(token, job_id):
+    try:
+        return http.get(
+            f"{BACKEND_URL}/jobs/{job_id}/",
+            headers={"x-token": token}
+        ).json()
+    except:
+        return {"error": "Could not connect to backend"}
+
+def wait_for_job(token, job_id, timeout=JOB_POLL_TIMEOUT):
+    deadline = time.time() + timeout
+    job = {}
+    while time.time() < deadline:
+        job = get_job_status(token, job_id)
+        if "error" in job or job.get("status") in ("ready", "failed"):
+            break
+        time.sleep(1)
+    return job
+
 def get_user_container(token):
     try:
-        resp = requests.post(
+        resp = http.post(
             f"{BACKEND_URL}/register_user/",
             headers={"x-token": token}
         )
-        return resp.json()
+        info = resp.json()
+    except:
+        return {"error": "Could not connect to backend"}
+    if resp.status_code == 429:
+        return {"message": info["detail"]}
+    if "job_id" not in info:
+        return info
+    with st.spinner("Provisioning your MySQL container..."):
+        job = wait_for_job(token, info["job_id"])
+    if job.get("status") == "ready":
+        return {
+            "message": f"MySQL container ready on port {job['port']}",
+            "host_port": job["port"],
+            **{k: job.get(k) for k in ("host", "user", "password", "database")},
+        }
+    if job.get("status") == "failed":
+        return {"message": f"Container provisioning failed: {job.get('error')}"}
+    return {"message": f"Container provisioning is {job.get('status', 'pending')}, try again shortly"}
+
+def get_with_etag(token, path, params=None):
+    # Listings are fetched on every rerun; the backend answers 304 while the
+    # copy kept in the session is still current.
+    cache = st.session_state.setdefault("etag_cache", {})
+    key = (path, json.dumps(params or {}, sort_keys=True))
+    etag, body = cache.get(key, (None, None))
+    headers = {"x-token": token}
+    if etag:
+        headers["If-None-Match"] = etag
+    resp = http.get(f"{BACKEND_URL}{path}", headers=headers, params=params)
+    if resp.status_code == 304:
+        return body
+    body = resp.json()
+    if resp.status_code == 200 and resp.headers.get("ETag"):
+        cache[key] = (resp.headers["ETag"], body)
+    return body
+
+def admin_list_users(token, **params):
+    try:
+        return get_with_etag(token, "/admin/list_user/", params)
     except:
         return {"error": "Could not connect to backend"}
 
-def admin_list_users(token):
+def admin_all_usernames(token):
+    users, cursor = [], None
+    while True:
+        page = admin_list_users(token, **({"cursor": cursor} if cursor else {}))
+        users += page.get("users", [])
+        cursor = page.get("next_cursor")
+        if not cursor:
+            return users
+
+def admin_list_users_detailed(token, **params):
     try:
-        return requests.get(
-            f"{BACKEND_URL}/admin/list_user/",
-            headers={"x-token": token}
-        ).json()
+        return get_with_etag(token, "/admin/list_users_detailed/", params)
     except:
         return {"error": "Could not connect to backend"}
 
-def admin_list_users_detailed(token):
+def admin_idle_summary(token):
     try:
-        return requests.get(
-            f"{BACKEND_URL}/admin/list_users_detailed/",
+        return http.get(
+            f"{BACKEND_URL}/admin/idle/",
             headers={"x-token": token}
         ).json()
     except:
@@ -68,7 +147,7 @@ def admin_list_users_detailed(token):
 
 def admin_action(token, action, username):
     try:
-        return requests.post(
+        return http.post(
             f"{BACKEND_URL}/admin/{action}/",
             headers={"x-token": token},
             json={"username": username}
@@ -76,89 +155,173 @@ def admin_action(token, action, username):
     except:
         return {"error": "Could not connect to backend"}
 
-def admin_get_logs(token, username):
+def admin_bulk_action(token, action, usernames, stop_timeout):
     try:
-        return requests.get(
-            f"{BACKEND_URL}/admin/container_logs/",
+        return http.post(
+            f"{BACKEND_URL}/admin/bulk/{action}/",
             headers={"x-token": token},
-            params={"username": username}
+            json={"usernames": usernames, "stop_timeout": stop_timeout}
         ).json()
     except:
         return {"error": "Could not connect to backend"}
 
-# -------------------------------
-# MySQL helpers
-# -------------------------------
-def run_sql_query(host, port, sql, database=None):
+def admin_get_logs(token, username, **params):
+    # params: tail, cursor (newer than), until (older than); returns [{"ts", "line"}]
     try:
-        conn = mysql.connector.connect(
-            host=host,
-            port=port,
-            user="root",
-            password=MYSQL_ROOT_PASSWORD,
-            database=database if database else None
-        )
-        cursor = conn.cursor()
-        cursor.execute(sql)
-
-        if cursor.with_rows:
-            rows = cursor.fetchall()
-            columns = [d[0] for d in cursor.description]
-            return {"type": "table", "columns": columns, "rows": rows}
-        else:
-            conn.commit()
-            return {"type": "message", "message": f"{cursor.rowcount} rows affected."}
-    except Exception as e:
-        return {"type": "error", "message": str(e)}
+        with http.get(
+            f"{BACKEND_URL}/admin/container_logs/stream/",
+            headers={"x-token": token},
+            params={"username": username, **params},
+            stream=True,
+        ) as resp:
+            if resp.status_code != 200:
+                return {"error": resp.json().get("detail", resp.text)}
+            return {"records": [json.loads(line) for line in resp.iter_lines() if line]}
+    except:
+        return {"error": "Could not connect to backend"}
 
-def get_databases(host, port):
+def admin_stats(token, sort, top):
     try:
-        conn = mysql.connector.connect(
-            host=host, port=port, user="root", password=MYSQL_ROOT_PASSWORD
-        )
-        cursor = conn.cursor()
-        cursor.execute("SHOW DATABASES;")
-        return [r[0] for r in cursor.fetchall()]
+        return http.get(
+            f"{BACKEND_URL}/admin/stats/",
+            headers={"x-token": token},
+            params={"sort": sort, "top": top}
+        ).json()
     except:
-        return []
+        return {"error": "Could not connect to backend"}
 
-def get_tables(host, port, db):
+def admin_log_summary(token):
     try:
-        conn = mysql.connector.connect(
-            host=host, port=port, user="root",
-            password=MYSQL_ROOT_PASSWORD, database=db
-        )
-        cursor = conn.cursor()
-        cursor.execute("SHOW TABLES;")
-        return [r[0] for r in cursor.fetchall()]
+        return http.get(
+            f"{BACKEND_URL}/admin/logs/summary/",
+            headers={"x-token": token}
+        ).json()
     except:
-        return []
+        return {"error": "Could not connect to backend"}
 
-def get_columns(host, port, db, table):
+def admin_search_logs(token, **params):
     try:
-        conn = mysql.connector.connect(
-            host=host, port=port, user="root",
-            password=MYSQL_ROOT_PASSWORD, database=db
-        )
-        cursor = conn.cursor()
-        cursor.execute(f"DESCRIBE {table};")
-        return [r[0] for r in cursor.fetchall()]
+        return http.get(
+            f"{BACKEND_URL}/admin/logs/search/",
+            headers={"x-token": token},
+            params={k: v for k, v in params.items() if v}
+        ).json()
     except:
-        return []
+        return {"error": "Could not connect to backend"}
 
-def preview_table(host, port, db, table, limit=TABLE_PREVIEW_LIMIT):
+# -------------------------------
+# SQL helpers (executed by the backend)
+# -------------------------------
+def sql_error_message(error):
+    if error.get("reason") == "timeout":
+        return "Query timed out and was stopped."
+    if error.get("reason") == "cancelled":
+        return "Query cancelled."
+    return error.get("message", str(error))
+
+def execute_sql(token, sql, database=None, max_rows=None, query_id=None, timeout=None):
+    # Streams NDJSON: a "columns" line, "rows" batches, then "done" or "error".
     try:
-        conn = mysql.connector.connect(
-            host=host, port=port, user="root",
-            password=MYSQL_ROOT_PASSWORD, database=db
+        resp = http.post(
+            f"{BACKEND_URL}/sql/execute/",
+            headers={"x-token": token},
+            json={
+                "sql": sql, "database": database, "max_rows": max_rows,
+                "query_id": query_id, "timeout": timeout,
+            },
+            stream=True,
         )
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT * FROM {table} LIMIT {limit};")
-        rows = cursor.fetchall()
-        columns = [d[0] for d in cursor.description]
-        return rows, columns
     except Exception as e:
-        return None, str(e)
+        return {"type": "error", "message": str(e)}
+    with resp:
+        if resp.status_code != 200:
+            detail = resp.json().get("detail", resp.text)
+            return {"type": "error", "message": sql_error_message(detail) if isinstance(detail, dict) else str(detail)}
+        if resp.headers.get("content-type", "").startswith("application/json"):
+            result = resp.json()
+            return {**result, "message": f"{result['rowcount']} rows affected."}
+        result = {"type": "table", "columns": [], "rows": []}
+        for line in resp.iter_lines():
+            record = json.loads(line)
+            if record["type"] == "columns":
+                result.update(columns=record["columns"], resume_ms=record.get("resume_ms"))
+            elif record["type"] == "rows":
+                result["rows"].extend(record["rows"])
+            elif record["type"] == "done":
+                result["truncated"] = record["truncated"]
+            else:
+                return {"type": "error", "message": sql_error_message(record)}
+        return result
+
+def cancel_sql(token, query_id):
+    try:
+        return http.post(
+            f"{BACKEND_URL}/sql/cancel/",
+            headers={"x-token": token},
+            json={"query_id": query_id}
+        ).json()
+    except:
+        return {"error": "Could not connect to backend"}
+
+def run_sql_query(token, sql, database=None, timeout=None):
+    # The request runs on a worker thread while this script keeps touching
+    # the page, so a Cancel click can interrupt it with a rerun; the rerun
+    # finds the query id in the session and cancels it on the backend.
+    query_id = uuid.uuid4().hex
+    st.session_state["running_query_id"] = query_id
+    result = {}
+    # The worker runs in a copy of this context to stay inside the current span.
+    worker = threading.Thread(
+        target=contextvars.copy_context().run,
+        args=(lambda: result.update(execute_sql(token, sql, database, query_id=query_id, timeout=timeout)),),
+        daemon=True,
+    )
+    started = time.time()
+    worker.start()
+    status = st.empty()
+    while worker.is_alive():
+        status.caption(f"Running query... {time.time() - started:.0f}s")
+        worker.join(0.25)
+    status.empty()
+    st.session_state.pop("running_query_id", None)
+    if result.get("resume_ms") is not None:
+        st.session_state["resume_ms"] = result["resume_ms"]
+    return result
+
+def schema_query(token, sql, db=None):
+    # The explorer's queries are kept for the session and dropped after each
+    # console statement, rather than spending the rate-limited SQL budget
+    # on every rerun. Errors (including 429s) are not kept.
+    cache = st.session_state.setdefault("schema_cache", {})
+    key = (db, sql)
+    if key in cache:
+        return cache[key]
+    result = execute_sql(token, sql, db)
+    if result["type"] != "error":
+        cache[key] = result
+    return result
+
+def schema_names(token, sql, db=None):
+    result = schema_query(token, sql, db)
+    if result["type"] == "error":
+        st.warning(result["message"])
+        return []
+    return [r[0] for r in result["rows"]] if result["type"] == "table" else []
+
+def get_databases(token):
+    return schema_names(token, "SHOW DATABASES;")
+
+def get_tables(token, db):
+    return schema_names(token, "SHOW TABLES;", db)
+
+def get_columns(token, db, table):
+    return schema_names(token, f"DESCRIBE `{table}`;", db)
+
+def preview_table(token, db, table, limit=TABLE_PREVIEW_LIMIT):
+    result = schema_query(token, f"SELECT * FROM `{table}` LIMIT {limit};", db)
+    if result["type"] != "table":
+        return None, result["message"]
+    return result["rows"], result["columns"]
 
 # -------------------------------
 # Streamlit UI
@@ -241,7 +404,7 @@ if st.session_state["token"]:
         # Clear session state fully
         for key in [
             "token", "username", "container_info",
-            "query_history", "selected_db",
+            "query_history", "selected_db", "user_db_ready", "schema_cache",
             "login_user", "login_pass",
             "reg_user", "reg_pass",
         ]:
@@ -271,14 +434,23 @@ if st.session_state["token"]:
 
         if host_port:
             st.success(f"MySQL container running on port: {host_port}")
+            if container_info.get("resumed"):
+                st.info(f"Your stopped container was resumed in {container_info['resume_ms']} ms")
+                container_info["resumed"] = False
 
             # ---------------- SQL Console ----------------
             st.subheader("SQL Console")
 
-            # Ensure user database exists and is used
+            # Set when a rerun (a Cancel click or any other widget) interrupted
+            # run_sql_query; read before this run issues any SQL of its own.
+            interrupted_query_id = st.session_state.pop("running_query_id", None)
+
+            # Ensure user database exists and is used, once per session
             user_db = username
-            create_db_query = f"CREATE DATABASE IF NOT EXISTS `{user_db}`;"
-            run_sql_query(BACKEND_IP, host_port, create_db_query)
+            if st.session_state.get("user_db_ready") != user_db:
+                create_db_query = f"CREATE DATABASE IF NOT EXISTS `{user_db}`;"
+                if execute_sql(token, create_db_query)["type"] != "error":
+                    st.session_state["user_db_ready"] = user_db
             st.session_state["selected_db"] = user_db
 
             # Initialize query history if not exists
@@ -317,6 +489,14 @@ if st.session_state["token"]:
                 placeholder="Write your SQL query here...",
             )
 
+            c1, c2 = st.columns([1, 3])
+            query_timeout = c1.selectbox("Timeout (s)", QUERY_TIMEOUTS, index=len(QUERY_TIMEOUTS) - 1)
+            if c2.button("⏹ Cancel running query"):
+                if interrupted_query_id and cancel_sql(token, interrupted_query_id).get("cancelled"):
+                    st.warning("Query cancelled.")
+                else:
+                    st.info("No query is running.")
+
             # Protected databases
             protected_dbs = ["mysql", "information_schema", "performance_schema", "sys", username]
 
@@ -328,25 +508,34 @@ if st.session_state["token"]:
                 if drop_db_match and drop_db_match.group(1) in protected_dbs:
                     st.error(f"Cannot drop protected database: `{drop_db_match.group(1)}`")
                 else:
-                    result = run_sql_query(
-                        BACKEND_IP,
-                        host_port,
-                        sql_query,
-                        st.session_state.get("selected_db")
-                    )
-
-                    # Append to query history
+                    # Recorded first so a Cancel rerun doesn't execute it again
                     st.session_state["query_history"].append(sql_query)
                     st.session_state["last_executed_sql"] = sql_query
 
-                    # Display results
-                    if result["type"] == "table":
-                        df = pd.DataFrame(result["rows"], columns=result["columns"])
-                        st.dataframe(df, use_container_width=True)
-                    elif result["type"] == "message":
-                        st.success(result["message"])
-                    else:
-                        st.error(result["message"])
+                    with tracing.span("console.query", user=st.session_state["username"]) as span:
+                        result = run_sql_query(
+                            token,
+                            sql_query,
+                            st.session_state.get("selected_db"),
+                            timeout=query_timeout,
+                        )
+                        span.set(result=result["type"], rows=len(result.get("rows", [])))
+                        st.session_state.pop("schema_cache", None)
+
+                        # Display results
+                        with tracing.span("console.render"):
+                            resume_ms = st.session_state.pop("resume_ms", None)
+                            if resume_ms is not None:
+                                st.info(f"Your stopped container was resumed in {resume_ms} ms")
+                            if result["type"] == "table":
+                                df = pd.DataFrame(result["rows"], columns=result["columns"])
+                                st.dataframe(df, use_container_width=True)
+                                if result.get("truncated"):
+                                    st.warning(f"Result truncated to {len(result['rows'])} rows ({result['truncated']} limit)")
+                            elif result["type"] == "message":
+                                st.success(result["message"])
+                            else:
+                                st.error(result["message"])
 
             # ---------------- Query History ----------------
             if st.session_state.get("query_history"):
@@ -358,7 +547,9 @@ if st.session_state["token"]:
 
             # ---------------- Database Schema Explorer ----------------
             st.subheader("Database Schema Explorer")
-            dbs = get_databases(BACKEND_IP, host_port)
+            if st.button("🔄 Refresh schema"):
+                st.session_state.pop("schema_cache", None)
+            dbs = get_databases(token)
             st.session_state["selected_db"] = st.selectbox(
                 "Select Database",
                 dbs,
@@ -367,15 +558,15 @@ if st.session_state["token"]:
 
             if st.session_state["selected_db"]:
                 selected_db = st.session_state["selected_db"]
-                tables = get_tables(BACKEND_IP, host_port, selected_db)
+                tables = get_tables(token, selected_db)
                 selected_table = st.selectbox("Select Table", tables)
                 if selected_table:
-                    columns = get_columns(BACKEND_IP, host_port, selected_db, selected_table)
+                    columns = get_columns(token, selected_db, selected_table)
                     st.write(f"Columns in `{selected_table}`:")
                     st.write(columns)
                     # Table preview
                     st.write(f"Preview of `{selected_table}` (first {TABLE_PREVIEW_LIMIT} rows):")
-                    rows, cols = preview_table(BACKEND_IP, host_port, selected_db, selected_table)
+                    rows, cols = preview_table(token, selected_db, selected_table)
                     if rows is not None:
                         df = pd.DataFrame(rows, columns=cols)
                         st.dataframe(df, use_container_width=True)
@@ -391,15 +582,50 @@ if st.session_state["token"]:
         # ---------------- Admin Dashboard ----------------
         st.subheader("Admin Dashboard")
         st.write(f"Hello {username}! Manage users and containers.")
-        tabs = st.tabs(["List Users", "User Details", "Manage Containers", "View Logs"])
+        idle = admin_idle_summary(token)
+        if "memory_reclaimed_bytes" in idle:
+            c1, c2 = st.columns(2)
+            c1.metric("Idle containers stopped", idle["stopped_containers"])
+            c2.metric("Memory reclaimed by idle auto-stop", f"{idle['memory_reclaimed_bytes'] / 2**20:.0f} MB")
+        tabs = st.tabs(["List Users", "User Details", "Manage Containers", "View Logs", "Log Archive", "Resources"])
         with tabs[0]:
             st.write("List of all users:")
-            users = admin_list_users(token).get("users", [])
+            users = admin_all_usernames(token)
             st.write(users)
         with tabs[1]:
-            st.write("Detailed info for all users:")
-            details = admin_list_users_detailed(token)
-            st.json(details)
+            st.write("Detailed info for users:")
+            c1, c2, c3, c4 = st.columns(4)
+            filters = {
+                "prefix": c1.text_input("Name prefix"),
+                "suspended": {"Any": None, "Yes": True, "No": False}[c2.selectbox("Suspended", ["Any", "Yes", "No"])],
+                "has_container": {"Any": None, "Yes": True, "No": False}[c3.selectbox("Has container", ["Any", "Yes", "No"])],
+                "limit": c4.number_input("Page size", min_value=10, max_value=2000, value=100, step=10),
+            }
+            c1, c2, c3 = st.columns(3)
+            filters["port_min"] = c1.number_input("Port from", min_value=0, max_value=65535, value=0) or None
+            filters["port_max"] = c2.number_input("Port to", min_value=0, max_value=65535, value=0) or None
+            fields = c3.multiselect("Fields", DETAIL_FIELDS, default=DETAIL_DEFAULT_FIELDS)
+            params = {k: v for k, v in filters.items() if v not in (None, "")}
+            if fields:
+                params["fields"] = ",".join(fields)
+            # Cursors of the pages before the current one; reset when the query changes.
+            paging = st.session_state.get("user_pages")
+            if not paging or paging["params"] != params:
+                paging = st.session_state["user_pages"] = {"params": params, "cursors": [None]}
+            cursor = paging["cursors"][-1]
+            details = admin_list_users_detailed(token, **params, **({"cursor": cursor} if cursor else {}))
+            if "users" in details:
+                st.dataframe(pd.DataFrame(details["users"]), use_container_width=True)
+                c1, c2, c3 = st.columns(3)
+                c1.caption(f"Page {len(paging['cursors'])}")
+                if len(paging["cursors"]) > 1 and c2.button("Previous page"):
+                    paging["cursors"].pop()
+                    st.rerun()
+                if details.get("next_cursor") and c3.button("Next page"):
+                    paging["cursors"].append(details["next_cursor"])
+                    st.rerun()
+            else:
+                st.json(details)
         with tabs[2]:
             st.write("Manage user containers")
             target_user = st.selectbox("Select user", [u for u in users if u != "admin"])
@@ -408,12 +634,91 @@ if st.session_state["token"]:
             if st.button("Execute"):
                 result = admin_action(token, action, target_user)
                 st.write(result)
+
+            st.write("Bulk actions")
+            bulk_users = st.multiselect("Select users", [u for u in users if u != "admin"])
+            bulk_action = st.selectbox("Bulk action", ["start", "stop", "restart", "suspend", "unsuspend", "delete"])
+            stop_timeout = st.number_input("Stop timeout (s)", min_value=0, max_value=60, value=10)
+            if st.button("Execute for selected") and bulk_users:
+                result = admin_bulk_action(token, bulk_action, bulk_users, int(stop_timeout))
+                if "results" in result:
+                    st.write(f"{result['succeeded']} succeeded, {result['failed']} failed in {result['elapsed_ms']} ms")
+                    st.dataframe(pd.DataFrame(result["results"]), use_container_width=True)
+                else:
+                    st.write(result)
         with tabs[3]:
             st.write("View container logs")
             log_user = st.selectbox("Select user for logs", [u for u in users if u != "admin"], key="loguser")
-            if st.button("Show Logs"):
-                logs = admin_get_logs(token, log_user)
-                if "logs" in logs:
-                    st.code(logs["logs"])
+            log_tail = st.number_input("Lines", min_value=10, max_value=5000, value=100, step=50)
+            c1, c2, c3 = st.columns(3)
+            shown = st.session_state.get("log_view")
+            if shown and shown["user"] != log_user:
+                shown = None
+            fetched = None
+            if c1.button("Show Logs"):
+                fetched = admin_get_logs(token, log_user, tail=log_tail)
+                shown = {"user": log_user, "records": []}
+            if c2.button("Load older") and shown and shown["records"]:
+                fetched = admin_get_logs(token, log_user, tail=log_tail, until=shown["records"][0]["ts"])
+                if "records" in fetched:
+                    shown["records"] = fetched["records"] + shown["records"]
+                    fetched = None
+            if c3.button("Load newer") and shown and shown["records"]:
+                fetched = admin_get_logs(token, log_user, cursor=shown["records"][-1]["ts"])
+            if fetched is not None:
+                if "records" in fetched:
+                    shown["records"] = shown["records"] + fetched["records"]
                 else:
-                    st.write(logs)
+                    st.write(fetched)
+            st.session_state["log_view"] = shown
+            if shown:
+                st.code("\n".join(f"{r['ts']} {r['line']}" for r in shown["records"]))
+        with tabs[4]:
+            st.write("Errors and warnings across all containers today")
+            summary = admin_log_summary(token)
+            if summary.get("users"):
+                st.dataframe(pd.DataFrame(summary["users"]), use_container_width=True)
+            else:
+                st.write(summary.get("error", "No archived logs yet"))
+            c1, c2, c3 = st.columns(3)
+            search_user = c1.selectbox("User", [""] + [u for u in users if u != "admin"], key="archive_user")
+            search_severity = c2.selectbox("Severity", ["", "error", "warning"])
+            search_text = c3.text_input("Contains")
+            if st.button("Search archive"):
+                found = admin_search_logs(token, username=search_user, severity=search_severity, q=search_text)
+                if "matches" in found:
+                    st.dataframe(pd.DataFrame(found["matches"]), use_container_width=True)
+                    if found["next_cursor"]:
+                        st.caption("More matches available; narrow the search.")
+                else:
+                    st.write(found)
+        with tabs[5]:
+            c1, c2 = st.columns(2)
+            stats_sort = c1.selectbox(
+                "Sort by",
+                ["cpu_percent", "mem_bytes", "blk_read_bps", "blk_write_bps", "net_rx_bps", "net_tx_bps"]
+            )
+            stats_top = c2.number_input("Top", min_value=1, max_value=500, value=20)
+            stats = admin_stats(token, stats_sort, int(stats_top))
+            if "containers" in stats:
+                st.caption(f"Sampled every {stats['interval']:.0f}s; averages over the last {stats['history_size']} samples")
+                st.dataframe(
+                    pd.DataFrame(
+                        [
+                            {
+                                "user": r["username"], "host": r["host"],
+                                "cpu %": r["current"]["cpu_percent"],
+                                "memory MB": round(r["current"]["mem_bytes"] / 2**20),
+                                "avg cpu %": r["avg"]["cpu_percent"],
+                                "disk read B/s": r["current"]["blk_read_bps"],
+                                "disk write B/s": r["current"]["blk_write_bps"],
+                                "net rx B/s": r["current"]["net_rx_bps"],
+                                "net tx B/s": r["current"]["net_tx_bps"],
+                            }
+                            for r in stats["containers"]
+                        ]
+                    ),
+                    use_container_width=True
+                )
+            else:
+                st.write(stats)
@@ -0,0 +1,138 @@
+"""Multi-host placement against two in-process fake Docker daemons (fake_docker.py)."""
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+STATE_DIR = tempfile.mkdtemp(prefix="sqllab-test-")
+os.environ.update(
+    {
+        "DOCKER_HOSTS": json.dumps(
+            [
+                {"name": "a", "base_url": "fake://a", "memory_budget_mb": 2048, "publish_ports": True,
+                 "port_range_start": 41000, "port_range_end": 41004},
+                {"name": "b", "base_url": "fake://b", "memory_budget_mb": 4096, "publish_ports": True,
+                 "port_range_start": 42000, "port_range_end": 42010},
+            ]
+        ),
+        "USERS_DB_FILE": os.path.join(STATE_DIR, "users.sqlite3"),
+        "LOG_ARCHIVE_DIR": os.path.join(STATE_DIR, "log_archive"),
+        "MYSQL_PROXY_PORT": "0",
+        "WARM_POOL_SIZE": "0",
+        "STATS_INTERVAL": "0",
+        "MYSQL_PREINIT": "0",
+    }
+)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import api  # noqa: E402
+
+ADMIN = {"x-token": api.ADMIN_USERNAME}
+A, B = api.docker_hosts["a"], api.docker_hosts["b"]
+
+
+def daemon(h):
+    # DockerHost wraps the client in tracing and metrics proxies.
+    return h.client._target._target._daemon
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(api.app) as c:
+        yield c
+
+
+@pytest.fixture
+def load(client):
+    # Commits memory on a host for the test and restores the budgets after;
+    # the port pools and budgets are set up at startup, hence the client.
+    saved = {h.name: dict(h.admission._committed) for h in (A, B)}
+
+    def commit(h, mb):
+        assert h.admission.reserve(f"load-{h.name}", mb)
+
+    yield commit
+    for h in (A, B):
+        h.admission.reset(saved[h.name])
+
+
+def provision(c, username):
+    c.post("/auth/register/", json={"username": username, "password": "pw"})
+    job = c.post("/register_user/", headers={"x-token": username}).json()
+    for _ in range(200):
+        status = c.get(f"/jobs/{job['job_id']}/", headers={"x-token": username}).json()
+        if status["status"] in ("ready", "failed"):
+            break
+        time.sleep(0.05)
+    assert status["status"] == "ready", status
+    return api.get_user(username)
+
+
+@pytest.mark.parametrize("strategy, expected", [("least_loaded", "b"), ("binpack", "a")])
+def test_placement_strategy(monkeypatch, load, strategy, expected):
+    monkeypatch.setattr(api, "PLACEMENT_STRATEGY", strategy)
+    load(A, 1024)  # a: 50% free, 1024 MB
+    load(B, 1024)  # b: 75% free, 3072 MB
+    assert api.place_container(None).name == expected
+
+
+@pytest.mark.parametrize("strategy", ["least_loaded", "binpack"])
+def test_placement_skips_hosts_where_the_tier_does_not_fit(monkeypatch, load, strategy):
+    monkeypatch.setattr(api, "PLACEMENT_STRATEGY", strategy)
+    load(A, 1800)
+    assert api.place_container({"tier": "standard"}).name == "b"
+    load(B, 3800)
+    # Nothing fits: queue on the host with the largest free share.
+    assert api.place_container({"tier": "standard"}).name == "a"
+
+
+def test_placement_skips_hosts_without_free_ports(client, monkeypatch):
+    monkeypatch.setattr(api, "PLACEMENT_STRATEGY", "binpack")
+    taken = []
+    while (port := A.ports.allocate()) is not None:
+        taken.append(port)
+    try:
+        assert api.place_container(None).name == "b"
+    finally:
+        for port in taken:
+            A.ports.release(port)
+
+
+def test_containers_get_ports_from_their_hosts_pool(client, monkeypatch):
+    monkeypatch.setattr(api, "PLACEMENT_STRATEGY", "least_loaded")
+    users = [provision(client, f"place{i}") for i in range(4)]
+    assert {u["host"] for u in users} == {"a", "b"}
+    for u in users:
+        h = api.docker_hosts[u["host"]]
+        assert h.ports.start <= u["host_port"] < h.ports.end
+        assert u["container_name"] in daemon(h).containers
+        other = B if h is A else A
+        assert u["container_name"] not in daemon(other).containers
+    assert len({u["host_port"] for u in users}) == len(users)
+
+
+def test_admin_actions_reach_the_users_host(client, monkeypatch):
+    monkeypatch.setattr(api, "PLACEMENT_STRATEGY", "binpack")
+    a_user = provision(client, "route_a")
+    assert a_user["host"] == "a"
+    monkeypatch.setattr(api, "PLACEMENT_STRATEGY", "least_loaded")
+    b_user = provision(client, "route_b")
+    assert b_user["host"] == "b"
+    assert api.host_of(b_user) is B
+
+    r = client.post("/admin/stop_user/", json={"username": "route_b"}, headers=ADMIN)
+    assert r.status_code == 200, r.text
+    assert daemon(B).containers[b_user["container_name"]].status == "exited"
+    assert daemon(A).containers[a_user["container_name"]].status == "running"
+
+    r = client.post("/admin/start_user/", json={"username": "route_b"}, headers=ADMIN)
+    assert r.status_code == 200, r.text
+    assert daemon(B).containers[b_user["container_name"]].status == "running"
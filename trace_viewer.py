@@ -0,0 +1,104 @@
+"""Print traces recorded by tracing.py as waterfalls.
+
+Usage: python trace_viewer.py TRACE_FILE [TRACE_FILE ...] [--trace ID] [--last 5] [--min-ms 0]
+
+Each file holds one JSON span per line; the Streamlit app and the backend
+may write to separate files, which are merged here by trace id. Every trace
+is printed as a tree of spans, indented by depth, with a bar showing where
+each span sits within the trace and how long it took:
+
+    3c9f...  412.7 ms  console.query
+      0.0    410.1  |########################| streamlit  console.query
+      1.2    398.4  | #######################| streamlit    http POST /sql/execute/
+      4.0    390.9  | #######################| backend        POST /sql/execute/
+"""
+import argparse
+import json
+from collections import defaultdict
+from typing import Dict, List
+
+BAR_WIDTH = 40
+
+
+def load_spans(paths: List[str]) -> Dict[str, List[Dict]]:
+    traces: Dict[str, List[Dict]] = defaultdict(list)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    span = json.loads(line)
+                    traces[span["trace_id"]].append(span)
+    return traces
+
+
+def ordered(spans: List[Dict]) -> List[tuple]:
+    # -> [(depth, span)] depth-first, children by start time. Spans whose
+    # parent was not recorded (another service, unsampled) become roots.
+    ids = {s["span_id"] for s in spans}
+    children: Dict[str, List[Dict]] = defaultdict(list)
+    roots = []
+    for s in sorted(spans, key=lambda s: s["start"]):
+        if s["parent_id"] in ids:
+            children[s["parent_id"]].append(s)
+        else:
+            roots.append(s)
+    result = []
+
+    def walk(span: Dict, depth: int) -> None:
+        result.append((depth, span))
+        for child in children[span["span_id"]]:
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+    return result
+
+
+def bar(offset_ms: float, duration_ms: float, total_ms: float) -> str:
+    scale = BAR_WIDTH / total_ms if total_ms else 0
+    start = min(int(offset_ms * scale), BAR_WIDTH - 1)
+    length = max(1, round(duration_ms * scale))
+    return (" " * start + "#" * length)[:BAR_WIDTH].ljust(BAR_WIDTH)
+
+
+def print_trace(trace_id: str, spans: List[Dict], min_ms: float) -> None:
+    begin = min(s["start"] for s in spans)
+    end = max(s["start"] + s["duration_ms"] / 1000 for s in spans)
+    total_ms = (end - begin) * 1000
+    rows = ordered(spans)
+    print(f"{trace_id}  {total_ms:.1f} ms  {rows[0][1]['name']}")
+    for depth, s in rows:
+        if s["duration_ms"] < min_ms:
+            continue
+        offset_ms = (s["start"] - begin) * 1000
+        error = f"  !! {s['error']}" if s.get("error") else ""
+        attrs = " ".join(f"{k}={v}" for k, v in s["attrs"].items() if v is not None)
+        print(
+            f"  {offset_ms:8.1f} {s['duration_ms']:8.1f}  |{bar(offset_ms, s['duration_ms'], total_ms)}|"
+            f" {s['service'] or '-':<10} {'  ' * depth}{s['name']}  {attrs}{error}"
+        )
+    print()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--trace", help="Only this trace id (a prefix is enough)")
+    parser.add_argument("--last", type=int, default=5, help="Show the most recent N traces")
+    parser.add_argument("--min-ms", type=float, default=0, help="Hide spans shorter than this")
+    args = parser.parse_args()
+
+    traces = load_spans(args.files)
+    if args.trace:
+        selected = [t for t in traces if t.startswith(args.trace)]
+    else:
+        selected = sorted(traces, key=lambda t: min(s["start"] for s in traces[t]))[-args.last:]
+    if not selected:
+        raise SystemExit("No matching traces")
+    for trace_id in selected:
+        print_trace(trace_id, traces[trace_id], args.min_ms)
+
+
+if __name__ == "__main__":
+    main()
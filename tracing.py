@@ -0,0 +1,202 @@
+"""Lightweight span tracing exported to a local JSONL file.
+
+Spans nest through a context variable and carry a trace id that crosses
+process boundaries in a W3C `traceparent` header, so one console click can
+be followed from the Streamlit app through the backend into Docker and
+MySQL. Each finished span is appended as one JSON object to TRACE_FILE;
+trace_viewer.py renders them as a waterfall per trace. With TRACE_FILE
+unset every span is a no-op.
+
+    with tracing.span("sql.execute", statement_bytes=120) as s:
+        ...
+        s.set(rows=10)
+"""
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence
+
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "1"))  # fraction of new traces recorded
+SERVICE = os.getenv("TRACE_SERVICE", "")
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+_write_lock = threading.Lock()
+
+
+def new_id(nbytes: int) -> str:
+    return "%0*x" % (nbytes * 2, random.getrandbits(nbytes * 8))
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attrs: Dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attrs = attrs
+        self.start = time.time()
+        self.status = "ok"
+        self.error: Optional[str] = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def rename(self, name: str) -> None:
+        self.name = name
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def finish(self) -> None:
+        if not self.sampled or not TRACE_FILE:
+            return
+        record = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "service": SERVICE,
+            "start": self.start,
+            "duration_ms": round((time.time() - self.start) * 1000, 3),
+            "status": self.status,
+            "attrs": self.attrs,
+        }
+        if self.error:
+            record["error"] = self.error
+        line = json.dumps(record, default=str) + "\n"
+        with _write_lock, open(TRACE_FILE, "a") as f:
+            f.write(line)
+
+
+def parse_traceparent(header: Optional[str]):
+    # -> (trace_id, parent span id, sampled) or None
+    parts = (header or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == "01"
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, traceparent: Optional[str] = None, root: bool = True, **attrs):
+    """Record a span around the block.
+
+    Children join the current span's trace. Otherwise a remote traceparent
+    is continued, or, if root is true, a new trace is started; with
+    root=False and nothing to join the block runs untraced.
+    """
+    parent = _current.get()
+    remote = parse_traceparent(traceparent)
+    if not TRACE_FILE:
+        s = None
+    elif parent is not None:
+        s = Span(name, parent.trace_id, parent.span_id, parent.sampled, attrs)
+    elif remote is not None:
+        s = Span(name, remote[0], remote[1], remote[2], attrs)
+    elif root:
+        s = Span(name, new_id(16), None, random.random() < TRACE_SAMPLE, attrs)
+    else:
+        s = None
+    if s is None:
+        yield NOOP
+        return
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.status = "error"
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        s.finish()
+
+
+def detached_span(name: str, parent: Optional[Span], **attrs):
+    """A child of parent that is not made current; the caller finishes it.
+
+    For work that outlives the block that started it, such as a streaming
+    response body, where each step may run in a different context.
+    """
+    if parent is None or not TRACE_FILE:
+        return NOOP
+    return Span(name, parent.trace_id, parent.span_id, parent.sampled, attrs)
+
+
+class _NoopSpan:
+    def set(self, **attrs) -> None:
+        pass
+
+    def rename(self, name: str) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+    def traceparent(self) -> None:
+        return None
+
+
+NOOP = _NoopSpan()
+
+
+def inject(headers: Optional[Dict] = None) -> Dict:
+    headers = dict(headers or {})
+    s = _current.get()
+    if s is not None:
+        headers["traceparent"] = s.traceparent()
+    return headers
+
+
+class Traced:
+    """Proxy that records a child span for every method call on target.
+
+    Only calls made inside an existing trace are recorded, so background
+    loops stay out of the file. Attributes listed in nested are wrapped too,
+    their name extending the span name (docker.api.start).
+    """
+
+    def __init__(self, target, prefix: str, attrs: Optional[Dict] = None, nested: Sequence[str] = ()):
+        self._target = target
+        self._prefix = prefix
+        self._attrs = attrs or {}
+        self._nested = tuple(nested)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name in self._nested:
+            return Traced(attr, f"{self._prefix}.{name}", self._attrs)
+        if not callable(attr):
+            return attr
+        span_name = f"{self._prefix}.{name}"
+
+        def traced(*args, **kwargs):
+            with span(span_name, root=False, **self._attrs):
+                return attr(*args, **kwargs)
+
+        return traced
+
+
+def traced_session():
+    """A requests.Session whose requests are spans and carry traceparent."""
+    import requests
+
+    class TracedSession(requests.Session):
+        def request(self, method, url, *args, **kwargs):
+            path = "/" + url.split("://", 1)[-1].split("/", 1)[-1].split("?", 1)[0]
+            with span(f"http {method.upper()} {path}", url=url) as s:
+                kwargs["headers"] = inject(kwargs.get("headers"))
+                response = super().request(method, url, *args, **kwargs)
+                s.set(status=response.status_code)
+                return response
+
+    return TracedSession()